@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from tests.mock_openai import MockOpenAIServer
+from tests.test_e2e import PROJECT_ROOT, create_repo
+
+
+def run_benchmark(file_count, line_count, server_options, rgpt_args):
+    """
+    Review a synthetic repository with rgpt against the mock server
+    and return wall time, requests, tokens and peak memory of the run
+    """
+    with tempfile.TemporaryDirectory() as repo_root:
+        create_repo(repo_root, file_count, line_count)
+        with MockOpenAIServer(**server_options) as server:
+            command = [
+                sys.executable,
+                "-m",
+                "gitreview_gpt",
+                "review",
+                "--base-url",
+                server.base_url,
+                *rgpt_args,
+            ]
+            env = {
+                **os.environ,
+                "OPENAI_API_KEY": "benchmark",
+                "PYTHONPATH": PROJECT_ROOT,
+                "XDG_CACHE_HOME": os.path.join(repo_root, ".cache"),
+            }
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                command,
+                cwd=repo_root,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            # read stderr while waiting, rgpt would block on a full pipe otherwise
+            stderr_chunks = []
+            stderr_reader = threading.Thread(
+                target=lambda: stderr_chunks.append(process.stderr.read())
+            )
+            stderr_reader.start()
+            peak_memory = None
+            if hasattr(os, "wait4"):
+                # resource usage of this process only, not of all children
+                _, status, resource_usage = os.wait4(process.pid, 0)
+                process.returncode = get_exit_code(status)
+                # kilobytes on linux, bytes on macos
+                peak_memory = resource_usage.ru_maxrss
+                if sys.platform == "darwin":
+                    peak_memory //= 1024
+            else:
+                process.wait()
+            wall_time = time.perf_counter() - start
+            stderr_reader.join()
+            process.stderr.close()
+            stderr = b"".join(stderr_chunks).decode()
+
+            if process.returncode != 0:
+                raise RuntimeError(f"rgpt failed for {file_count} files:\n{stderr}")
+
+            return {
+                "files": file_count,
+                "lines": line_count,
+                "wall_time": round(wall_time, 3),
+                "requests": len(server.requests),
+                "prompt_tokens": server.prompt_tokens,
+                "completion_tokens": server.completion_tokens,
+                "peak_memory_kb": peak_memory,
+            }
+
+
+def get_exit_code(status):
+    """
+    Return the exit code of a wait status like subprocess does,
+    negative if the process has been terminated by a signal
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+COLUMNS = [
+    ("files", "Files"),
+    ("wall_time", "Wall time [s]"),
+    ("requests", "Requests"),
+    ("prompt_tokens", "Prompt tokens"),
+    ("completion_tokens", "Completion tokens"),
+    ("peak_memory_kb", "Peak memory [KB]"),
+]
+
+
+def print_header():
+    print("  ".join(title for _, title in COLUMNS))
+
+
+def print_result(result):
+    print("  ".join(str(result[key]).rjust(len(title)) for key, title in COLUMNS))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark rgpt review against a local mock of the OpenAI api. "
+        + "Arguments after -- are passed to rgpt review.",
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100],
+        help="Number of changed files of each synthetic repository",
+    )
+    parser.add_argument(
+        "--lines", type=int, default=200, help="Number of lines per file"
+    )
+    parser.add_argument(
+        "--delay", type=float, default=0.2, help="Response delay in seconds"
+    )
+    parser.add_argument(
+        "--stream-chunk-delay",
+        type=float,
+        default=0.005,
+        help="Delay between streamed chunks in seconds",
+    )
+    parser.add_argument(
+        "--error-status", type=int, help="Status code of failing requests"
+    )
+    parser.add_argument(
+        "--error-count", type=int, default=0, help="Number of failing requests"
+    )
+    parser.add_argument(
+        "--truncate-ratio", type=float, help="Truncate responses to this fraction"
+    )
+    parser.add_argument("--json", type=str, help="Write the results to a json file")
+    args, rgpt_args = parser.parse_known_args()
+    if rgpt_args and rgpt_args[0] == "--":
+        rgpt_args = rgpt_args[1:]
+    # reviews are not applied to the synthetic repositories by default
+    rgpt_args = rgpt_args or ["--readonly", "--no-cache"]
+
+    server_options = {
+        "delay": args.delay,
+        "stream_chunk_delay": args.stream_chunk_delay,
+        "error_status": args.error_status,
+        "error_count": args.error_count,
+        "truncate_ratio": args.truncate_ratio,
+    }
+    results = []
+    print_header()
+    for file_count in args.files:
+        results.append(run_benchmark(file_count, args.lines, server_options, rgpt_args))
+        print_result(results[-1])
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
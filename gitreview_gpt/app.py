@@ -1,26 +1,60 @@
+import json
 import os
 import subprocess
 import argparse
+import atexit
+import itertools
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait
 import gitreview_gpt.prompt as prompt
 import gitreview_gpt.formatter as formatter
 import gitreview_gpt.utils as utils
 import gitreview_gpt.request as request
 import gitreview_gpt.reviewer as reviewer
+import gitreview_gpt.dispatcher as dispatcher
+import gitreview_gpt.cache as cache
+import gitreview_gpt.hunks as hunks
+import gitreview_gpt.incremental as incremental
+import gitreview_gpt.output as output
+import gitreview_gpt.profiler as profiler
 
 
 def get_git_diff(branch):
     """
-    Return the code changes as a git diff
+    Yield the code changes as git diff lines while git is still running
     """
-    if not branch:
-        command = ["git", "diff", "HEAD"]
-    else:
-        command = ["git", "diff", branch, "--cached"]
+    process = subprocess.Popen(
+        utils.get_git_diff_command(branch),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    try:
+        yield from process.stdout
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
 
-    git_diff = subprocess.run(command, capture_output=True, text=True)
 
-    return git_diff.stdout
+def report_profile(print_table, json_path):
+    """
+    Print the profile of the run and dump it to a json file
+    """
+    if print_table:
+        profiler.print_report(utils.message_stream)
+    if json_path:
+        profiler.dump_report(json_path)
+
+
+def close_review_writer(review_writer, output_path):
+    """
+    Complete the written reviews and close the output file
+    """
+    review_writer.close()
+    if output_path:
+        review_writer.file.close()
 
 
 def print_review_from_response_json(feedback_json):
@@ -35,34 +69,136 @@ def print_review_from_response_json(feedback_json):
             print("No issues found in " + utils.get_bold_text(file))
 
 
+class ReviewStreamPrinter:
+    """
+    Draw streamed review findings to console as soon as they arrive
+    """
+
+    def __init__(self):
+        self.printed_files = set()
+        self.open_box = None
+
+    def print_event(self, event):
+        # the model might key the review by the path instead of the file name
+        event = (event[0], dispatcher.get_file_name(event[1]), *event[2:])
+        if event[0] == "file":
+            self.close_box()
+        elif event[0] == "finding":
+            _, file, line, finding = event
+            if formatter.is_unused_suggestion(finding["feedback"]):
+                return
+            max_length = formatter.get_terminal_width() - 2
+            if self.open_box != file:
+                self.close_box()
+                print("✨ Review Result ✨")
+                print("\n".join(formatter.draw_box_header(file, max_length)))
+                self.open_box = file
+                self.printed_files.add(file)
+            print("\n".join(formatter.draw_box_entry(line, finding, max_length)))
+        elif event[0] == "file_end":
+            if self.open_box == event[1]:
+                self.close_box()
+            elif event[1] not in self.printed_files:
+                print("✨ Review Result ✨")
+                print("No issues found in " + utils.get_bold_text(event[1]))
+                self.printed_files.add(event[1])
+
+    def close_box(self):
+        if self.open_box is not None:
+            print(formatter.draw_box_footer(formatter.get_terminal_width() - 2))
+            self.open_box = None
+
+    def finish(self, file):
+        """
+        Close the review output of the current request
+        and return if the review of the file has been drawn
+        """
+        self.close_box()
+        printed = file in self.printed_files
+        self.printed_files.discard(file)
+        return printed
+
+
 def apply_review_to_file(
-    api_key, file, file_path, review_json, code_change_chunks, guided, gpt_model
+    api_key,
+    file,
+    file_path,
+    review_json,
+    code_change_chunks,
+    guided,
+    gpt_model,
+    repo_root,
+    unstaged_files,
+    max_workers=1,
+    show_spinner=True,
+    apply_mode=reviewer.APPLY_MODE_EDITS,
 ):
     """
     Apply review to file
     """
-    if not utils.has_unstaged_changes(file_path):
+    if file_path not in unstaged_files:
         if review_json:
             apply_changes = False
             if guided:
-                print(f"Apply changes to {utils.get_bold_text(file)}? (y/n)")
+                utils.print_message(
+                    f"Apply changes to {utils.get_bold_text(file)}? (y/n)"
+                )
                 apply_changes = input().lower() == "y"
             if not guided or apply_changes:
                 reviewer.apply_review(
                     api_key,
-                    os.path.abspath(file_path),
+                    os.path.join(repo_root, file_path),
                     review_json,
                     code_change_chunks,
                     gpt_model,
+                    max_workers,
+                    show_spinner,
+                    apply_mode,
                 )
     else:
-        print(
+        utils.print_message(
             f"⚠️  There are unstaged changes in {utils.get_bold_text(file)}. "
             + "Please commit or stage them. "
             + "Applying review changes skipped for now."
         )
 
 
+class ApplyPipeline:
+    """
+    Apply reviews in a background thread, while the next files are reviewed.
+    Reviews of the same file are applied one after another in order.
+    """
+
+    def __init__(self, max_workers=1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.file_futures = {}
+
+    def submit(self, file_path, function, *args):
+        # tasks are started in order, so the previous task of the file
+        # is already running when it is awaited
+        future = self.executor.submit(
+            self._apply, self.file_futures.get(file_path), function, *args
+        )
+        self.file_futures[file_path] = future
+        self.futures.append(future)
+
+    def _apply(self, previous_future, function, *args):
+        if previous_future is not None:
+            wait([previous_future])
+        function(*args)
+
+    def close(self):
+        """
+        Wait until all reviews are applied
+        """
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown()
+
+
 def run():
     """
     Main function to run the script
@@ -71,8 +207,9 @@ def run():
 
     parser.add_argument(
         "action",
-        choices=["review", "commit"],
-        help="Review changes (review) or create commit message (commit)",
+        choices=["review", "commit", "batch"],
+        help="Review changes (review), create commit message (commit) "
+        + "or review the changes of multiple repositories (batch)",
     )
     parser.add_argument(
         "--branch", type=str, help="Review changes against a specific branch"
@@ -88,9 +225,124 @@ def run():
         action="store_true",
         help="Readonly mode. Review changes without applying them to the files.",
     )
+    parser.add_argument(
+        "--apply-mode",
+        choices=[reviewer.APPLY_MODE_EDITS, reviewer.APPLY_MODE_FILE],
+        default=reviewer.APPLY_MODE_EDITS,
+        help="Apply review changes as search and replace edits of the file (edits) "
+        + "or request the complete updated file (file). Edits which don't match "
+        + "the file fall back to the complete file (default: edits)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=output.FORMATS,
+        default=output.FORMAT_TEXT,
+        help="Output format of the reviews. json and jsonl are written "
+        + "file by file as the reviews are done, sarif when all files are "
+        + "reviewed (default: text)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Write the reviews in json, jsonl or sarif format to this file "
+        + "(default: stdout)",
+    )
+    parser.add_argument(
+        "--targets",
+        type=str,
+        help="Batch mode. File with one repository to review per line, "
+        + "as <path> [<branch>] [-- <pathspec>...], or - for stdin",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="Batch mode. Write the aggregated review report to this json file",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Incremental mode for --branch. Review only the commits since the "
+        + "last review of the current branch and keep the findings of unchanged "
+        + "lines of previous reviews.",
+    )
     parser.add_argument(
         "--gpt4", action="store_true", help="Use GPT-4 (default: GPT-3.5)"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of review or apply requests in flight (default: 4)",
+    )
+    parser.add_argument(
+        "--pack-ratio",
+        type=float,
+        default=dispatcher.DEFAULT_PACK_RATIO,
+        help="Pack small files into shared review requests up to this fraction "
+        + "of the token limit of the model, 0 disables packing "
+        + f"(default: {dispatcher.DEFAULT_PACK_RATIO})",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the reviews and draw each finding as soon as it arrives.",
+    )
+    parser.add_argument(
+        "--structured-output",
+        action="store_true",
+        help="Request the reviews as function calls with a json schema "
+        + "instead of json in text.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't use cached reviews of unchanged files and hunks.",
+    )
+    parser.add_argument(
+        "--base-url",
+        type=str,
+        help="Base url of an OpenAI compatible api "
+        + f"(default: $OPENAI_BASE_URL or {request.DEFAULT_BASE_URL})",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        help="Timeout in seconds for connecting to the api "
+        + f"(default: {request.DEFAULT_CONNECT_TIMEOUT})",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        help="Timeout in seconds for waiting on a response of the api "
+        + f"(default: {request.DEFAULT_READ_TIMEOUT})",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        help="Maximum number of retries of rate limited or failed api requests "
+        + f"(default: {request.DEFAULT_MAX_RETRIES})",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        help="Requests per minute allowed by your OpenAI quota (default: unlimited)",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        help="Tokens per minute allowed by your OpenAI quota (default: unlimited)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print where the time of the run went, the requests, retries, "
+        + "tokens and cache hits.",
+    )
+    parser.add_argument(
+        "--profile-json",
+        type=str,
+        help="Write the profile of the run to a json file",
+    )
 
     args = parser.parse_args()
 
@@ -102,58 +354,292 @@ def run():
     if not args.action:
         sys.exit()
 
-    diff_text = None
+    if args.concurrency < 1:
+        sys.exit("--concurrency must be at least 1.")
 
-    if args.action == "review":
-        diff_text = get_git_diff(args.branch)
-    elif args.action == "commit":
-        diff_text = subprocess.run(
-            ["git", "diff", "--cached"], capture_output=True, text=True
-        ).stdout
+    if args.pack_ratio < 0:
+        sys.exit("--pack-ratio must not be negative.")
+
+    if args.action == "batch" and not (args.targets and args.report):
+        sys.exit("batch requires --targets and --report.")
 
-    if not diff_text:
-        sys.exit("No git changes.")
+    if args.output and args.format == output.FORMAT_TEXT:
+        sys.exit("--output requires --format json, jsonl or sarif.")
 
-    (
-        formatted_diff,
-        diff_file_chunks,
-        code_change_chunks,
-        file_paths,
-    ) = formatter.format_git_diff(diff_text)
+    if args.incremental and not args.branch:
+        sys.exit("--incremental requires --branch.")
+
+    if args.profile or args.profile_json:
+        profiler.enable()
+        # report on every exit, e.g. also if there are no changes
+        atexit.register(report_profile, args.profile, args.profile_json)
+
+    request.configure(
+        base_url=args.base_url,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        # connections for concurrent reviews and concurrent applied code chunks
+        pool_size=args.concurrency * 2,
+        max_retries=args.max_retries,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+    )
+
+    gpt_model = prompt.GptModel.GPT_4 if args.gpt4 else prompt.GptModel.GPT_35
+    # packed requests have to fit into the context of the model
+    pack_ratio = min(args.pack_ratio, dispatcher.get_max_pack_ratio(gpt_model))
 
     if args.action == "review":
-        gpt_model = prompt.GptModel.GPT_4 if args.gpt4 else prompt.GptModel.GPT_35
-
-        for key, value in diff_file_chunks.items():
-            review_file = False
-            if args.guided:
-                print(f"Review file {utils.get_bold_text(key)}? (y/n)")
-                review_file = input().lower() == "y"
-            if not args.guided or review_file:
-                file_tokens = utils.count_tokens(value)
-                if file_tokens > gpt_model.value - 1024:
-                    print(
-                        f"⚠️  The token count of {utils.get_bold_text(key)} exceeds "
-                        + "the current limit for a file. Conder using the "
-                        + f"{utils.get_bold_text('--gpt4')} flag."
+        # set up the output before any message is printed
+        review_writer = None
+        if args.format != output.FORMAT_TEXT:
+            output_file = open(args.output, "w") if args.output else sys.stdout
+            if output_file is sys.stdout:
+                # keep stdout for the reviews, messages and spinners go to stderr
+                utils.set_message_stream(sys.stderr)
+            review_writer = output.ReviewWriter(output_file, args.format, gpt_model)
+
+        # in incremental mode only the changes since the last review are diffed,
+        # the findings of previous reviews are moved to the current lines
+        diff_base = args.branch
+        review_state = None
+        carried_findings = {}
+        if args.incremental:
+            review_state = incremental.ReviewState(
+                utils.get_git_repo_root(), args.branch
+            ).load()
+            if review_state.commit and incremental.is_ancestor(review_state.commit):
+                diff_base = review_state.commit
+                carried_findings = incremental.remap_findings(
+                    review_state.findings,
+                    incremental.get_changed_lines(review_state.commit),
+                )
+                utils.print_message(
+                    f"Reviewing changes since {review_state.commit[:7]}"
+                )
+
+        # parse the diff while git is still running,
+        # so that the first reviews are requested as early as possible,
+        # the time of parsing includes waiting for the output of git
+        file_chunks = profiler.timed_iter(
+            "format_git_diff",
+            formatter.parse_git_diff(
+                profiler.timed_iter("get_git_diff", get_git_diff(diff_base))
+            ),
+        )
+        first_file_chunk = next(file_chunks, None)
+        if first_file_chunk is None:
+            # the findings of previous reviews are still reported
+            if review_writer is not None:
+                for file_path, file_findings in carried_findings.items():
+                    review_writer.write_file(file_path, file_findings)
+                close_review_writer(review_writer, args.output)
+            elif carried_findings:
+                print("Findings of previous reviews:")
+                print_review_from_response_json(carried_findings)
+            if not carried_findings:
+                sys.exit("No git changes.")
+            utils.print_message("No new git changes.")
+            return
+        file_chunks = itertools.chain([first_file_chunk], file_chunks)
+
+        review_timer = output.ReviewTimer()
+
+        review_complete = True
+        # ask for all files up front in guided mode,
+        # so that the reviews can be requested concurrently afterwards
+        if args.guided:
+            selected_file_chunks = []
+            for file_chunk in file_chunks:
+                file_name = utils.get_bold_text(file_chunk.file_name)
+                utils.print_message(f"Review file {file_name}? (y/n)")
+                if input().lower() == "y":
+                    selected_file_chunks.append(file_chunk)
+                else:
+                    # skipped changes are reviewed in the next incremental run
+                    review_complete = False
+            file_chunks = selected_file_chunks
+
+        if not args.readonly:
+            # query the repo state once instead of per applied file
+            repo_root = utils.get_git_repo_root()
+            unstaged_files = utils.get_unstaged_files(repo_root)
+        # apply reviews while the next files are reviewed in autonomous mode,
+        # in guided mode each file is confirmed before it is applied
+        apply_pipeline = None
+        if not args.readonly and not args.guided:
+            apply_pipeline = ApplyPipeline()
+        review_cache = None if args.no_cache else cache.ReviewCache()
+        hunk_index = None if args.no_cache else hunks.HunkIndex()
+        stream_printer = None
+        if args.stream and review_writer is None:
+            stream_printer = ReviewStreamPrinter()
+        findings = dict(carried_findings)
+
+        for file_chunk, review_json in dispatcher.request_reviews(
+            api_key,
+            file_chunks,
+            gpt_model,
+            args.concurrency,
+            review_cache,
+            stream_printer.print_event if stream_printer else None,
+            pack_ratio,
+            args.structured_output,
+            hunk_index,
+            review_timer,
+        ):
+            streamed = stream_printer is not None and stream_printer.finish(
+                file_chunk.file_name
+            )
+            if review_json is None:
+                # failed reviews are requested again in the next incremental run
+                review_complete = False
+                if review_writer is not None:
+                    review_writer.write_file(
+                        file_chunk.file_path, None, review_timer.stop(file_chunk)
                     )
-                    continue
-                review_json = reviewer.request_review(api_key, value, gpt_model, key)
-                if review_json is not None:
-                    print_review_from_response_json(review_json)
-                    if not args.readonly:
-                        for file_name, review in review_json.items():
-                            apply_review_to_file(
-                                api_key,
-                                file_name,
-                                file_paths[file_name],
-                                review,
-                                code_change_chunks[file_name],
-                                args.guided,
-                                gpt_model,
-                            )
+                continue
+            file_findings = review_json.get(file_chunk.file_name, {})
+            if review_state is not None:
+                # merge the new findings with the findings of unchanged lines
+                file_findings = {
+                    **carried_findings.get(file_chunk.file_path, {}),
+                    **file_findings,
+                }
+                findings[file_chunk.file_path] = file_findings
+                if not streamed:
+                    # previous findings are drawn together with the new ones
+                    carried_findings.pop(file_chunk.file_path, None)
+            if review_writer is not None:
+                review_writer.write_file(
+                    file_chunk.file_path, file_findings, review_timer.stop(file_chunk)
+                )
+            elif not streamed:
+                print_review_from_response_json({file_chunk.file_name: file_findings})
+            if apply_pipeline is not None:
+                apply_pipeline.submit(
+                    file_chunk.file_path,
+                    apply_review_to_file,
+                    api_key,
+                    file_chunk.file_name,
+                    file_chunk.file_path,
+                    review_json[file_chunk.file_name],
+                    file_chunk.code_chunks,
+                    args.guided,
+                    gpt_model,
+                    repo_root,
+                    unstaged_files,
+                    args.concurrency,
+                    False,
+                    args.apply_mode,
+                )
+            elif not args.readonly:
+                apply_review_to_file(
+                    api_key,
+                    file_chunk.file_name,
+                    file_chunk.file_path,
+                    review_json[file_chunk.file_name],
+                    file_chunk.code_chunks,
+                    args.guided,
+                    gpt_model,
+                    repo_root,
+                    unstaged_files,
+                    args.concurrency,
+                    True,
+                    args.apply_mode,
+                )
+
+        if apply_pipeline is not None:
+            apply_pipeline.close()
+
+        if review_writer is not None:
+            for file_path, file_findings in carried_findings.items():
+                review_writer.write_file(file_path, file_findings)
+            close_review_writer(review_writer, args.output)
+        elif carried_findings:
+            print("Findings of previous reviews:")
+            print_review_from_response_json(carried_findings)
+
+        # staged changes are reviewed again in the next run, since the findings
+        # are at the lines of the index and not of the saved commit
+        if (
+            review_state is not None
+            and review_complete
+            and not incremental.has_staged_changes()
+        ):
+            review_state.save(incremental.get_head_commit(), findings)
+
+        if review_cache is not None:
+            review_cache.evict()
+        if hunk_index is not None:
+            hunk_index.evict()
+
+    elif args.action == "batch":
+        # the process pool of batch mode is only imported for batch runs
+        import gitreview_gpt.batch as batch
+
+        # reviews of a batch are not applied to the repositories
+        try:
+            if args.targets == "-":
+                targets = batch.parse_targets(sys.stdin)
+            else:
+                with open(args.targets, "r") as file:
+                    targets = batch.parse_targets(file)
+        except (OSError, ValueError) as e:
+            sys.exit(str(e))
+        if not targets:
+            sys.exit("No batch targets.")
+
+        review_cache = None if args.no_cache else cache.ReviewCache()
+        hunk_index = None if args.no_cache else hunks.HunkIndex()
+        report = batch.BatchReport(gpt_model, targets)
+
+        for target, file_chunk, review_json in batch.review_targets(
+            api_key,
+            targets,
+            gpt_model,
+            args.concurrency,
+            review_cache,
+            pack_ratio,
+            args.structured_output,
+            hunk_index,
+            report.errors,
+        ):
+            report.add(target, file_chunk, review_json)
+            if review_json is not None:
+                print_review_from_response_json(
+                    {
+                        os.path.join(target.path, file_chunk.file_path): (
+                            review_json[file_chunk.file_name]
+                        )
+                    }
+                )
+
+        for target in targets:
+            if id(target) in report.errors:
+                print(f"💥 Could not review {target.path}: {report.errors[id(target)]}")
+
+        with open(args.report, "w") as file:
+            json.dump(report.to_json(), file, indent=2)
+
+        if review_cache is not None:
+            review_cache.evict()
+        if hunk_index is not None:
+            hunk_index.evict()
+
+        if report.errors:
+            sys.exit(f"{len(report.errors)} of {len(targets)} targets failed.")
 
     elif args.action == "commit":
+        with profiler.timer("get_git_diff"):
+            diff_text = subprocess.run(
+                ["git", "diff", "--cached"], capture_output=True, text=True
+            ).stdout
+
+        if not diff_text:
+            sys.exit("No git changes.")
+
+        formatted_diff, _, _, _ = formatter.format_git_diff(diff_text)
         payload = prompt.get_commit_message_prompt(formatted_diff)
         commit_message = request.send_request(
             api_key, payload, "Creating commit message..."
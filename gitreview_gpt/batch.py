@@ -0,0 +1,158 @@
+import os
+import shlex
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import gitreview_gpt.dispatcher as dispatcher
+import gitreview_gpt.formatter as formatter
+import gitreview_gpt.output as output
+import gitreview_gpt.prompt as prompt
+import gitreview_gpt.utils as utils
+
+REPORT_VERSION = 2
+
+
+# Repository or subproject of a monorepo to review in a batch.
+# Changes are reviewed against the branch, or the working directory
+# changes if there is no branch, limited to the pathspecs.
+class BatchTarget:
+    def __init__(self, path, branch=None, pathspecs=()):
+        self.path = path
+        self.branch = branch
+        self.pathspecs = list(pathspecs)
+
+
+# Parse batch targets, one per line: <path> [<branch>] [-- <pathspec>...]
+# Empty lines and lines starting with # are skipped.
+def parse_targets(lines: Iterable[str]) -> List[BatchTarget]:
+    targets = []
+    for line_number, line in enumerate(lines, start=1):
+        parts = shlex.split(line, comments=True)
+        if not parts:
+            continue
+        pathspecs = []
+        if "--" in parts:
+            separator = parts.index("--")
+            parts, pathspecs = parts[:separator], parts[separator + 1 :]
+        if not parts or len(parts) > 2:
+            raise ValueError(f"Invalid batch target in line {line_number}: {line}")
+        targets.append(
+            BatchTarget(parts[0], parts[1] if len(parts) > 1 else None, pathspecs)
+        )
+    return targets
+
+
+# Run git diff for a target and parse it into file chunks.
+# Runs in a worker process, the error is returned instead of raised.
+def extract_file_chunks(
+    target: BatchTarget,
+) -> Tuple[List[formatter.FileChunk], Optional[str]]:
+    try:
+        result = subprocess.run(
+            utils.get_git_diff_command(target.branch, target.pathspecs),
+            cwd=target.path,
+            capture_output=True,
+            text=True,
+        )
+    except OSError as e:
+        return [], str(e)
+    if result.returncode != 0:
+        return [], result.stderr.strip() or f"git diff failed in {target.path}"
+    return list(formatter.parse_git_diff(formatter.iter_lines(result.stdout))), None
+
+
+# Yield the file chunks of all targets in order, while the diffs of the
+# following targets are still extracted in a pool of worker processes
+def iter_target_file_chunks(
+    targets: List[BatchTarget], max_workers=None, errors=None
+) -> Iterator[Tuple[BatchTarget, formatter.FileChunk]]:
+    max_workers = max_workers or min(len(targets), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        for target, (file_chunks, error) in zip(
+            targets, executor.map(extract_file_chunks, targets)
+        ):
+            if error is not None and errors is not None:
+                errors[id(target)] = error
+            for file_chunk in file_chunks:
+                yield target, file_chunk
+
+
+# Review the changes of all targets with shared review requests,
+# so that all targets share the http session, the rate limiter
+# and the concurrency of the requests.
+# Yield the target, file chunk and review of every file in order.
+def review_targets(
+    api_key,
+    targets: List[BatchTarget],
+    gpt_model,
+    max_workers=1,
+    review_cache=None,
+    pack_ratio=dispatcher.DEFAULT_PACK_RATIO,
+    structured_output=False,
+    hunk_index=None,
+    errors=None,
+) -> Iterator[Tuple[BatchTarget, formatter.FileChunk, Optional[Dict[str, Any]]]]:
+    file_targets = {}
+
+    def iter_file_chunks():
+        for target, file_chunk in iter_target_file_chunks(targets, errors=errors):
+            file_targets[id(file_chunk)] = target
+            yield file_chunk
+
+    for file_chunk, review_json in dispatcher.request_reviews(
+        api_key,
+        iter_file_chunks(),
+        gpt_model,
+        max_workers,
+        review_cache,
+        None,
+        pack_ratio,
+        structured_output,
+        hunk_index,
+    ):
+        yield file_targets.pop(id(file_chunk)), file_chunk, review_json
+
+
+# Aggregated report of a batch review.
+# Files are reported with the same records as the output of --format.
+class BatchReport:
+    def __init__(self, gpt_model, targets: List[BatchTarget]):
+        self.model = prompt.get_model_name(gpt_model)
+        self.targets = targets
+        self.files = {id(target): [] for target in targets}
+        self.errors = {}
+
+    def add(self, target, file_chunk, review_json):
+        findings = None
+        if review_json is not None:
+            findings = review_json.get(file_chunk.file_name, {})
+        self.files[id(target)].append(
+            output.get_file_record(file_chunk.file_path, findings, self.model, None)
+        )
+
+    def to_json(self) -> Dict[str, Any]:
+        targets = []
+        for target in self.targets:
+            files = self.files[id(target)]
+            targets.append(
+                {
+                    "path": target.path,
+                    "branch": target.branch,
+                    "pathspecs": target.pathspecs,
+                    "error": self.errors.get(id(target)),
+                    "files": files,
+                }
+            )
+        all_files = [file for files in self.files.values() for file in files]
+        return {
+            "version": REPORT_VERSION,
+            "model": self.model,
+            "summary": {
+                "targets": len(self.targets),
+                "failed_targets": len(self.errors),
+                "files": len(all_files),
+                "failed_files": sum(not file["reviewed"] for file in all_files),
+                "findings": sum(len(file["findings"]) for file in all_files),
+            },
+            "targets": targets,
+        }
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional
+import gitreview_gpt.prompt as prompt
+import gitreview_gpt.profiler as profiler
+
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+
+
+def get_default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "gitreview-gpt", "reviews")
+
+
+# Persistent cache for parsed review results.
+# Entries are keyed by model, prompt version and the hash of the reviewed code
+# and are evicted by age and by total size, least recently used first.
+class ReviewCache:
+    # prefix of the hit and miss counters when profiling
+    profile_name = "cache"
+
+    def __init__(
+        self, cache_dir=None, max_age=DEFAULT_MAX_AGE, max_size=DEFAULT_MAX_SIZE
+    ):
+        self.cache_dir = cache_dir or get_default_cache_dir()
+        self.max_age = max_age
+        self.max_size = max_size
+
+    def get_key(self, code, gpt_model) -> str:
+        key = f"{gpt_model.name}\0{prompt.PROMPT_VERSION}\0{code}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, code, gpt_model) -> Optional[Dict[str, Any]]:
+        path = self.get_path(self.get_key(code, gpt_model))
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                profiler.count(f"{self.profile_name}_misses")
+                return None
+            with open(path, "r") as file:
+                review_json = json.load(file)
+            # mark entry as recently used for eviction
+            os.utime(path)
+            profiler.count(f"{self.profile_name}_hits")
+            return review_json
+        except (OSError, ValueError):
+            profiler.count(f"{self.profile_name}_misses")
+            return None
+
+    def put(self, code, gpt_model, review_json):
+        path = self.get_path(self.get_key(code, gpt_model))
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to temporary file first, so that concurrent runs
+            # never read a partially written entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as file:
+                json.dump(review_json, file)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def evict(self):
+        try:
+            entries = []
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith(".json"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        now = time.time()
+        total_size = 0
+        # keep most recently used entries until max size is reached
+        for mtime, size, path in sorted(entries, reverse=True):
+            if now - mtime > self.max_age or total_size + size > self.max_size:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            else:
+                total_size += size
@@ -0,0 +1,507 @@
+import collections
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import gitreview_gpt.formatter as formatter
+import gitreview_gpt.hunks as hunks
+import gitreview_gpt.review_parser as review_parser
+import gitreview_gpt.reviewer as reviewer
+import gitreview_gpt.tokens as tokens
+import gitreview_gpt.utils as utils
+
+DEFAULT_PACK_RATIO = 0.25
+# tokens of the context of the model which are left for the review
+REVIEW_TOKENS = 1024
+
+
+# Fan out review requests to a bounded thread pool
+# and yield the review results in the order of the given files.
+# Small files are packed into shared review requests
+# up to pack_ratio of the token limit of the model.
+# Files with a cached review are not sent to the api.
+# With a hunk index, only the hunks which are not indexed are sent to the api
+# and the indexed findings are merged into the review of the file.
+# If on_stream_event is given, the reviews are streamed and the parsed
+# findings are passed to on_stream_event in the order of the given files,
+# before the review results of the files are yielded.
+# If review_timer is given, the time of the review request of each file
+# is recorded before the file is yielded.
+def request_reviews(
+    api_key,
+    file_chunks: Iterable[formatter.FileChunk],
+    gpt_model,
+    max_workers=1,
+    review_cache=None,
+    on_stream_event=None,
+    pack_ratio=DEFAULT_PACK_RATIO,
+    structured_output=False,
+    hunk_index=None,
+    review_timer=None,
+) -> Iterator[Tuple[formatter.FileChunk, Optional[Dict[str, Any]]]]:
+    max_file_tokens = get_max_file_tokens(gpt_model)
+    # packs never exceed the limit of a file, so that the open pack is
+    # submitted before any file which is reviewed in windows
+    max_pack_tokens = min(int(gpt_model.value * pack_ratio), max_file_tokens)
+    # original file, indexed findings and reviewed hunks per requested file
+    indexed_files = {}
+
+    def complete(pending_review):
+        for file_chunk, review_json in pending_review.complete(on_stream_event):
+            review_seconds = pending_review.get_review_seconds(file_chunk)
+            if hunk_index is not None:
+                file_chunk, review_json = _merge_indexed_findings(
+                    *indexed_files.pop(id(file_chunk)),
+                    review_json,
+                    hunk_index,
+                    gpt_model,
+                    on_stream_event,
+                )
+            if review_timer is not None:
+                review_timer.record(file_chunk, review_seconds)
+            yield file_chunk, review_json
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # the files are consumed lazily, so that requests are sent
+        # while the remaining files are still being parsed
+        pending_reviews = collections.deque()
+        packed_review = None
+
+        for file_chunk in file_chunks:
+            cached_review = None
+            if review_cache is not None:
+                cached_review = review_cache.get(file_chunk.diff, gpt_model)
+            if hunk_index is not None:
+                file_chunk, cached_review = _lookup_hunk_index(
+                    file_chunk, cached_review, hunk_index, gpt_model, indexed_files
+                )
+
+            if cached_review is not None:
+                # keep the order of the files by adding cached reviews
+                # to the open packed review
+                if packed_review is not None:
+                    packed_review.add_file(file_chunk, cached_review=cached_review)
+                else:
+                    pending_review = PendingReview(
+                        gpt_model, review_cache, structured_output
+                    )
+                    pending_review.add_file(file_chunk, cached_review=cached_review)
+                    pending_review.submit(executor, api_key, on_stream_event)
+                    pending_reviews.append(pending_review)
+            else:
+                file_tokens = tokens.count_tokens(file_chunk.diff)
+
+                # submit the open packed review before a file which doesn't fit,
+                # reviews are keyed by file name and can't be told apart otherwise
+                if packed_review is not None and (
+                    file_tokens > max_pack_tokens
+                    or packed_review.tokens + file_tokens > max_pack_tokens
+                    or packed_review.has_file_name(file_chunk.file_name)
+                ):
+                    packed_review.submit(executor, api_key, on_stream_event)
+                    packed_review = None
+
+                if file_tokens > max_file_tokens:
+                    # review oversized files in windows of their hunks
+                    pending_review = PendingReview(
+                        gpt_model, review_cache, structured_output
+                    )
+                    pending_review.add_file(
+                        file_chunk,
+                        file_tokens,
+                        windows=split_file_chunk(file_chunk, max_file_tokens),
+                    )
+                    pending_review.submit(executor, api_key, on_stream_event)
+                    pending_reviews.append(pending_review)
+                elif file_tokens <= max_pack_tokens:
+                    if packed_review is None:
+                        packed_review = PendingReview(
+                            gpt_model, review_cache, structured_output
+                        )
+                        pending_reviews.append(packed_review)
+                    packed_review.add_file(file_chunk, file_tokens)
+                else:
+                    pending_review = PendingReview(
+                        gpt_model, review_cache, structured_output
+                    )
+                    pending_review.add_file(file_chunk, file_tokens)
+                    pending_review.submit(executor, api_key, on_stream_event)
+                    pending_reviews.append(pending_review)
+
+            while pending_reviews and pending_reviews[0].is_done():
+                yield from complete(pending_reviews.popleft())
+
+        if packed_review is not None:
+            packed_review.submit(executor, api_key, on_stream_event)
+
+        while pending_reviews:
+            yield from complete(pending_reviews.popleft())
+
+
+def get_max_file_tokens(gpt_model):
+    return gpt_model.value - REVIEW_TOKENS
+
+
+# Return the largest pack ratio whose packs fit into a single request
+def get_max_pack_ratio(gpt_model):
+    return get_max_file_tokens(gpt_model) / gpt_model.value
+
+
+# Review request for one or more files.
+# Files with a cached review are not part of the request.
+# A file which exceeds the token limit is reviewed with one request
+# per window of its diff and the results are merged.
+# If the review of a window fails, the review of the whole file fails,
+# so that a partial review is neither cached nor taken as complete.
+class PendingReview:
+    def __init__(self, gpt_model, review_cache=None, structured_output=False):
+        self.gpt_model = gpt_model
+        self.review_cache = review_cache
+        self.structured_output = structured_output
+        self.files = []
+        self.tokens = 0
+        self.windows = None
+        self.submitted = False
+        self.future = None
+        self.window_futures = None
+        self.stream_events = None
+        self.submit_time = None
+        self.done_time = None
+
+    def add_file(self, file_chunk, file_tokens=0, cached_review=None, windows=None):
+        self.files.append((file_chunk, cached_review))
+        self.tokens += file_tokens
+        self.windows = windows
+
+    def has_file_name(self, file_name):
+        return any(file_chunk.file_name == file_name for file_chunk, _ in self.files)
+
+    def get_requested_file_chunks(self):
+        return [
+            file_chunk
+            for file_chunk, cached_review in self.files
+            if cached_review is None
+        ]
+
+    def submit(self, executor, api_key, on_stream_event=None):
+        self.submitted = True
+        requested_file_chunks = self.get_requested_file_chunks()
+        if not requested_file_chunks:
+            return
+        self.submit_time = time.perf_counter()
+
+        if self.windows is not None:
+            # windows are not streamed,
+            # since their findings would be drawn interleaved
+            file_name = requested_file_chunks[0].file_name
+            self.window_futures = [
+                executor.submit(
+                    self._request_review,
+                    api_key,
+                    window,
+                    self.gpt_model,
+                    f"{file_name} {index}/{len(self.windows)}",
+                    False,
+                    None,
+                    self.structured_output,
+                )
+                for index, window in enumerate(self.windows, start=1)
+            ]
+            return
+
+        on_content = None
+        if on_stream_event is not None:
+            self.stream_events = queue.Queue()
+            on_content = _get_stream_event_producer(self.stream_events)
+        self.future = executor.submit(
+            self._request_review,
+            api_key,
+            "".join(file_chunk.diff for file_chunk in requested_file_chunks),
+            self.gpt_model,
+            ", ".join(file_chunk.file_name for file_chunk in requested_file_chunks),
+            False,
+            on_content,
+            self.structured_output,
+        )
+
+    # Request a review in a worker thread and keep the time it is done,
+    # windows are done with their last request
+    def _request_review(self, *args):
+        try:
+            return reviewer.request_review(*args)
+        finally:
+            self.done_time = time.perf_counter()
+
+    # Return the time of the request of a file from its submission until
+    # it is done, None if the file has a cached review
+    def get_review_seconds(self, file_chunk):
+        if self.submit_time is None or self.done_time is None:
+            return None
+        if any(
+            cached_file_chunk is file_chunk and cached_review is not None
+            for cached_file_chunk, cached_review in self.files
+        ):
+            return None
+        return self.done_time - self.submit_time
+
+    def is_done(self):
+        if self.window_futures is not None:
+            return all(future.done() for future in self.window_futures)
+        return self.submitted and (self.future is None or self.future.done())
+
+    def complete(self, on_stream_event=None):
+        review_json = None
+        if self.window_futures is not None:
+            review_json = self._await_windows()
+        elif self.future is not None:
+            file_names = ", ".join(
+                file_chunk.file_name for file_chunk in self.get_requested_file_chunks()
+            )
+            spinner_text = f"🔍 Reviewing {utils.get_bold_text(file_names)}..."
+            if self.stream_events is not None:
+                review_json = _await_streamed_review(
+                    self.future, self.stream_events, on_stream_event, spinner_text
+                )
+            # show a single spinner for the request which is awaited next,
+            # since spinners of concurrent requests would overwrite each other
+            elif not self.future.done():
+                with utils.get_spinner(spinner_text):
+                    review_json = self.future.result()
+            else:
+                review_json = self.future.result()
+
+        results = []
+        for file_chunk, cached_review in self.files:
+            if cached_review is not None:
+                utils.print_message(
+                    "♻️  Using cached review of "
+                    + utils.get_bold_text(file_chunk.file_name)
+                )
+                results.append((file_chunk, cached_review))
+            elif review_json is None:
+                results.append((file_chunk, None))
+            else:
+                file_review = {
+                    file_chunk.file_name: get_file_review(
+                        review_json, file_chunk.file_name
+                    )
+                }
+                if review_parser.is_truncated(review_json):
+                    # findings might be missing, so the file is reviewed again
+                    file_review = review_parser.TruncatedReview(file_review)
+                elif self.review_cache is not None:
+                    self.review_cache.put(file_chunk.diff, self.gpt_model, file_review)
+                results.append((file_chunk, file_review))
+        return results
+
+    def _await_windows(self):
+        file_name = self.files[0][0].file_name
+        review_json = None
+        failed = False
+        truncated = False
+        for index, future in enumerate(self.window_futures, start=1):
+            if not future.done():
+                spinner_text = (
+                    f"🔍 Reviewing {utils.get_bold_text(file_name)}... "
+                    + f"{index}/{len(self.window_futures)}"
+                )
+                with utils.get_spinner(spinner_text):
+                    future.result()
+            window_review_json = future.result()
+            if window_review_json is None:
+                failed = True
+            if failed:
+                # await the remaining windows before the file is reported
+                continue
+            if review_json is None:
+                review_json = {file_name: {}}
+            review_json[file_name].update(
+                get_file_review(window_review_json, file_name)
+            )
+            truncated = truncated or review_parser.is_truncated(window_review_json)
+        if failed:
+            return None
+        if truncated:
+            return review_parser.TruncatedReview(review_json)
+        return review_json
+
+
+# Look up the hunks of a file in the hunk index and return the file chunk
+# to request, which only has the hunks which are not indexed,
+# and the cached review, if all hunks are indexed
+def _lookup_hunk_index(file_chunk, cached_review, hunk_index, gpt_model, indexed_files):
+    if cached_review is not None:
+        # index the hunks of cached reviews as well
+        indexed_files[id(file_chunk)] = (
+            file_chunk,
+            {},
+            hunks.get_code_chunks(file_chunk),
+        )
+        return file_chunk, cached_review
+
+    indexed_findings, new_code_chunks = hunk_index.lookup(file_chunk, gpt_model)
+    request_file_chunk = file_chunk
+    if not new_code_chunks:
+        cached_review = {file_chunk.file_name: {}}
+    elif len(new_code_chunks) < len(hunks.get_code_chunks(file_chunk)):
+        request_file_chunk = hunks.get_partial_file_chunk(file_chunk, new_code_chunks)
+    indexed_files[id(request_file_chunk)] = (
+        file_chunk,
+        indexed_findings,
+        new_code_chunks,
+    )
+    return request_file_chunk, cached_review
+
+
+# Index the findings of the reviewed hunks of a file
+# and merge them with the indexed findings of the other hunks
+def _merge_indexed_findings(
+    file_chunk,
+    indexed_findings,
+    new_code_chunks,
+    review_json,
+    hunk_index,
+    gpt_model,
+    on_stream_event,
+):
+    if review_json is None:
+        return file_chunk, None
+    findings = review_json.get(file_chunk.file_name, {})
+    # hunks of a truncated review might miss findings and are reviewed again
+    if not review_parser.is_truncated(review_json):
+        hunk_index.add(file_chunk.file_path, new_code_chunks, gpt_model, findings)
+    if not indexed_findings:
+        return file_chunk, review_json
+    if on_stream_event is not None and new_code_chunks:
+        # the findings of the reviewed hunks have been streamed already
+        for line_key, finding in indexed_findings.items():
+            on_stream_event(("finding", file_chunk.file_name, line_key, finding))
+        on_stream_event(("file_end", file_chunk.file_name))
+    # findings are applied in the order of their lines
+    merged_findings = dict(
+        sorted(
+            {**indexed_findings, **findings}.items(),
+            key=lambda item: hunks.get_first_line(item[0]) or 0,
+        )
+    )
+    return file_chunk, {file_chunk.file_name: merged_findings}
+
+
+# Split the diff of a file into windows which fit into max_tokens.
+# Windows are split along hunks, preferably where the selection marker
+# changes, and hunks which exceed max_tokens on their own are split by lines.
+def split_file_chunk(file_chunk, max_tokens) -> List[str]:
+    header = file_chunk.file_name + "\n"
+    max_tokens -= tokens.count_tokens(header)
+    code_chunks = sorted(
+        (
+            (code_chunk, selection_marker)
+            for selection_marker, code_chunks in file_chunk.code_chunks.items()
+            for code_chunk in code_chunks
+        ),
+        key=lambda item: item[0].start_line,
+    )
+    code_chunk_tokens = tokens.count_tokens_batch(
+        code_chunk.diff for code_chunk, _ in code_chunks
+    )
+
+    windows = []
+    window = []
+    window_tokens = 0
+    window_selection_marker = None
+    for (code_chunk, selection_marker), chunk_tokens in zip(
+        code_chunks, code_chunk_tokens
+    ):
+        if window and (
+            window_tokens + chunk_tokens > max_tokens
+            or (
+                selection_marker != window_selection_marker
+                and window_tokens > max_tokens / 2
+            )
+        ):
+            windows.append(header + "".join(window))
+            window = []
+            window_tokens = 0
+
+        if chunk_tokens > max_tokens:
+            windows.extend(
+                header + part for part in _split_code_chunk(code_chunk, max_tokens)
+            )
+            continue
+
+        window.append(code_chunk.diff)
+        window_tokens += chunk_tokens
+        window_selection_marker = selection_marker
+
+    if window:
+        windows.append(header + "".join(window))
+    return windows
+
+
+# Split the diff of a hunk by lines and repeat the hunk header in each part
+def _split_code_chunk(code_chunk, max_tokens) -> List[str]:
+    hunk_header, *lines = code_chunk.diff.splitlines(keepends=True)
+    max_tokens -= tokens.count_tokens(hunk_header)
+    parts = []
+    part = []
+    part_tokens = 0
+    for line, line_tokens in zip(lines, tokens.count_tokens_batch(lines)):
+        if part and part_tokens + line_tokens > max_tokens:
+            parts.append(hunk_header + "".join(part))
+            part = []
+            part_tokens = 0
+        part.append(line)
+        part_tokens += line_tokens
+    if part:
+        parts.append(hunk_header + "".join(part))
+    return parts
+
+
+# Return the review of one file from the review result of a request.
+# The model might use the file path instead of the file name as key.
+def get_file_review(review_json, file_name):
+    file_review = {}
+    for key, review in review_json.items():
+        if get_file_name(key) == file_name and isinstance(review, dict):
+            file_review.update(review)
+    return file_review
+
+
+# Return the file name of a key of the review result
+def get_file_name(key):
+    return key.rsplit("/", 1)[-1]
+
+
+# Parse streamed content in the worker thread
+# and queue the parsed events for the main thread
+def _get_stream_event_producer(stream_events):
+    parser = formatter.ReviewStreamParser()
+
+    def on_content(content):
+        for event in parser.feed(content):
+            stream_events.put(event)
+
+    return on_content
+
+
+# Pass the queued stream events to on_stream_event until the review is done
+def _await_streamed_review(future, stream_events, on_stream_event, spinner_text):
+    spinner = utils.get_spinner(spinner_text)
+    spinner.start()
+    try:
+        while True:
+            try:
+                event = stream_events.get(timeout=0.05)
+            except queue.Empty:
+                # all events are queued before the request returns
+                if future.done() and stream_events.empty():
+                    break
+                continue
+            if spinner is not None:
+                spinner.stop()
+                spinner = None
+            on_stream_event(event)
+    finally:
+        if spinner is not None:
+            spinner.stop()
+    return future.result()
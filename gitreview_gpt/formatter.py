@@ -1,141 +1,183 @@
+import hashlib
 import re
 import textwrap
-import os
 import json
+import shutil
 import gitreview_gpt.utils as utils
-from typing import Tuple, Dict, List
+import gitreview_gpt.profiler as profiler
+from typing import Tuple, Dict, Iterable, Iterator, List
+
+HUNK_HEADER_PATTERN = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
 
 
 class CodeChunk:
-    def __init__(self, start_line, end_line, code):
+    def __init__(self, start_line, end_line, code, diff=None, fingerprint=None):
         self.start_line = start_line
         self.end_line = end_line
         self.code = code
+        # formatted diff of the code chunk with line numbers and +/- markers
+        self.diff = diff
+        # hash of the changed and context lines without line numbers,
+        # which stays the same if the hunk is moved in the file
+        self.fingerprint = fingerprint
 
 
 class FileChunk:
-    def __init__(self, file_name, file_path, code_chunks):
+    def __init__(self, file_name, file_path, code_chunks, diff=""):
         self.file_name = file_name
         self.file_path = file_path
+        # code chunks per selection marker
         self.code_chunks = code_chunks
+        # formatted diff of the file with line numbers
+        self.diff = diff
 
 
 # Format the git diff into a format that can be used by the GPT-3.5 API
 # Add line numbers to the diff
 # Split the diff into chunks per file
+@profiler.timed("format_git_diff")
 def format_git_diff(
     diff_text: str,
 ) -> Tuple[str, Dict[str, str], Dict[str, Dict[str, List[CodeChunk]]], Dict[str, str],]:
-    git_diff_formatted = ""
+    git_diff_formatted = []
     git_diff_file_chunks = {}
     git_diff_code_block_chunks = {}
     file_paths = {}
 
-    file_blacklist = utils.get_file_blacklist()
-    # Split git diff into chunks with separator +++ line inclusive,
-    # the line with the filename
-    parent_chunks = re.split(r"\n\+{3,}\s", diff_text, re.MULTILINE)
-    for j, file_chunk in enumerate(parent_chunks, -1):
-        # Skip first chunk (it's the head info)
-        if j == -1:
-            continue
-
-        # Remove git --diff section
-        file_chunk = re.sub(
-            r"(diff --git.*\n)(.*\n)", lambda match: match.group(1), file_chunk
-        )
-        file_chunk = re.sub(r"^diff --git.*\n", "", file_chunk, flags=re.MULTILINE)
-
-        # Split chunk into chunks with separator @@ -n,n +n,n @@ inclusive,
-        # the changes in the file
-        changes_per_file = re.split(r"(?=@@ -\d+,\d+ \+\d+,\d+ @@)", file_chunk)
-        file_name = ""
-        for i, code_change_chunk in enumerate(changes_per_file, 1):
-            # Skip first chunk (it's the file name)
-            if i == 1:
-                file_name = code_change_chunk.rstrip("\n").rsplit("/", 1)[-1]
-                # Skip unmerged added files
-                if file_name == "null":
-                    break
-                if file_name in file_blacklist:
-                    break
-                git_diff_formatted += code_change_chunk.rsplit("/", 1)[-1]
-                git_diff_file_chunks[file_name] = code_change_chunk.rsplit("/", 1)[-1]
-                git_diff_code_block_chunks[file_name] = {}
-                file_paths[file_name] = code_change_chunk[2:].rstrip("\n")
-                continue
-
-            # Extract the line numbers from the changes pattern
-            pattern = r"@@ -(\d+),(\d+) \+(\d+),(\d+) @@"
-            match = re.findall(pattern, code_change_chunk)
-            chunk_dividers = []
-            for m in match:
-                chunk_dividers.append(
-                    {
-                        "original_start_line": int(m[0]),
-                        "original_end_line": int(m[1]),
-                        "new_start_line": int(m[2]),
-                        "new_end_line": int(m[3]),
-                    }
-                )
-            line_counter = -1 + chunk_dividers[0]["new_start_line"]
-
-            chunk_formatted = ""
-            code_chunk_formatted = ""
-            optional_selection_marker = ""
-            for line in code_change_chunk.splitlines():
-                if line.startswith("@@ -"):
-                    git_diff_formatted += line + "\n"
-                    chunk_formatted += line + "\n"
-                    code_chunk_formatted += line + "\n"
-                    # Extract selection marker
-                    parts = line.split("def", 1)
-                    if len(parts) > 1:
-                        optional_selection_marker = parts[1].strip()
-                    else:
-                        optional_selection_marker = ""
-                    continue
-                if line.startswith("---"):
-                    continue
-                if line.startswith("-"):
-                    continue
-                else:
-                    line_counter += 1
-
-                new_line = str(line_counter) + " " + line + "\n"
-                git_diff_formatted += new_line
-                chunk_formatted += new_line
-
-                if line.startswith("+"):
-                    code_chunk_formatted += str(line_counter) + " " + line[1:] + "\n"
-                else:
-                    code_chunk_formatted += new_line
-
-            code_chunk = CodeChunk(
-                start_line=chunk_dividers[0]["new_start_line"],
-                end_line=chunk_dividers[0]["new_end_line"]
-                + chunk_dividers[0]["new_start_line"]
-                - 1,
-                code=code_chunk_formatted,
-            )
-            git_diff_file_chunks[file_name] += chunk_formatted
-            if optional_selection_marker not in git_diff_code_block_chunks[file_name]:
-                git_diff_code_block_chunks[file_name][optional_selection_marker] = [
-                    code_chunk
-                ]
-            else:
-                git_diff_code_block_chunks[file_name][optional_selection_marker].append(
-                    code_chunk
-                )
+    for file_chunk in parse_git_diff(iter_lines(diff_text)):
+        git_diff_formatted.append(file_chunk.diff)
+        git_diff_file_chunks[file_chunk.file_name] = file_chunk.diff
+        git_diff_code_block_chunks[file_chunk.file_name] = file_chunk.code_chunks
+        file_paths[file_chunk.file_name] = file_chunk.file_path
 
     return (
-        git_diff_formatted,
+        "".join(git_diff_formatted),
         git_diff_file_chunks,
         git_diff_code_block_chunks,
         file_paths,
     )
 
 
+# Yield the lines of a text without copying the whole text
+def iter_lines(text) -> Iterator[str]:
+    start = 0
+    length = len(text)
+    while start < length:
+        end = text.find("\n", start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+# Parse git diff output line by line in a single pass
+# and yield a FileChunk as soon as the diff of a file is complete.
+# Lines of the new file are prefixed with their line number,
+# removed lines are dropped.
+def parse_git_diff(lines: Iterable[str]) -> Iterator[FileChunk]:
+    file_blacklist = utils.get_file_blacklist()
+    file_chunk = None
+    file_diff = []
+    hunk = None
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+
+        if hunk is not None:
+            # a hunk ends after its line counts or at the next header
+            if not hunk.is_complete() and not line.startswith(("diff --git ", "@@ -")):
+                hunk.add_line(line)
+                continue
+            hunk.add_to(file_chunk)
+            hunk = None
+
+        if line.startswith("diff --git "):
+            if file_chunk is not None and file_chunk.code_chunks:
+                file_chunk.diff = "".join(file_diff)
+                yield file_chunk
+            file_chunk = None
+            file_diff = []
+        elif line.startswith("+++ "):
+            file_path = line[4:]
+            if file_path.startswith("b/"):
+                file_path = file_path[2:]
+            file_name = file_path.rsplit("/", 1)[-1]
+            # Skip deleted files
+            if file_path == "/dev/null" or file_name in file_blacklist:
+                file_chunk = None
+                continue
+            file_chunk = FileChunk(file_name, file_path, {})
+            file_diff = [file_name + "\n"]
+        elif line.startswith("@@ -") and file_chunk is not None:
+            match = HUNK_HEADER_PATTERN.match(line)
+            if match:
+                hunk = _Hunk(line, match, file_diff)
+
+    if hunk is not None:
+        hunk.add_to(file_chunk)
+    if file_chunk is not None and file_chunk.code_chunks:
+        file_chunk.diff = "".join(file_diff)
+        yield file_chunk
+
+
+# Builder for the formatted lines of one hunk of a file diff
+class _Hunk:
+    def __init__(self, header, match, file_diff):
+        self.file_diff = file_diff
+        self.diff_start = len(file_diff)
+        self.original_lines_left = int(match.group(2) or 1)
+        self.new_start_line = int(match.group(3))
+        self.new_line_count = int(match.group(4) or 1)
+        self.new_lines_left = self.new_line_count
+        self.line_counter = self.new_start_line - 1
+        self.code = [header + "\n"]
+        self.fingerprint = hashlib.blake2b(digest_size=16)
+        file_diff.append(header + "\n")
+
+        # Extract selection marker
+        parts = header.split("def", 1)
+        if len(parts) > 1:
+            self.selection_marker = parts[1].strip()
+        else:
+            self.selection_marker = ""
+
+    def is_complete(self):
+        return self.original_lines_left <= 0 and self.new_lines_left <= 0
+
+    def add_line(self, line):
+        self.fingerprint.update(line.encode() + b"\n")
+        if line.startswith("-"):
+            self.original_lines_left -= 1
+            return
+        # Skip "\ No newline at end of file"
+        if line.startswith("\\"):
+            return
+        if line.startswith("+"):
+            self.new_lines_left -= 1
+        else:
+            self.original_lines_left -= 1
+            self.new_lines_left -= 1
+
+        self.line_counter += 1
+        new_line = f"{self.line_counter} {line}\n"
+        self.file_diff.append(new_line)
+        if line.startswith("+"):
+            self.code.append(f"{self.line_counter} {line[1:]}\n")
+        else:
+            self.code.append(new_line)
+
+    def add_to(self, file_chunk):
+        code_chunk = CodeChunk(
+            start_line=self.new_start_line,
+            end_line=self.new_line_count + self.new_start_line - 1,
+            code="".join(self.code),
+            diff="".join(self.file_diff[self.diff_start :]),
+            fingerprint=self.fingerprint.hexdigest(),
+        )
+        file_chunk.code_chunks.setdefault(self.selection_marker, []).append(code_chunk)
+
+
 # Extract markdown code blocks from text
 def extract_content_from_markdown_code_block(markdown_code_block) -> str:
     pattern = r"```(?:[a-zA-Z0-9]+)?\n(.*?)```"
@@ -156,63 +198,160 @@ def extract_content_from_multiple_markdown_code_blocks(markdown_text) -> list:
     return extracted_content
 
 
-def parse_review_result(review_result):
-    return remove_unused_suggestions(json.loads(review_result))
+# Check if feedback contains "not used" or "unused" etc
+def is_unused_suggestion(feedback):
+    feedback = feedback.lower()
+    return (
+        "not used" in feedback
+        or "unused" in feedback
+        or "not being used" in feedback
+        or "variable name" in feedback
+        or "more descriptive" in feedback
+        or "more specific" in feedback
+        or "never used" in feedback
+        or "into smaller functions" in feedback
+        or "to a separate function" in feedback
+        or "extracting the logic" in feedback
+        or "extract the logic" in feedback
+    )
 
 
 def remove_unused_suggestions(review_result):
-    # Function to check if feedback contains "not used" or "unused" etc
-    def has_not_used_or_unused(feedback):
-        return (
-            "not used" in feedback.lower()
-            or "unused" in feedback.lower()
-            or "not being used" in feedback.lower()
-            or "variable name" in feedback.lower()
-            or "more descriptive" in feedback.lower()
-            or "more specific" in feedback.lower()
-            or "never used" in feedback.lower()
-            or "into smaller functions" in feedback.lower()
-            or "to a separate function" in feedback.lower()
-            or "extracting the logic" in feedback.lower()
-            or "extract the logic" in feedback.lower()
-        )
-
     # Filter out the entries based on the condition
     return {
         file: {
             line: value
             for line, value in file_data.items()
-            if not has_not_used_or_unused(value["feedback"])
+            if not is_unused_suggestion(value["feedback"])
         }
         for file, file_data in review_result.items()
     }
 
 
+# Incremental parser for streamed review results
+# of the format {"filename":{"line_number":{"feedback": "..."}}}.
+# Emits a ("file", filename) event when the review of a file starts,
+# a ("finding", filename, line_number, finding) event as soon as
+# the object of a finding is closed and a ("file_end", filename) event
+# when the review of a file is complete.
+# Text around the json object, e.g. markdown code fences, is ignored.
+class ReviewStreamParser:
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.keys = {}
+        self.key = None
+        self.finding = None
+
+    def feed(self, text) -> List[tuple]:
+        events = []
+        for char in text:
+            if self.finding is not None:
+                self.finding.append(char)
+
+            if self.in_string:
+                if self.key is not None:
+                    self.key.append(char)
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.key is not None:
+                        self.keys[self.depth] = json.loads("".join(self.key))
+                        self.key = None
+                continue
+
+            if char == '"':
+                self.in_string = True
+                if self.expect_key and self.depth in (1, 2):
+                    self.key = [char]
+            elif char == "{":
+                self.depth += 1
+                self.expect_key = True
+                if self.depth == 2 and 1 in self.keys:
+                    events.append(("file", self.keys[1]))
+                elif self.depth == 3:
+                    self.finding = [char]
+            elif char == "}":
+                if self.depth == 3 and self.finding is not None:
+                    event = self._get_finding_event()
+                    if event:
+                        events.append(event)
+                    self.finding = None
+                elif self.depth == 2 and 1 in self.keys:
+                    events.append(("file_end", self.keys[1]))
+                self.depth = max(self.depth - 1, 0)
+                self.expect_key = False
+            elif char == "[":
+                self.depth += 1
+                self.expect_key = False
+            elif char == "]":
+                self.depth = max(self.depth - 1, 0)
+            elif char == ",":
+                self.expect_key = True
+            elif char == ":":
+                self.expect_key = False
+        return events
+
+    def _get_finding_event(self):
+        if 1 not in self.keys or 2 not in self.keys:
+            return None
+        try:
+            finding = json.loads("".join(self.finding))
+        except ValueError:
+            return None
+        if not isinstance(finding, dict) or "feedback" not in finding:
+            return None
+        return ("finding", self.keys[1], self.keys[2], finding)
+
+
+# Return the width of the terminal,
+# or a default width if the output is not a terminal, e.g. in CI
+def get_terminal_width():
+    return shutil.get_terminal_size().columns
+
+
 # Draw review output box
 def draw_box(filename, feedback_lines):
-    max_length = os.get_terminal_size()[0] - 2
+    max_length = get_terminal_width() - 2
+    result = draw_box_header(filename, max_length)
+
+    for entry in feedback_lines:
+        result.extend(draw_box_entry(entry, feedback_lines[entry], max_length))
+
+    result.append(draw_box_footer(max_length))
+    return "\n".join(result)
+
+
+def draw_box_header(filename, max_length) -> List[str]:
     border = "╭" + "─" * (max_length) + "╮"
     bottom_border = "│" + "─" * (max_length) + "│"
     filename_line = "│ " + filename.ljust(max_length - 1) + "│"
-    result = [border, filename_line, bottom_border]
+    return [border, filename_line, bottom_border]
+
+
+def draw_box_entry(line, feedback, max_length) -> List[str]:
+    result = []
+    line_string = f"◇ \033[01mLine {line}\033[0m: {feedback['feedback']}"
+    if "suggestion" in feedback:
+        if feedback["suggestion"] is not None:
+            line_string += f" {feedback['suggestion']}"
+    if len(line_string) > max_length - 2:
+        wrapped_lines = textwrap.wrap(line_string, width=max_length - 4)
+        result.append("│ " + wrapped_lines[0].ljust(max_length + 7) + " │")
+        for wrapped_line in wrapped_lines[1:]:
+            result.append("│   " + wrapped_line.ljust(max_length - 4) + " │")
+    else:
+        result.append("│ " + line_string.ljust(max_length + 7) + " │")
+    return result
 
-    for entry in feedback_lines:
-        line_string = (
-            f"◇ \033[01mLine {entry}\033[0m: {feedback_lines[entry]['feedback']}"
-        )
-        if "suggestion" in feedback_lines[entry]:
-            if feedback_lines[entry]["suggestion"] is not None:
-                line_string += f" {feedback_lines[entry]['suggestion']}"
-        if len(line_string) > max_length - 2:
-            wrapped_lines = textwrap.wrap(line_string, width=max_length - 4)
-            result.append("│ " + wrapped_lines[0].ljust(max_length + 7) + " │")
-            for wrapped_line in wrapped_lines[1:]:
-                result.append("│   " + wrapped_line.ljust(max_length - 4) + " │")
-        else:
-            result.append("│ " + line_string.ljust(max_length + 7) + " │")
 
-    result.append("╰" + "─" * (max_length) + "╯")
-    return "\n".join(result)
+def draw_box_footer(max_length) -> str:
+    return "╰" + "─" * (max_length) + "╯"
 
 
 def get_review_suggestions_per_file_payload_from_json(review_json):
@@ -235,7 +374,9 @@ def parse_apply_review_per_code_hunk(code_changes, review_json, line_number_stac
             <= line_number
             < code_change_hunk.start_line + code_change_hunk.end_line
         ):
-            review_per_chunk[line_number] = review_json[str(line_number)]
+            review_per_chunk[line_number] = review_json[
+                get_review_line_key(review_json, line_number)
+            ]
 
             if not line_number_stack:
                 break
@@ -254,6 +395,14 @@ def parse_apply_review_per_code_hunk(code_changes, review_json, line_number_stac
     return hunk_review_payload
 
 
+# Return the key of a line number in a review, which might be a line range
+def get_review_line_key(review_json, line_number):
+    key = str(line_number)
+    if key not in review_json:
+        key = next((k for k in review_json if k.startswith(key + "-")), key)
+    return key
+
+
 def code_block_to_dict(code_block) -> Dict[int, str]:
     lines = code_block.strip().splitlines()
     parsed_code_block = {}
@@ -0,0 +1,110 @@
+import os
+from typing import Any, Dict, List, Tuple
+import gitreview_gpt.cache as cache
+import gitreview_gpt.formatter as formatter
+
+
+def get_default_index_dir():
+    return os.path.join(os.path.dirname(cache.get_default_cache_dir()), "hunks")
+
+
+# Persistent index of the findings of reviewed hunks, keyed by the path of
+# the file in the repository and the fingerprint of the hunk,
+# which doesn't depend on its line numbers.
+# The lines of the findings are stored relative to the first line of the hunk,
+# so that they can be moved to the current lines of a hunk,
+# e.g. after a rebase or if lines have been added above the hunk.
+class HunkIndex(cache.ReviewCache):
+    profile_name = "hunk_index"
+
+    def __init__(self, index_dir=None, **kwargs):
+        super().__init__(index_dir or get_default_index_dir(), **kwargs)
+
+    def get_hunk_key(self, file_path, code_chunk):
+        return f"{file_path}\0{code_chunk.fingerprint}"
+
+    # Return the findings of the indexed hunks of a file
+    # at the current lines and the hunks which haven't been reviewed yet
+    def lookup(
+        self, file_chunk, gpt_model
+    ) -> Tuple[Dict[str, Any], List[formatter.CodeChunk]]:
+        findings = {}
+        new_code_chunks = []
+        for code_chunk in get_code_chunks(file_chunk):
+            hunk_findings = None
+            if code_chunk.fingerprint is not None:
+                hunk_findings = self.get(
+                    self.get_hunk_key(file_chunk.file_path, code_chunk), gpt_model
+                )
+            if hunk_findings is None:
+                new_code_chunks.append(code_chunk)
+                continue
+            for line_key, finding in hunk_findings.items():
+                line_key = shift_line_key(line_key, code_chunk.start_line)
+                if line_key is not None:
+                    findings[line_key] = finding
+        return findings, new_code_chunks
+
+    # Index the findings of a file review per hunk,
+    # hunks without findings are indexed as reviewed without issues
+    def add(self, file_path, code_chunks, gpt_model, findings):
+        for code_chunk in code_chunks:
+            if code_chunk.fingerprint is None:
+                continue
+            hunk_findings = {}
+            for line_key, finding in findings.items():
+                line = get_first_line(line_key)
+                if line is not None and (
+                    code_chunk.start_line <= line <= code_chunk.end_line
+                ):
+                    hunk_findings[shift_line_key(line_key, -code_chunk.start_line)] = (
+                        finding
+                    )
+            self.put(self.get_hunk_key(file_path, code_chunk), gpt_model, hunk_findings)
+
+
+# Return the code chunks of a file in the order of their lines
+def get_code_chunks(file_chunk) -> List[formatter.CodeChunk]:
+    return sorted(
+        (
+            code_chunk
+            for code_chunks in file_chunk.code_chunks.values()
+            for code_chunk in code_chunks
+        ),
+        key=lambda code_chunk: code_chunk.start_line,
+    )
+
+
+# Return a file chunk with only the given code chunks of a file,
+# e.g. to review only the hunks which are not indexed
+def get_partial_file_chunk(file_chunk, code_chunks) -> formatter.FileChunk:
+    code_chunk_ids = {id(code_chunk) for code_chunk in code_chunks}
+    partial_code_chunks = {}
+    for selection_marker, marker_code_chunks in file_chunk.code_chunks.items():
+        for code_chunk in marker_code_chunks:
+            if id(code_chunk) in code_chunk_ids:
+                partial_code_chunks.setdefault(selection_marker, []).append(code_chunk)
+    return formatter.FileChunk(
+        file_chunk.file_name,
+        file_chunk.file_path,
+        partial_code_chunks,
+        file_chunk.file_name
+        + "\n"
+        + "".join(code_chunk.diff or "" for code_chunk in code_chunks),
+    )
+
+
+def get_first_line(line_key):
+    try:
+        return int(str(line_key).split("-", 1)[0])
+    except ValueError:
+        return None
+
+
+# Shift a line key like "12" or "12-15" by an offset
+def shift_line_key(line_key, offset):
+    try:
+        lines = [int(line) + offset for line in str(line_key).split("-")]
+    except ValueError:
+        return None
+    return "-".join(str(line) for line in lines)
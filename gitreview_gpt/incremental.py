@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+from typing import Any, Dict, List, Tuple
+import gitreview_gpt.cache as cache
+import gitreview_gpt.formatter as formatter
+
+STATE_VERSION = 1
+
+
+def get_default_state_dir():
+    return os.path.join(os.path.dirname(cache.get_default_cache_dir()), "incremental")
+
+
+# Last reviewed commit of a branch and the findings of all reviews up to it,
+# keyed by the path of the file and the line in the reviewed state of the file.
+# The state is stored per repository, current branch and target branch.
+class ReviewState:
+    def __init__(self, repo_root, target_branch, state_dir=None):
+        self.state_dir = state_dir or get_default_state_dir()
+        self.repo_root = repo_root
+        self.target_branch = target_branch
+        self.commit = None
+        self.findings: Dict[str, Dict[str, Any]] = {}
+
+    def get_path(self):
+        key = f"{self.repo_root}\0{get_current_branch()}\0{self.target_branch}"
+        return os.path.join(
+            self.state_dir, hashlib.sha256(key.encode()).hexdigest() + ".json"
+        )
+
+    def load(self):
+        try:
+            with open(self.get_path(), "r") as file:
+                state = json.load(file)
+            if state.get("version") == STATE_VERSION:
+                self.commit = state["commit"]
+                self.findings = state["findings"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return self
+
+    def save(self, commit, findings):
+        self.commit = commit
+        self.findings = findings
+        path = self.get_path()
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            # write to temporary file first, so that concurrent runs
+            # never read a partially written state
+            fd, tmp_path = tempfile.mkstemp(dir=self.state_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as file:
+                json.dump(
+                    {"version": STATE_VERSION, "commit": commit, "findings": findings},
+                    file,
+                )
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+
+def get_current_branch():
+    return subprocess.check_output(
+        ["git", "rev-parse", "--abbrev-ref", "HEAD"], universal_newlines=True
+    ).strip()
+
+
+def get_head_commit():
+    return subprocess.check_output(
+        ["git", "rev-parse", "HEAD"], universal_newlines=True
+    ).strip()
+
+
+# Return if the index differs from HEAD. The review diffs the index,
+# so its findings only match the lines of HEAD without staged changes.
+def has_staged_changes():
+    return (
+        subprocess.run(
+            ["git", "diff", "--cached", "--quiet", "HEAD"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        != 0
+    )
+
+
+# Return if the commit is part of the history of the current branch,
+# which is not the case after a rebase or a force push
+def is_ancestor(commit):
+    return (
+        subprocess.run(
+            ["git", "merge-base", "--is-ancestor", commit, "HEAD"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        == 0
+    )
+
+
+# Return the changed line ranges of every file since a commit
+# as {old_path: (new_path, [(old_start, old_count, new_start, new_count)])},
+# new_path is None if the file has been deleted
+def get_changed_lines(commit) -> Dict[str, Tuple[str, List[Tuple[int, ...]]]]:
+    output = subprocess.check_output(
+        ["git", "diff", "-U0", "--no-color", "--no-renames", commit, "--cached"],
+        universal_newlines=True,
+    )
+    return parse_changed_lines(output)
+
+
+def parse_changed_lines(diff_text) -> Dict[str, Tuple[str, List[Tuple[int, ...]]]]:
+    changed_lines = {}
+    old_path = None
+    hunks = None
+    for line in diff_text.splitlines():
+        if line.startswith("--- "):
+            old_path = line[4:]
+            old_path = old_path[2:] if old_path.startswith("a/") else old_path
+        elif line.startswith("+++ ") and old_path is not None:
+            new_path = line[4:]
+            new_path = new_path[2:] if new_path.startswith("b/") else new_path
+            hunks = []
+            changed_lines[old_path] = (
+                None if new_path == "/dev/null" else new_path,
+                hunks,
+            )
+        elif line.startswith("@@ -") and hunks is not None:
+            match = formatter.HUNK_HEADER_PATTERN.match(line)
+            if match:
+                old_start, old_count, new_start, new_count = match.groups()
+                hunks.append(
+                    (
+                        int(old_start),
+                        int(1 if old_count is None else old_count),
+                        int(new_start),
+                        int(1 if new_count is None else new_count),
+                    )
+                )
+    return changed_lines
+
+
+# Map a line of the old state of a file to the new state,
+# None if the line has been changed or removed
+def remap_line(line, hunks):
+    offset = 0
+    for old_start, old_count, new_start, new_count in hunks:
+        if old_count == 0:
+            # lines are inserted after old_start
+            if line > old_start:
+                offset += new_count
+        elif line >= old_start + old_count:
+            offset += new_count - old_count
+        elif line >= old_start:
+            return None
+    return line + offset
+
+
+# Map a line key like "12" or "12-15" to the new state of a file
+def remap_line_key(line_key, hunks):
+    try:
+        lines = [int(line) for line in str(line_key).split("-")]
+    except ValueError:
+        return None
+    lines = [remap_line(line, hunks) for line in lines]
+    if None in lines:
+        return None
+    return "-".join(str(line) for line in lines)
+
+
+# Map findings of the previous review to the current state of the files.
+# Findings of changed lines are dropped, since these lines are reviewed again.
+def remap_findings(findings, changed_lines) -> Dict[str, Dict[str, Any]]:
+    remapped = {}
+    for file_path, file_findings in findings.items():
+        new_path, hunks = changed_lines.get(file_path, (file_path, []))
+        if new_path is None:
+            continue
+        for line_key, finding in file_findings.items():
+            new_line_key = remap_line_key(line_key, hunks)
+            if new_line_key is not None:
+                remapped.setdefault(new_path, {})[new_line_key] = finding
+    return remapped
@@ -0,0 +1,179 @@
+import json
+import time
+from typing import Any, Dict, List, Optional
+import gitreview_gpt.prompt as prompt
+
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+FORMAT_JSONL = "jsonl"
+FORMAT_SARIF = "sarif"
+FORMATS = [FORMAT_TEXT, FORMAT_JSON, FORMAT_JSONL, FORMAT_SARIF]
+
+SARIF_SCHEMA = "https://json.schemastore.org/sarif-2.1.0.json"
+SARIF_RULE_ID = "code-review"
+REVIEW_FAILED_ERROR = "Review request failed"
+
+
+# Write the reviews of files as soon as they are done,
+# so that the output can be consumed while the next files are reviewed.
+# json is written as one document whose array of files grows with every file
+# and which is complete after close, jsonl is written as one json object
+# per file and line. sarif is written as a whole on close.
+# Files whose review failed are written with their error, so that they
+# can be told apart from files without findings.
+class ReviewWriter:
+    def __init__(self, file, output_format, gpt_model):
+        self.file = file
+        self.output_format = output_format
+        self.model = prompt.get_model_name(gpt_model)
+        self.start_time = time.perf_counter()
+        self.items = 0
+        self.sarif_results: List[Dict[str, Any]] = []
+        self.sarif_notifications: List[Dict[str, Any]] = []
+        if output_format == FORMAT_JSON:
+            self.file.write(f'{{"model": {json.dumps(self.model)}, "files": [')
+        self.file.flush()
+
+    # Write the findings of a file, review_seconds is None
+    # for findings which haven't been requested, e.g. of previous reviews,
+    # and findings is None
+    # if the review of the file failed
+    def write_file(self, file_path, findings, review_seconds=None):
+        record = get_file_record(file_path, findings, self.model, review_seconds)
+        if self.output_format == FORMAT_JSONL:
+            self.file.write(json.dumps(record) + "\n")
+        elif self.output_format == FORMAT_JSON:
+            self._write_item(record)
+        elif self.output_format == FORMAT_SARIF:
+            if not record["reviewed"]:
+                self.sarif_notifications.append(get_sarif_notification(record))
+            for finding in record["findings"]:
+                self.sarif_results.append(get_sarif_result(record, finding))
+        self.file.flush()
+
+    def close(self):
+        timings = {"total_seconds": round(time.perf_counter() - self.start_time, 3)}
+        if self.output_format == FORMAT_JSON:
+            self.file.write(f'], "timings": {json.dumps(timings)}}}\n')
+        elif self.output_format == FORMAT_SARIF:
+            json.dump(self.get_sarif_document(), self.file)
+            self.file.write("\n")
+        self.file.flush()
+
+    def get_sarif_document(self) -> Dict[str, Any]:
+        return {
+            "$schema": SARIF_SCHEMA,
+            "version": "2.1.0",
+            "runs": [
+                {
+                    "tool": {
+                        "driver": {
+                            "name": "gitreview-gpt",
+                            "rules": [
+                                {
+                                    "id": SARIF_RULE_ID,
+                                    "shortDescription": {"text": "Code review finding"},
+                                }
+                            ],
+                        }
+                    },
+                    "invocations": [
+                        {
+                            "executionSuccessful": not self.sarif_notifications,
+                            "toolExecutionNotifications": self.sarif_notifications,
+                        }
+                    ],
+                    "properties": {"model": self.model},
+                    "results": self.sarif_results,
+                }
+            ],
+        }
+
+    def _write_item(self, item):
+        if self.items:
+            self.file.write(", ")
+        self.file.write(json.dumps(item))
+        self.items += 1
+
+
+# Review time of files, which is the time of their review request
+# from its submission until it is done. Files which are reviewed
+# in one request share its time, files without request have no time.
+class ReviewTimer:
+    def __init__(self):
+        self.review_seconds = {}
+
+    def record(self, file_chunk, review_seconds):
+        self.review_seconds[id(file_chunk)] = review_seconds
+
+    def stop(self, file_chunk):
+        return self.review_seconds.pop(id(file_chunk), None)
+
+
+def get_file_record(file_path, findings, model, review_seconds) -> Dict[str, Any]:
+    return {
+        "file_path": file_path,
+        "model": model,
+        "reviewed": findings is not None,
+        "error": None if findings is not None else REVIEW_FAILED_ERROR,
+        "findings": [
+            get_finding_record(line_key, finding)
+            for line_key, finding in (findings or {}).items()
+        ],
+        "timings": {
+            "review_seconds": (
+                None if review_seconds is None else round(review_seconds, 3)
+            )
+        },
+    }
+
+
+def get_finding_record(line_key, finding) -> Dict[str, Any]:
+    start_line, end_line = parse_line_range(line_key)
+    return {
+        "line": start_line,
+        "end_line": end_line,
+        "feedback": finding.get("feedback", ""),
+        "suggestion": finding.get("suggestion"),
+    }
+
+
+def get_sarif_result(record, finding) -> Dict[str, Any]:
+    message = finding["feedback"]
+    if finding["suggestion"]:
+        message += "\n" + finding["suggestion"]
+    location: Dict[str, Any] = {"artifactLocation": {"uri": record["file_path"]}}
+    if finding["line"] is not None:
+        location["region"] = {
+            "startLine": finding["line"],
+            "endLine": finding["end_line"],
+        }
+    return {
+        "ruleId": SARIF_RULE_ID,
+        "level": "note",
+        "message": {"text": message},
+        "locations": [{"physicalLocation": location}],
+        "properties": {
+            "model": record["model"],
+            "reviewSeconds": record["timings"]["review_seconds"],
+        },
+    }
+
+
+def get_sarif_notification(record) -> Dict[str, Any]:
+    return {
+        "level": "error",
+        "message": {"text": record["error"]},
+        "locations": [
+            {"physicalLocation": {"artifactLocation": {"uri": record["file_path"]}}}
+        ],
+    }
+
+
+# Return the first and last line of a line key like "12" or "12-15"
+def parse_line_range(line_key) -> List[Optional[int]]:
+    try:
+        lines = [int(line) for line in str(line_key).split("-")]
+    except ValueError:
+        return [None, None]
+    return [lines[0], lines[-1]]
@@ -0,0 +1,59 @@
+import re
+from typing import List, Tuple
+
+EDIT_BLOCK_PATTERN = re.compile(
+    r"^<{5,} ?SEARCH[ \t]*\n(.*?)^={5,}[ \t]*\n(.*?)^>{5,} ?REPLACE[ \t]*$",
+    re.DOTALL | re.MULTILINE,
+)
+
+
+# Parse the search and replace blocks of a response
+# <<<<<<< SEARCH
+# lines to be replaced
+# =======
+# lines which replace them
+# >>>>>>> REPLACE
+def parse_edits(text) -> List[Tuple[str, str]]:
+    edits = EDIT_BLOCK_PATTERN.findall(text or "")
+    if not edits:
+        raise ValueError("No search and replace blocks found")
+    return edits
+
+
+# Apply the edits to the content of a file one after another.
+# Raises a ValueError if an edit doesn't match the content exactly once,
+# the edits are only applied as a whole.
+def apply_edits(content, edits: List[Tuple[str, str]]) -> str:
+    for search, replace in edits:
+        content = apply_edit(content, search, replace)
+    return content
+
+
+def apply_edit(content, search, replace) -> str:
+    if not search.strip():
+        raise ValueError("Search block is empty")
+
+    count = content.count(search)
+    if count == 1:
+        return content.replace(search, replace, 1)
+    if count > 1:
+        raise ValueError(f"Search block matches {count} times:\n{search}")
+
+    # tolerate differences in trailing whitespace,
+    # e.g. a missing newline at the end of the file
+    lines = content.splitlines(keepends=True)
+    search_lines = [line.rstrip() for line in search.splitlines()]
+    stripped_lines = [line.rstrip() for line in lines]
+    matches = [
+        index
+        for index in range(len(lines) - len(search_lines) + 1)
+        if stripped_lines[index : index + len(search_lines)] == search_lines
+    ]
+    if len(matches) != 1:
+        raise ValueError(f"Search block matches {len(matches)} times:\n{search}")
+
+    start = matches[0]
+    end = start + len(search_lines)
+    if replace and not replace.endswith("\n") and lines[end - 1].endswith("\n"):
+        replace += "\n"
+    return "".join(lines[:start]) + replace + "".join(lines[end:])
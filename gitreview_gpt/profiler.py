@@ -0,0 +1,147 @@
+import contextlib
+import functools
+import json
+import threading
+import time
+from typing import Any, Dict
+
+# Timers and counters of a run, only recorded if profiling is enabled.
+# Timers of concurrent requests add up, so the total of a timer
+# can exceed the wall time of the run.
+_enabled = False
+_lock = threading.Lock()
+_start_time = None
+_timers = {}
+_counters = {}
+
+
+def enable():
+    global _enabled, _start_time
+    _enabled = True
+    _start_time = time.perf_counter()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    global _enabled, _start_time
+    with _lock:
+        _enabled = False
+        _start_time = None
+        _timers.clear()
+        _counters.clear()
+
+
+def add_time(name, seconds):
+    with _lock:
+        timer = _timers.setdefault(name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+# Measure the time of a block of code
+@contextlib.contextmanager
+def timer(name):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+# Measure the time of every call of a function
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+# Measure the time of producing the items of an iterator,
+# without the time the consumer spends between the items
+def timed_iter(name, iterable):
+    if not _enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    total = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                total += time.perf_counter() - start
+                break
+            total += time.perf_counter() - start
+            yield item
+    finally:
+        add_time(name, total)
+
+
+def get_report() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "wall_time": (
+                time.perf_counter() - _start_time if _start_time is not None else 0.0
+            ),
+            "timers": {
+                name: {
+                    "calls": calls,
+                    "total": total,
+                    "mean": total / calls if calls else 0.0,
+                }
+                for name, (calls, total) in _timers.items()
+            },
+            "counters": dict(_counters),
+        }
+
+
+def print_report(file=None):
+    report = get_report()
+    name_width = max(
+        len("Total"), *(len(name) for name in [*report["timers"], *report["counters"]])
+    )
+    print("⏱️  Profile", file=file)
+    print(
+        f"{'':{name_width}}  {'Calls':>7}  {'Total [s]':>10}  {'Mean [ms]':>10}",
+        file=file,
+    )
+    for name, timer in sorted(
+        report["timers"].items(), key=lambda item: item[1]["total"], reverse=True
+    ):
+        print(
+            f"{name:{name_width}}  {timer['calls']:>7}  {timer['total']:>10.3f}  "
+            + f"{timer['mean'] * 1000:>10.1f}",
+            file=file,
+        )
+    print(f"{'Total':{name_width}}  {'':>7}  {report['wall_time']:>10.3f}", file=file)
+    for name, value in sorted(report["counters"].items()):
+        print(f"{name:{name_width}}  {value:>7}", file=file)
+
+
+def dump_report(path):
+    with open(path, "w") as file:
+        json.dump(get_report(), file, indent=2)
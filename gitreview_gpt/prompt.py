@@ -1,11 +1,18 @@
 from enum import Enum
 
+# Increase when the review prompt changes to invalidate cached reviews
+PROMPT_VERSION = 1
+
 
 class GptModel(Enum):
     GPT_35 = 4096
     GPT_4 = 8192
 
 
+def get_model_name(gpt_model: GptModel):
+    return gpt_model == GptModel.GPT_35 and "gpt-3.5-turbo" or "gpt-4"
+
+
 def get_commit_message_prompt(git_diff_text):
     return {
         "model": "gpt-3.5-turbo",
@@ -31,9 +38,45 @@ def get_commit_message_prompt(git_diff_text):
     }
 
 
-def get_review_prompt(git_diff_text, max_tokens, gpt_model: GptModel):
-    return {
-        "model": gpt_model == GptModel.GPT_35 and "gpt-3.5-turbo" or "gpt-4",
+# Function the model is asked to call with the review,
+# the arguments are the review in the same format as the json requested in text
+REVIEW_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "submit_review",
+        "description": "Submit the feedback on the code changes.",
+        "parameters": {
+            "type": "object",
+            "description": "Feedback per file name",
+            "additionalProperties": {
+                "type": "object",
+                "description": "Feedback per line number of the file",
+                "additionalProperties": {
+                    "type": "object",
+                    "properties": {
+                        "feedback": {"type": "string"},
+                        "suggestion": {"type": "string"},
+                    },
+                    "required": ["feedback"],
+                },
+            },
+        },
+    },
+}
+
+
+def get_review_prompt(
+    git_diff_text, max_tokens, gpt_model: GptModel, structured_output=False
+):
+    instructions = (
+        "You are a code reviewer. "
+        "You should review my code changes and provide feedback. "
+        "Provide feedback on how to improve the code. "
+        "Don't provide feedback on code style. "
+        "You will get my changes with line numbers at the start of each line. "
+    )
+    payload = {
+        "model": get_model_name(gpt_model),
         "max_tokens": max_tokens,
         "temperature": 0.4,
         "n": 1,
@@ -41,12 +84,8 @@ def get_review_prompt(git_diff_text, max_tokens, gpt_model: GptModel):
         "messages": [
             {
                 "role": "user",
-                "content": "You are a code reviewer. "
-                "You should review my code changes and provide feedback. "
-                "Provide feedback on how to improve the code. "
-                "Don't provide feedback on code style. "
-                "You will get my changes with line numbers at the start of each line. "
-                "Provide feedback as a JSON object with the following format: "
+                "content": instructions
+                + "Provide feedback as a JSON object with the following format: "
                 '{"filename":{"line_number":{"feedback": "your feedback."}}}',
             },
             {
@@ -59,11 +98,20 @@ def get_review_prompt(git_diff_text, max_tokens, gpt_model: GptModel):
             },
         ],
     }
+    if structured_output:
+        # the format of the review is described by the tool
+        payload["messages"][0]["content"] = instructions + "Submit your feedback."
+        payload["tools"] = [REVIEW_TOOL]
+        payload["tool_choice"] = {
+            "type": "function",
+            "function": {"name": REVIEW_TOOL["function"]["name"]},
+        }
+    return payload
 
 
 def get_review_repair_prompt(invalid_json, error, max_tokens, gpt_model: GptModel):
     return {
-        "model": gpt_model == GptModel.GPT_35 and "gpt-3.5-turbo" or "gpt-4",
+        "model": get_model_name(gpt_model),
         "max_tokens": max_tokens,
         "temperature": 0.5,
         "n": 1,
@@ -92,7 +140,7 @@ def get_apply_review_for_file_prompt(
     code, review_comments, max_tokens, programming_language, gpt_model: GptModel
 ):
     return {
-        "model": gpt_model == GptModel.GPT_35 and "gpt-3.5-turbo" or "gpt-4",
+        "model": get_model_name(gpt_model),
         "max_tokens": max_tokens,
         "temperature": 0.4,
         "n": 1,
@@ -119,7 +167,7 @@ def get_apply_review_for_git_diff_chunk_promp(
     code_chunk, review_comments, max_tokens, programming_language, gpt_model: GptModel
 ):
     return {
-        "model": gpt_model == GptModel.GPT_35 and "gpt-3.5-turbo" or "gpt-4",
+        "model": get_model_name(gpt_model),
         "max_tokens": max_tokens,
         "temperature": 0.4,
         "n": 1,
@@ -142,3 +190,38 @@ def get_apply_review_for_git_diff_chunk_promp(
             },
         ],
     }
+
+
+def get_apply_review_edits_for_file_prompt(
+    code, review_comments, max_tokens, programming_language, gpt_model: GptModel
+):
+    return {
+        "model": get_model_name(gpt_model),
+        "max_tokens": max_tokens,
+        "temperature": 0.4,
+        "n": 1,
+        "stop": None,
+        "messages": [
+            {
+                "role": "user",
+                "content": f"Review the following {programming_language} code and address the review comments below:\n"
+                f"{programming_language} code:\n"
+                "```\n"
+                f"{code}"
+                "```\n"
+                "Review comments:\n"
+                f"{review_comments}"
+                "\n"
+                f"Apply the necessary changes to the {programming_language} code based on the review comments. "
+                "Provide only the changed parts of the code as search and replace blocks in the following format:\n"
+                "<<<<<<< SEARCH\n"
+                "the exact lines of the code to be replaced\n"
+                "=======\n"
+                "the lines which replace them\n"
+                ">>>>>>> REPLACE\n"
+                "Each search block must match the code exactly once, including the indentation. "
+                "Keep the search blocks as short as possible. "
+                "Don't include any explanations in your response.",
+            },
+        ],
+    }
@@ -1,30 +1,351 @@
-import requests
-from yaspin import yaspin
+import json
+import os
+import random
+import re
+import threading
+import time
+import gitreview_gpt.profiler as profiler
+import gitreview_gpt.utils as utils
 
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1
+MAX_BACKOFF = 60
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
 
-def send_request(api_key, payload, spinner_text):
-    spinner = yaspin(text=spinner_text)
-    spinner.start()
+_client_config = {
+    "base_url": os.environ.get("OPENAI_BASE_URL") or DEFAULT_BASE_URL,
+    "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+    "read_timeout": DEFAULT_READ_TIMEOUT,
+    "pool_size": DEFAULT_POOL_SIZE,
+    "max_retries": DEFAULT_MAX_RETRIES,
+}
+_session = None
+_session_lock = threading.Lock()
+
+
+# Configure the shared http client
+# The base url can point to any OpenAI compatible api, e.g. a proxy
+def configure(
+    base_url=None,
+    connect_timeout=None,
+    read_timeout=None,
+    pool_size=None,
+    max_retries=None,
+    requests_per_minute=None,
+    tokens_per_minute=None,
+):
+    global _session
+    with _session_lock:
+        if max_retries is not None:
+            _client_config["max_retries"] = max_retries
+        if requests_per_minute is not None or tokens_per_minute is not None:
+            rate_limiter.configure(requests_per_minute, tokens_per_minute)
+        if base_url:
+            _client_config["base_url"] = base_url
+        if connect_timeout is not None:
+            _client_config["connect_timeout"] = connect_timeout
+        if read_timeout is not None:
+            _client_config["read_timeout"] = read_timeout
+        if pool_size is not None and pool_size != _client_config["pool_size"]:
+            _client_config["pool_size"] = pool_size
+            # recreate the session with the new pool size on next request
+            if _session is not None:
+                _session.close()
+                _session = None
+
+
+# Return the shared session, which keeps connections alive between requests
+def get_session():
+    # requests is imported on first use, since it is slow to import
+    # and not needed for the cli help or if there are no changes
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=_client_config["pool_size"]
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def get_completions_url():
+    return _client_config["base_url"].rstrip("/") + "/chat/completions"
+
+
+# Token buckets for requests and tokens per minute, shared by all requests.
+# A request reserves its share of both buckets up front and waits until
+# the buckets are refilled, so that concurrent requests stay within the quota.
+# A rate limit reported by the api pauses all requests until it is reset.
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.paused_until = 0
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None):
+        with self.lock:
+            now = time.monotonic()
+            for name, limit in (
+                ("requests", requests_per_minute),
+                ("tokens", tokens_per_minute),
+            ):
+                if limit is not None:
+                    # start with full buckets, the quota is not used yet
+                    self.buckets[name] = [limit, limit, now] if limit > 0 else None
+
+    # Block until the request fits into the buckets
+    def acquire(self, request_tokens=0):
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.paused_until - now, 0)
+            for name, amount in (("requests", 1), ("tokens", request_tokens)):
+                bucket = self.buckets.get(name)
+                if bucket is None:
+                    continue
+                limit, available, updated = bucket
+                available = min(limit, available + (now - updated) * limit / 60)
+                # a request larger than the bucket only has to wait for a full bucket
+                available -= min(amount, limit)
+                bucket[1:] = [available, now]
+                if available < 0:
+                    wait = max(wait, -available * 60 / limit)
+        if wait > 0:
+            time.sleep(wait)
+
+    # Pause all requests for the given seconds
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+rate_limiter = RateLimiter()
+
+
+# Estimate the tokens a request counts against the tokens per minute quota,
+# which are the prompt tokens and the max tokens of the completion.
+# Roughly four characters per token, to not encode the prompt once more.
+def estimate_request_tokens(payload) -> int:
+    prompt_length = sum(
+        len(message.get("content") or "") for message in payload.get("messages", [])
+    )
+    return prompt_length // 4 + payload.get("max_tokens", 0)
+
+
+# Return the seconds to wait before retrying a failed request.
+# Prefer the wait time sent by the api over exponential backoff with jitter.
+def get_retry_delay(response, attempt) -> float:
+    if response is not None:
+        delay = get_response_reset_delay(response)
+        if delay is not None:
+            return min(delay, MAX_BACKOFF)
+    backoff = min(MAX_BACKOFF, DEFAULT_BACKOFF * 2**attempt)
+    return random.uniform(backoff / 2, backoff)
+
+
+# Return the seconds until the rate limit of the api is reset, if sent.
+# Retry-After is sent as seconds or http date,
+# the x-ratelimit-reset headers as durations like 1s, 6m0s or 20ms.
+def get_response_reset_delay(response):
+    headers = response.headers
+    retry_after = headers.get("retry-after-ms")
+    if retry_after:
+        try:
+            return float(retry_after) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            try:
+                import email.utils
+
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                return max(retry_date.timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+
+    delays = [
+        parse_duration(headers.get(f"x-ratelimit-reset-{name}"))
+        for name in ("requests", "tokens")
+        if headers.get(f"x-ratelimit-remaining-{name}") == "0"
+        or response.status_code == 429
+    ]
+    delays = [delay for delay in delays if delay is not None]
+    return max(delays) if delays else None
+
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+
+
+# Parse a duration like 1h2m3.5s or 20ms to seconds
+def parse_duration(duration):
+    if not duration:
+        return None
+    parts = DURATION_PATTERN.findall(duration)
+    if not parts:
+        try:
+            return float(duration)
+        except ValueError:
+            return None
+    return sum(float(value) * DURATION_UNITS[unit] for value, unit in parts)
+
+
+# Send a chat completions request and return the content of the response,
+# or the arguments of the tool call if the payload requires a tool call.
+# If on_content is given, the response is streamed with server-sent events
+# and on_content is called with every content delta as soon as it arrives.
+# Rate limited and failed requests are retried with backoff,
+# unless content has been streamed already.
+@profiler.timed("send_request")
+def send_request(api_key, payload, spinner_text=None, on_content=None):
+    import requests
+
+    # no spinner if the request is awaited by the caller, e.g. concurrently
+    spinner = utils.get_spinner(spinner_text) if spinner_text else None
+    if spinner:
+        spinner.start()
 
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    stream = on_content is not None
+    if stream:
+        payload = {**payload, "stream": True}
+        if profiler.is_enabled():
+            # the usage is only sent in the last chunk if requested
+            payload["stream_options"] = {"include_usage": True}
+    request_tokens = estimate_request_tokens(payload)
+    tool_call = "tool_choice" in payload
 
+    attempt = 0
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload,
-        )
-        response.raise_for_status()
-        json_response = response.json()
-        review_summary = (
-            json_response["choices"][0]["message"]["content"]
-            .encode()
-            .decode("unicode_escape")
-        )
-        return review_summary
-    except (KeyError, requests.exceptions.RequestException) as e:
-        print("💥 An error occurred while requesting a review.")
-        print(str(e))
+        while True:
+            rate_limiter.acquire(request_tokens)
+            response = None
+            streamed = False
+            profiler.count("requests")
+            try:
+                response = get_session().post(
+                    get_completions_url(),
+                    headers=headers,
+                    json=payload,
+                    timeout=(
+                        _client_config["connect_timeout"],
+                        _client_config["read_timeout"],
+                    ),
+                    stream=stream,
+                )
+                response.raise_for_status()
+                if stream:
+                    content = []
+                    for delta in iter_stream_content(response):
+                        if spinner:
+                            spinner.stop()
+                            spinner = None
+                        streamed = True
+                        content.append(delta)
+                        on_content(delta)
+                    review_summary = "".join(content)
+                else:
+                    response_json = response.json()
+                    count_usage(response_json)
+                    message = response_json["choices"][0]["message"]
+                    if message.get("tool_calls"):
+                        review_summary = message["tool_calls"][0]["function"][
+                            "arguments"
+                        ]
+                    else:
+                        review_summary = message["content"]
+                # the arguments of a tool call are plain json
+                if not tool_call:
+                    review_summary = review_summary.encode().decode("unicode_escape")
+                # the quota is used up, pause the following requests until reset
+                reset_delay = get_response_reset_delay(response)
+                if reset_delay:
+                    rate_limiter.pause(reset_delay)
+                return review_summary
+            except requests.exceptions.RequestException as e:
+                if (
+                    streamed
+                    or attempt >= _client_config["max_retries"]
+                    or not is_retryable(e)
+                ):
+                    raise
+                delay = get_retry_delay(e.response, attempt)
+                if e.response is not None and e.response.status_code == 429:
+                    # all requests are rate limited, not only this one
+                    rate_limiter.pause(delay)
+                elif delay > 0:
+                    time.sleep(delay)
+                attempt += 1
+                profiler.count("retries")
+                if spinner:
+                    spinner.text = f"{spinner_text} (retry {attempt})"
+    except (KeyError, ValueError, requests.exceptions.RequestException) as e:
+        utils.print_message("💥 An error occurred while requesting a review.")
+        utils.print_message(str(e))
         return None
     finally:
-        spinner.stop()
+        if spinner:
+            spinner.stop()
+
+
+# Return if a failed request might succeed when it is sent again
+def is_retryable(error) -> bool:
+    import requests
+
+    if isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    ):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code in RETRY_STATUS_CODES
+
+
+# Yield the content or tool call argument deltas
+# of a streamed chat completions response
+def iter_stream_content(response):
+    try:
+        for line in response.iter_lines():
+            # lines are split by bytes to not break up multibyte characters
+            line = line.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:") :].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            count_usage(chunk)
+            if not chunk.get("choices"):
+                continue
+            delta = chunk["choices"][0].get("delta") or {}
+            if delta.get("tool_calls"):
+                delta = delta["tool_calls"][0].get("function") or {}
+                content = delta.get("arguments")
+            else:
+                content = delta.get("content")
+            if content:
+                yield content
+    finally:
+        response.close()
+
+
+# Count the prompt and completion tokens reported by the api
+def count_usage(response_json):
+    usage = response_json.get("usage")
+    if not usage:
+        return
+    profiler.count("prompt_tokens", usage.get("prompt_tokens") or 0)
+    profiler.count("completion_tokens", usage.get("completion_tokens") or 0)
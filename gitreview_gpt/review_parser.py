@@ -0,0 +1,204 @@
+import json
+import re
+from typing import Any, Dict, Iterator
+import gitreview_gpt.utils as utils
+import gitreview_gpt.profiler as profiler
+
+FENCED_BLOCK_PATTERN = re.compile(r"```[a-zA-Z0-9]*[ \t]*\n(.*?)```", re.DOTALL)
+LENIENT_TOKEN_PATTERN = re.compile(
+    # double quoted strings are kept as they are
+    r'"(?:[^"\\]|\\.)*"'
+    r"|'((?:[^'\\]|\\.)*)'"
+    r"|,(?=\s*[}\]])"
+    # unquoted keys, including line numbers and ranges like 12 or 12-15
+    r"|\b([A-Za-z_$][\w$]*|\d+(?:\s*-\s*\d+)?)(?=\s*:)"
+    r"|\b(True|False|None)\b",
+    re.DOTALL,
+)
+# stages of the candidates of iter_json_candidates, counted when profiling
+PARSE_STAGES = ("json", "code_blocks", "repaired")
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+LINE_KEY_PATTERN = re.compile(
+    r"^\D*?(\d+)(?:\s*(?:-|–|to)\s*[a-z]*\s*(\d+))?\D*$", re.IGNORECASE
+)
+
+
+# Review which has been recovered from truncated json.
+# The findings after the truncation are missing,
+# so it must not be stored as a complete review.
+class TruncatedReview(dict):
+    pass
+
+
+def is_truncated(review_json) -> bool:
+    return isinstance(review_json, TruncatedReview)
+
+
+# Parse the review result of the model into the review format
+# {"filename": {"line_number": {"feedback": "...", "suggestion": "..."}}}.
+# Tolerates text around the json, multiple fenced code blocks,
+# trailing commas, single quotes, unquoted keys and truncated json.
+# A review recovered from truncated json is returned as TruncatedReview.
+# Raises a ValueError if no review in the expected format is found.
+def parse_review(review_result) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    if not review_result:
+        raise ValueError("Review result is empty")
+
+    error = None
+    for stage, candidates in zip(PARSE_STAGES, iter_json_candidates(review_result)):
+        review_json = None
+        for candidate in candidates:
+            try:
+                review = validate_review(candidate)
+            except ValueError as e:
+                error = e
+                continue
+            if review_json is None:
+                review_json = {}
+            for file_name, file_review in review.items():
+                review_json.setdefault(file_name, {}).update(file_review)
+        if review_json is not None:
+            profiler.count(f"parse_{stage}")
+            if stage == "repaired":
+                return TruncatedReview(review_json)
+            return review_json
+    raise error or ValueError("No review found")
+
+
+# Parse the arguments of a review tool call,
+# which are json in the review format without any text around it.
+# Falls back to the tolerant parser, e.g. if the arguments have been truncated.
+def parse_structured_review(arguments) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    try:
+        review_json = validate_review(json.loads(arguments))
+        profiler.count("parse_structured")
+        return review_json
+    except (TypeError, ValueError):
+        return parse_review(arguments)
+
+
+# Yield the parsed json candidates of a review result, from strict to loose:
+# the whole text, the contents of all fenced code blocks
+# and finally the repaired text, if the response has been truncated.
+# A list is yielded for every stage, which is empty if the stage failed.
+def iter_json_candidates(review_result) -> Iterator[list]:
+    candidates = []
+    try:
+        candidates.append(loads_lenient(review_result))
+    except ValueError:
+        pass
+    yield candidates
+
+    blocks = []
+    for block in FENCED_BLOCK_PATTERN.findall(review_result):
+        try:
+            blocks.append(loads_lenient(block))
+        except ValueError:
+            pass
+    yield blocks
+
+    # normalize from the json on, quotes in the text before might be apostrophes
+    start = review_result.find("{")
+    candidates = []
+    if start != -1:
+        try:
+            candidates.append(
+                utils.repair_truncated_json(normalize_json(review_result[start:]))
+            )
+        except ValueError:
+            pass
+    yield candidates
+
+
+# Load a json object from text, which might not be strict json
+def loads_lenient(text) -> Any:
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("No json object found")
+    text = text[start : end + 1]
+    try:
+        return json.loads(text)
+    except ValueError:
+        return json.loads(normalize_json(text))
+
+
+# Turn javascript or python style object literals into json
+def normalize_json(text) -> str:
+    return LENIENT_TOKEN_PATTERN.sub(_normalize_json_token, text)
+
+
+def _normalize_json_token(match) -> str:
+    single_quoted, key, literal = match.groups()
+    token = match.group()
+    if single_quoted is not None:
+        content = single_quoted.replace("\\'", "'")
+        return '"' + re.sub(r'(?<!\\)"', r"\"", content) + '"'
+    if key is not None:
+        return json.dumps(key)
+    if literal is not None:
+        return PYTHON_LITERALS[literal]
+    if token == ",":
+        # trailing comma
+        return ""
+    return token
+
+
+# Validate a parsed review against the review format.
+# Findings without feedback are dropped, line numbers and ranges
+# like "Line 12" or "12 - 15" are normalized to "12" and "12-15".
+def validate_review(review_json) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    if not isinstance(review_json, dict):
+        raise ValueError("Review is not a json object")
+
+    review = {}
+    has_entries = False
+    has_findings = False
+    for file_name, file_review in review_json.items():
+        # findings might be returned as list with the line number in each finding
+        if isinstance(file_review, list):
+            file_review = {
+                str(finding.get("line", finding.get("line_number"))): finding
+                for finding in file_review
+                if isinstance(finding, dict)
+            }
+        if not isinstance(file_review, dict):
+            continue
+        review[file_name] = {}
+        for line, finding in file_review.items():
+            has_entries = True
+            line = normalize_line_key(line)
+            finding = validate_finding(finding)
+            if line is not None and finding is not None:
+                review[file_name][line] = finding
+                has_findings = True
+
+    # e.g. findings without file name, which can't be assigned to a file
+    if (review_json and not review) or (has_entries and not has_findings):
+        raise ValueError("Review has no findings per file and line number")
+    return review
+
+
+def normalize_line_key(line):
+    match = LINE_KEY_PATTERN.match(str(line).strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if end is None or int(end) <= int(start):
+        return str(int(start))
+    return f"{int(start)}-{int(end)}"
+
+
+def validate_finding(finding):
+    if isinstance(finding, str):
+        finding = {"feedback": finding}
+    if not isinstance(finding, dict) or not isinstance(finding.get("feedback"), str):
+        return None
+    finding = {
+        key: value
+        for key, value in finding.items()
+        if key not in ("line", "line_number")
+    }
+    if not isinstance(finding.get("suggestion", ""), (str, type(None))):
+        del finding["suggestion"]
+    return finding
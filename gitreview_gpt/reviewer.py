@@ -1,96 +1,130 @@
 import json
 import os
-from typing import Any, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List
 import gitreview_gpt.prompt as prompt
 import gitreview_gpt.formatter as formatter
+import gitreview_gpt.review_parser as review_parser
 import gitreview_gpt.utils as utils
 import gitreview_gpt.request as request
+import gitreview_gpt.tokens as tokens
+import gitreview_gpt.patch as patch
+import gitreview_gpt.profiler as profiler
+
+APPLY_MODE_EDITS = "edits"
+APPLY_MODE_FILE = "file"
 
 
 # Retrieve review from openai completions api
 # Process response and send repair request if json has invalid format
+# With structured output, the review is requested as arguments of a tool call
 def request_review(
-    api_key, code_to_review, gpt_model, file_name=None
+    api_key,
+    code_to_review,
+    gpt_model,
+    file_name=None,
+    show_spinner=True,
+    on_content=None,
+    structured_output=False,
 ) -> Dict[str, Any] | None:
-    max_tokens = gpt_model.value - utils.count_tokens(
-        json.dumps(prompt.get_review_prompt(code_to_review, gpt_model.value, gpt_model))
+    max_tokens = gpt_model.value - tokens.count_prompt_tokens(
+        prompt.get_review_prompt,
+        (code_to_review,),
+        gpt_model.value,
+        gpt_model,
+        structured_output,
+    )
+    payload = prompt.get_review_prompt(
+        code_to_review, max_tokens, gpt_model, structured_output
     )
-    payload = prompt.get_review_prompt(code_to_review, max_tokens, gpt_model)
 
-    spinner_text = "🔍 Reviewing"
-    if file_name is not None:
-        spinner_text += f" {utils.get_bold_text(file_name)}"
-    spinner_text += "..."
+    spinner_text = None
+    if show_spinner:
+        spinner_text = "🔍 Reviewing"
+        if file_name is not None:
+            spinner_text += f" {utils.get_bold_text(file_name)}"
+        spinner_text += "..."
 
-    review_result = request.send_request(api_key, payload, spinner_text)
+    review_result = request.send_request(api_key, payload, spinner_text, on_content)
     if not review_result:
         return None
     try:
-        review_json = formatter.parse_review_result(review_result)
-    except ValueError:
+        with profiler.timer("parse_review"):
+            if structured_output:
+                review_json = review_parser.parse_structured_review(review_result)
+            else:
+                review_json = review_parser.parse_review(review_result)
+            review_json = remove_unused_suggestions(review_json)
+    except ValueError as e:
+        # the review could not be parsed locally, let it be repaired as last resort
+        profiler.count("parse_repair_request")
         try:
-            # Try to parse review result from marldown code block
-            review_json = formatter.parse_review_result(
-                formatter.extract_content_from_markdown_code_block(review_result)
+            utils.print_message(
+                "Review result has invalid format. It will be repaired."
+            )
+            payload = prompt.get_review_repair_prompt(
+                review_result, e, max_tokens, gpt_model
+            )
+            review_result = request.send_request(
+                api_key, payload, show_spinner and "🔧 Repairing..." or None
+            )
+            review_json = remove_unused_suggestions(
+                review_parser.parse_review(review_result)
             )
         except ValueError:
-            try:
-                # Try to repair truncated review result
-                review_json = formatter.parse_review_result(
-                    utils.repair_truncated_json(review_result)
-                )
-            except ValueError as e:
-                try:
-                    print("Review result has invalid format. It will be repaired.")
-                    payload = prompt.get_review_repair_prompt(
-                        review_result, e, max_tokens, gpt_model
-                    )
-                    review_result = request.send_request(
-                        api_key, payload, "🔧 Repairing..."
-                    )
-                    review_json = formatter.parse_review_result(
-                        formatter.extract_content_from_markdown_code_block(
-                            review_result
-                        )
-                    )
-                except ValueError:
-                    print("💥 Review result could not be repaired.")
-                    print(review_result)
-                    print(
-                        "Feel free to create an issue at https://github.com/fynnfluegge/codereview-agi/issues"
-                    )
-                    return None
+            utils.print_message("💥 Review result could not be repaired.")
+            utils.print_message(review_result)
+            utils.print_message(
+                "Feel free to create an issue at https://github.com/fynnfluegge/codereview-agi/issues"
+            )
+            return None
 
     return review_json
 
 
+# Remove unused suggestions and keep the mark of a truncated review
+def remove_unused_suggestions(review_json):
+    if review_parser.is_truncated(review_json):
+        return review_parser.TruncatedReview(
+            formatter.remove_unused_suggestions(review_json)
+        )
+    return formatter.remove_unused_suggestions(review_json)
+
+
 # Retrieve code changes from openai completions api
 # for one specific file with the related review
+@profiler.timed("apply_review")
 def apply_review(
-    api_key, absolute_file_path, review_json, selection_marker_chunks: Dict, gpt_model
+    api_key,
+    absolute_file_path,
+    review_json,
+    selection_marker_chunks: Dict,
+    gpt_model,
+    max_workers=1,
+    show_spinner=True,
+    apply_mode=APPLY_MODE_EDITS,
 ):
     try:
         with open(absolute_file_path, "r") as file:
             file_name = os.path.basename(file.name)
             programming_language = utils.get_programming_language(file.name)
             file_content = file.read()
-            payload = {
-                "code": file_content,
-                "reviews": formatter.get_review_suggestions_per_file_payload_from_json(
-                    review_json
-                ),
-            }
-            prompt_payload = prompt.get_apply_review_for_file_prompt(
-                file_content,
-                json.dumps(payload["reviews"]),
+            review_comments = json.dumps(
+                formatter.get_review_suggestions_per_file_payload_from_json(review_json)
+            )
+            prompt_tokens = tokens.count_prompt_tokens(
+                prompt.get_apply_review_for_file_prompt,
+                (file_content, review_comments),
                 gpt_model.value,
                 programming_language,
                 gpt_model,
             )
-            tokens = utils.count_tokens(json.dumps(prompt_payload))
             # tokens for file content and review suggestions are greater than threshold
             # split requests into code chunks by selection markers
-            if tokens > gpt_model.value / 2 and selection_marker_chunks is not None:
+            if (
+                prompt_tokens > gpt_model.value / 2
+                and selection_marker_chunks is not None
+            ):
                 # initialize reviewed code for applying code changes later a tonce
                 reviewed_code = []
 
@@ -99,20 +133,7 @@ def apply_review(
                 for line_number in reversed(review_json.keys()):
                     line_number_stack.append(utils.parse_string_to_int(line_number))
 
-                code_chunks_to_review = []
-
-                # prompt offset tokens
-                prompt_tokens = utils.count_tokens(
-                    json.dumps(
-                        prompt.get_apply_review_for_file_prompt(
-                            "",
-                            "",
-                            gpt_model.value,
-                            programming_language,
-                            gpt_model,
-                        )
-                    )
-                )
+                code_chunks_with_suggestions = []
 
                 # iterate over code chunks by selection markers
                 # and merge them with review suggestions by line numbers
@@ -129,33 +150,41 @@ def apply_review(
                         line_number_stack,
                     )
 
-                    # there are review suggestions in that code chunk
-                    if chunk_payload:
-                        for chunk in chunk_payload:
-                            chunk_tokens = (
-                                utils.count_tokens(json.dumps(chunk)) + prompt_tokens
-                            )
-                            # if chunk tokens are smaller than threshold
-                            # add chunk to code chunks to review
-                            if chunk_tokens <= gpt_model.value / 2:
-                                code_chunks_to_review.append(chunk)
-                            else:
-                                # code chunk tokens are greater than threshold
-                                # skip since results are not reliable
-                                pass
+                    # collect review suggestions of that code chunk
+                    code_chunks_with_suggestions.extend(chunk_payload)
+
+                # prompt offset tokens
+                prompt_offset_tokens = tokens.count_prompt_tokens(
+                    prompt.get_apply_review_for_file_prompt,
+                    ("", ""),
+                    gpt_model.value,
+                    programming_language,
+                    gpt_model,
+                )
+                chunk_tokens = tokens.count_tokens_batch(
+                    json.dumps(chunk) for chunk in code_chunks_with_suggestions
+                )
+                # if chunk tokens are smaller than threshold
+                # add chunk to code chunks to review, otherwise
+                # skip since results are not reliable
+                code_chunks_to_review = [
+                    chunk
+                    for chunk, chunk_token_count in zip(
+                        code_chunks_with_suggestions, chunk_tokens
+                    )
+                    if chunk_token_count + prompt_offset_tokens <= gpt_model.value / 2
+                ]
 
                 if code_chunks_to_review:
-                    code_chunk_count = code_chunks_to_review.__len__()
-                    for index, chunk in enumerate(code_chunks_to_review, start=1):
-                        reviewed_code_chunks = request_review_changes(
-                            chunk,
-                            api_key,
-                            gpt_model,
-                            programming_language,
-                            index,
-                            code_chunk_count,
-                            file_name,
-                        )
+                    for reviewed_code_chunks in request_review_changes_concurrently(
+                        code_chunks_to_review,
+                        api_key,
+                        gpt_model,
+                        programming_language,
+                        file_name,
+                        max_workers,
+                        show_spinner,
+                    ):
                         add_reviewed_code(reviewed_code_chunks, reviewed_code)
 
                 file.close()
@@ -163,7 +192,7 @@ def apply_review(
                     "".join(reviewed_code)
                 )
                 utils.override_lines_in_file(absolute_file_path, code_lines)
-                print(
+                utils.print_message(
                     "✅ Successfully applied review changes to "
                     f"{utils.get_bold_text(os.path.basename(absolute_file_path))}"
                     "\n"
@@ -174,42 +203,145 @@ def apply_review(
                 )
 
             # tokens for file content and review suggestions are less than threshold
-            # send request for file content and review suggestions
+            # request edits of the file and apply them, if they can be validated,
+            # otherwise send request for file content and review suggestions
             else:
-                max_completions_tokens = gpt_model.value - tokens
-                reviewed_git_diff = request.send_request(
-                    api_key,
-                    prompt.get_apply_review_for_file_prompt(
+                reviewed_code = None
+                if apply_mode == APPLY_MODE_EDITS:
+                    reviewed_code = request_review_edits(
+                        api_key,
                         file_content,
-                        json.dumps(payload["reviews"]),
-                        max_completions_tokens,
+                        review_comments,
                         programming_language,
                         gpt_model,
-                    ),
-                    f"🔧 Applying changes to {utils.get_bold_text(file_name)}...",
-                )
-                reviewed_git_diff = formatter.extract_content_from_markdown_code_block(
-                    reviewed_git_diff
-                )
-                file.close()
-                with open(absolute_file_path, "w") as file:
-                    if reviewed_git_diff:
-                        file.write(reviewed_git_diff)
-                        print(
-                            "✅ Successfully applied review changes to "
-                            f"{utils.get_bold_text(file_name)}"
+                        file_name,
+                        show_spinner,
+                    )
+                if reviewed_code is None:
+                    if apply_mode == APPLY_MODE_EDITS:
+                        profiler.count("apply_edits_fallback")
+                    max_completions_tokens = gpt_model.value - prompt_tokens
+                    reviewed_code = request.send_request(
+                        api_key,
+                        prompt.get_apply_review_for_file_prompt(
+                            file_content,
+                            review_comments,
+                            max_completions_tokens,
+                            programming_language,
+                            gpt_model,
+                        ),
+                        show_spinner
+                        and f"🔧 Applying changes to {utils.get_bold_text(file_name)}..."
+                        or None,
+                    )
+                    if reviewed_code:
+                        reviewed_code = (
+                            formatter.extract_content_from_markdown_code_block(
+                                reviewed_code
+                            )
                         )
+                file.close()
+                if reviewed_code:
+                    with profiler.timer("write_file"):
+                        utils.write_file_atomically(absolute_file_path, reviewed_code)
+                    utils.print_message(
+                        "✅ Successfully applied review changes to "
+                        f"{utils.get_bold_text(file_name)}"
+                    )
 
     except FileNotFoundError:
-        print(f"💥 File '{absolute_file_path}' not found.")
+        utils.print_message(f"💥 File '{absolute_file_path}' not found.")
     except IOError:
-        print(f"💥 Error reading file '{absolute_file_path}'.")
+        utils.print_message(f"💥 Error reading file '{absolute_file_path}'.")
     except ValueError as e:
-        print(f"💥 Error while applying review changes for file {absolute_file_path}.")
-        print(e)
+        utils.print_message(
+            f"💥 Error while applying review changes for file {absolute_file_path}."
+        )
+        utils.print_message(e)
     return None
 
 
+# Request the code changes of independent code chunks concurrently
+# and return the results in the order of the code chunks
+def request_review_changes_concurrently(
+    code_chunks_with_suggestions,
+    api_key,
+    gpt_model,
+    programming_language,
+    file_name,
+    max_workers=1,
+    show_spinner=True,
+) -> List[str | None]:
+    total_steps = len(code_chunks_with_suggestions)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                request_review_changes,
+                chunk,
+                api_key,
+                gpt_model,
+                programming_language,
+                index,
+                total_steps,
+                file_name,
+                False,
+            )
+            for index, chunk in enumerate(code_chunks_with_suggestions, start=1)
+        ]
+        # a single spinner for all requests,
+        # since spinners of concurrent requests would overwrite each other
+        if show_spinner:
+            spinner_text = f"🔧 Applying changes to {utils.get_bold_text(file_name)}..."
+            with utils.get_spinner(f"{spinner_text} 0/{total_steps}") as spinner:
+                for done_steps, _ in enumerate(as_completed(futures), start=1):
+                    spinner.text = f"{spinner_text} {done_steps}/{total_steps}"
+        return [future.result() for future in futures]
+
+
+# Request search and replace edits for the review comments
+# and return the edited file content.
+# Returns None if the edits don't match the file content.
+def request_review_edits(
+    api_key,
+    file_content,
+    review_comments,
+    programming_language,
+    gpt_model,
+    file_name,
+    show_spinner=True,
+):
+    prompt_tokens = tokens.count_prompt_tokens(
+        prompt.get_apply_review_edits_for_file_prompt,
+        (file_content, review_comments),
+        gpt_model.value,
+        programming_language,
+        gpt_model,
+    )
+    review_edits = request.send_request(
+        api_key,
+        prompt.get_apply_review_edits_for_file_prompt(
+            file_content,
+            review_comments,
+            gpt_model.value - prompt_tokens,
+            programming_language,
+            gpt_model,
+        ),
+        show_spinner
+        and f"🔧 Applying changes to {utils.get_bold_text(file_name)}..."
+        or None,
+    )
+    if not review_edits:
+        return None
+    try:
+        return patch.apply_edits(file_content, patch.parse_edits(review_edits))
+    except ValueError:
+        utils.print_message(
+            f"⚠️  Review edits don't match {utils.get_bold_text(file_name)}. "
+            "Requesting the complete file instead."
+        )
+        return None
+
+
 def request_review_changes(
     code_chunk_with_suggestions,
     api_key,
@@ -218,29 +350,29 @@ def request_review_changes(
     current_step,
     total_steps,
     file_name,
+    show_spinner=True,
 ):
-    message_tokens = utils.count_tokens(
-        json.dumps(
-            prompt.get_apply_review_for_git_diff_chunk_promp(
-                code_chunk_with_suggestions["code"],
-                json.dumps(code_chunk_with_suggestions["suggestions"]),
-                gpt_model.value,
-                programming_language,
-                gpt_model,
-            )
-        )
+    review_comments = json.dumps(code_chunk_with_suggestions["suggestions"])
+    message_tokens = tokens.count_prompt_tokens(
+        prompt.get_apply_review_for_git_diff_chunk_promp,
+        (code_chunk_with_suggestions["code"], review_comments),
+        gpt_model.value,
+        programming_language,
+        gpt_model,
     )
     return request.send_request(
         api_key,
         prompt.get_apply_review_for_git_diff_chunk_promp(
             code_chunk_with_suggestions["code"],
-            json.dumps(code_chunk_with_suggestions["suggestions"]),
+            review_comments,
             gpt_model.value - message_tokens,
             programming_language,
             gpt_model,
         ),
-        "🔧 Applying changes to "
-        + f"{utils.get_bold_text(file_name)}... {current_step}/{total_steps}",
+        show_spinner
+        and "🔧 Applying changes to "
+        + f"{utils.get_bold_text(file_name)}... {current_step}/{total_steps}"
+        or None,
     )
 
 
@@ -0,0 +1,70 @@
+import functools
+import json
+import re
+from typing import Iterable, List
+import gitreview_gpt.profiler as profiler
+import gitreview_gpt.utils as utils
+
+DEFAULT_ENCODING_MODEL = "gpt-3.5-turbo"
+# words are split into pieces of up to four characters,
+# which slightly overestimates the tokens of code
+ESTIMATED_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+# Load the encoding only once per model.
+# If the encoding can't be loaded, e.g. when it is not cached yet
+# and there is no internet connection, the tokens are estimated.
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=DEFAULT_ENCODING_MODEL):
+    # tiktoken is imported on first use, since it is slow to import
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model(model)
+    except (ImportError, KeyError, ValueError, OSError):
+        utils.print_message(
+            "⚠️  Token encoding could not be loaded, tokens are estimated."
+        )
+        return EstimatedEncoding()
+
+
+# Encoding with a rough estimate of about four characters per token
+class EstimatedEncoding:
+    def encode(self, text, disallowed_special=()) -> List[str]:
+        return ESTIMATED_TOKEN_PATTERN.findall(text)
+
+    def encode_batch(self, texts, disallowed_special=()) -> List[List[str]]:
+        return [self.encode(text) for text in texts]
+
+
+# Return the number of tokens in a string
+@profiler.timed("count_tokens")
+def count_tokens(text, model=DEFAULT_ENCODING_MODEL) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+# Return the number of tokens for each string, encoded in one batch
+@profiler.timed("count_tokens_batch")
+def count_tokens_batch(texts: Iterable[str], model=DEFAULT_ENCODING_MODEL) -> List[int]:
+    encoded = get_encoding(model).encode_batch(list(texts), disallowed_special=())
+    return [len(tokens) for tokens in encoded]
+
+
+# Return the number of tokens of a prompt payload.
+# The prompt function is called with the variable parts first,
+# followed by the static arguments, like max_tokens and gpt_model.
+# The scaffolding of the prompt is counted once per static arguments,
+# only the variable parts are counted on every call.
+def count_prompt_tokens(
+    prompt_function, variable_parts, *static_args, model=DEFAULT_ENCODING_MODEL
+) -> int:
+    scaffold_tokens = _count_prompt_scaffold_tokens(
+        prompt_function, len(variable_parts), static_args, model
+    )
+    return scaffold_tokens + sum(count_tokens(part, model) for part in variable_parts)
+
+
+@functools.lru_cache(maxsize=None)
+def _count_prompt_scaffold_tokens(prompt_function, variable_count, static_args, model):
+    payload = prompt_function(*([""] * variable_count), *static_args)
+    return count_tokens(json.dumps(payload), model)
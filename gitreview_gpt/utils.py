@@ -1,6 +1,13 @@
+import collections
 import json
+import os
+import re
+import shutil
 import subprocess
-import tiktoken
+import sys
+import tempfile
+from typing import Dict, List
+import gitreview_gpt.profiler as profiler
 
 
 def parse_string_to_int(input_string):
@@ -13,28 +20,49 @@ def parse_string_to_int(input_string):
         return int(input_string)
 
 
+JSON_CLOSERS = {"{": "}", "[": "]"}
+# strings are matched as a whole, an unterminated string has no closing quote
+JSON_TOKEN_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*("?)|[{}\[\]]', re.DOTALL)
+
+
+# Repair a truncated json response and return the parsed object.
+# The json is scanned once for strings and brackets, keeping track of
+# the open brackets. The incomplete tail after the last closed object
+# or array is cut off and the brackets still open at that point are closed.
 def repair_truncated_json(json_str):
     try:
-        # Attempt to load the JSON
-        json_data = json.loads(json_str)
-        return json_data
+        return json.loads(json_str)
     except json.JSONDecodeError:
-        # If loading fails, try to find the last valid JSON fragment
-        last_valid_index = 0
-        for i in range(len(json_str) - 1, -1, -1):
-            partial_json = json_str[: i + 1]
-            try:
-                json.loads(partial_json + "\n}\n}")
-                last_valid_index = i
-                break
-            except json.JSONDecodeError:
-                pass
+        pass
 
-        if last_valid_index > 0:
-            repaired_json = json_str[: last_valid_index + 1]
-            return repaired_json + "\n}\n}"
+    # skip leading text, e.g. an opening markdown code block
+    start = json_str.find("{")
+    if start == -1:
+        raise ValueError("Could not repair JSON")
+
+    open_brackets = []
+    cut_index = None
+    cut_closers = None
+    for match in JSON_TOKEN_PATTERN.finditer(json_str, start):
+        token = match.group()
+        if token[0] == '"':
+            if not match.group(1):
+                # truncated within a string
+                break
+        elif token in JSON_CLOSERS:
+            open_brackets.append(JSON_CLOSERS[token])
         else:
-            raise ValueError("Could not repair JSON")
+            if not open_brackets or open_brackets.pop() != token:
+                raise ValueError("Could not repair JSON")
+            if not open_brackets:
+                # the json is complete, anything after it is ignored
+                return json.loads(json_str[start : match.end()])
+            cut_index = match.end()
+            cut_closers = "".join(reversed(open_brackets))
+
+    if cut_index is None:
+        raise ValueError("Could not repair JSON")
+    return json.loads(json_str[start:cut_index] + cut_closers)
 
 
 def get_programming_language(filename):
@@ -86,45 +114,246 @@ def get_file_blacklist():
     ]
 
 
-# Return the number of tokens in a string
-def count_tokens(text):
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    tokenized = encoding.encode(text)
-    return len(tokenized)
-
-
 def get_bold_text(text):
     return f"\033[01m{text}\033[0m"
 
 
+# Stream of progress messages and spinners, None for stdout.
+# Set to stderr if the reviews are written to stdout, e.g. as json.
+message_stream = None
+
+
+def set_message_stream(stream):
+    global message_stream
+    message_stream = stream
+
+
+def print_message(*values):
+    print(*values, file=message_stream or sys.stdout)
+
+
+# Return a spinner with the text on stdout.
+# Spinners always draw to stdout, so if messages are routed elsewhere
+# the text is printed once as message instead.
+def get_spinner(text):
+    if message_stream is not None and message_stream is not sys.stdout:
+        return MessageSpinner(text)
+    from yaspin import yaspin
+
+    return yaspin(text=text)
+
+
+class MessageSpinner:
+    def __init__(self, text):
+        self.text = text
+
+    def start(self):
+        print_message(self.text)
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# Return the git command for the changes of the working directory,
+# or of the staged changes against a branch, limited to the pathspecs
+def get_git_diff_command(branch=None, pathspecs=()):
+    if not branch:
+        command = ["git", "diff", "HEAD"]
+    else:
+        command = ["git", "diff", branch, "--cached"]
+    if pathspecs:
+        command += ["--", *pathspecs]
+    return command
+
+
 def get_git_repo_root():
     return subprocess.check_output(
         ["git", "rev-parse", "--show-toplevel"], universal_newlines=True
     ).strip()
 
 
-def has_unstaged_changes(file):
-    try:
-        # Run the "git diff --quiet" command and capture its output
-        subprocess.check_output(["git", "diff", "--quiet", file])
-        return False  # No unstaged changes
-    except subprocess.CalledProcessError:
-        return True  # Unstaged changes exist
+# Return the paths relative to the repo root of all files with unstaged changes
+def get_unstaged_files(repo_root=None):
+    output = subprocess.check_output(
+        ["git", "status", "--porcelain=v1", "-z", "--untracked-files=no"],
+        cwd=repo_root,
+        universal_newlines=True,
+    )
+    unstaged_files = set()
+    entries = iter(output.split("\0"))
+    for entry in entries:
+        if not entry:
+            continue
+        status, path = entry[:2], entry[3:]
+        # second status letter is the state of the working tree
+        if status[1] not in (" ", "?", "!"):
+            unstaged_files.add(path)
+        # renamed and copied files are followed by their original path
+        if status[0] in ("R", "C"):
+            next(entries, None)
+    return unstaged_files
 
 
+# Replace lines of a file by line number,
+# a line might be replaced by multiple lines separated by newlines
+@profiler.timed("override_lines_in_file")
 def override_lines_in_file(file_path, lines_dict):
+    edit_lines_in_files(
+        {
+            file_path: [
+                LineEdit(line_number, line_number, content.split("\n"))
+                for line_number, content in lines_dict.items()
+            ]
+        }
+    )
+
+
+# Replace the content of a file. The content is written to a temporary file
+# next to it, which replaces the file, so that the file is never left
+# partially written. With fsync, the content is flushed to disk first.
+def write_file_atomically(file_path, content, fsync=True):
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path) or ".",
+        prefix="." + os.path.basename(file_path) + ".",
+    )
     try:
-        with open(file_path, "r") as file:
-            existing_lines = file.readlines()
+        with open(file_descriptor, "w") as file:
+            file.write(content)
+            file.flush()
+            if fsync:
+                os.fsync(file.fileno())
+        shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    if fsync:
+        _fsync_directory(os.path.dirname(file_path) or ".")
 
-        with open(file_path, "w") as file:
-            for line_number, new_line_content in lines_dict.items():
-                # Adjust line number to 0-based index
-                line_index = line_number - 1
 
-                if 0 <= line_index < len(existing_lines):
-                    existing_lines[line_index] = new_line_content + "\n"
+# Replacement of the lines start_line to end_line of a file, starting at 1.
+# The lines are inserted before start_line if end_line is start_line - 1
+# and the range of lines is deleted if there are no lines.
+class LineEdit:
+    def __init__(self, start_line, end_line, lines):
+        self.start_line = start_line
+        self.end_line = end_line
+        self.lines = lines
 
-            file.writelines(existing_lines)
-    except Exception as e:
-        print("An error occurred:", str(e))
+
+# Apply line edits to multiple files.
+# Each file is streamed into a temporary file next to it and only if all
+# files have been written, the temporary files replace the original files.
+# With fsync, the files are flushed to disk before they replace the originals.
+# Edits after the end of a file are ignored.
+def edit_lines_in_files(file_edits: Dict[str, List[LineEdit]], fsync=True):
+    temp_paths = {}
+    try:
+        for file_path, edits in file_edits.items():
+            temp_paths[file_path] = _write_edited_file(file_path, edits, fsync)
+        for file_path, temp_path in temp_paths.items():
+            os.replace(temp_path, file_path)
+        if fsync:
+            for directory in {os.path.dirname(path) or "." for path in temp_paths}:
+                _fsync_directory(directory)
+    finally:
+        for temp_path in temp_paths.values():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def _write_edited_file(file_path, edits, fsync):
+    edits = sorted(edits, key=lambda edit: (edit.start_line, edit.end_line))
+    for edit in edits:
+        if edit.start_line < 1 or edit.end_line < edit.start_line - 1:
+            raise ValueError(
+                f"Invalid edit of lines {edit.start_line}-{edit.end_line} "
+                f"in {file_path}"
+            )
+    for edit, next_edit in zip(edits, edits[1:]):
+        if next_edit.start_line <= edit.end_line:
+            raise ValueError(
+                f"Overlapping edits of lines {edit.start_line}-{edit.end_line} "
+                f"and {next_edit.start_line}-{next_edit.end_line} in {file_path}"
+            )
+
+    file_descriptor, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path) or ".",
+        prefix="." + os.path.basename(file_path) + ".",
+    )
+    try:
+        # keep the line endings of the file as they are
+        with open(file_path, "r", newline="") as source, open(
+            file_descriptor, "w", newline=""
+        ) as target:
+            _write_edited_lines(source, target, collections.deque(edits))
+            target.flush()
+            if fsync:
+                os.fsync(target.fileno())
+        shutil.copymode(file_path, temp_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def _write_edited_lines(source, target, edits):
+    newline = None
+    line_number = 0
+    ends_with_newline = True
+
+    def write_lines(lines, last_line_ending):
+        nonlocal ends_with_newline
+        for index, line in enumerate(lines, start=1):
+            line_ending = last_line_ending if index == len(lines) else newline
+            target.write(line + line_ending)
+            ends_with_newline = bool(line_ending)
+
+    for line in source:
+        line_number += 1
+        content = line.rstrip("\r\n")
+        line_ending = line[len(content) :]
+        if newline is None and line_ending:
+            newline = line_ending
+        line_newline = line_ending or newline or "\n"
+
+        # insert lines before this line
+        while edits and edits[0].end_line < edits[0].start_line == line_number:
+            write_lines(edits.popleft().lines, line_newline)
+
+        if edits and edits[0].start_line <= line_number:
+            # the line is replaced, the lines of the edit are written with its last line
+            if line_number == edits[0].end_line:
+                write_lines(edits.popleft().lines, line_ending)
+            continue
+
+        target.write(line)
+        ends_with_newline = bool(line_ending)
+
+    newline = newline or "\n"
+    # the replaced range exceeds the end of the file
+    if edits and edits[0].start_line <= line_number < edits[0].end_line:
+        write_lines(edits.popleft().lines, newline)
+    # insert lines at the end of the file
+    while edits and edits[0].end_line < edits[0].start_line == line_number + 1:
+        if not ends_with_newline:
+            target.write(newline)
+        write_lines(edits.popleft().lines, newline)
+
+
+def _fsync_directory(directory):
+    # directories can't be opened on windows, the rename is durable there
+    if os.name == "nt":
+        return
+    directory_descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_descriptor)
+    finally:
+        os.close(directory_descriptor)
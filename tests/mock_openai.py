@@ -0,0 +1,206 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DIFF_LINE_PATTERN = re.compile(r"^(\d+) [+-]", re.MULTILINE)
+CODE_BLOCK_PATTERN = re.compile(r"```\n(.*?)```", re.DOTALL)
+
+
+# Local stand-in for the chat completions api of OpenAI.
+# Reviews have one finding for the first changed line of every file
+# in the prompt, requests to apply a review return the code unchanged.
+# Responses can be delayed, streamed, truncated or fail with an error.
+class MockOpenAIServer:
+    def __init__(
+        self,
+        delay=0.0,
+        stream_chunk_delay=0.0,
+        error_status=None,
+        error_count=0,
+        retry_after=0,
+        truncate_ratio=None,
+    ):
+        # seconds to wait before responding
+        self.delay = delay
+        # seconds to wait between streamed chunks
+        self.stream_chunk_delay = stream_chunk_delay
+        # the first error_count requests fail with error_status
+        self.error_status = error_status
+        self.error_count = error_count
+        self.retry_after = retry_after
+        # cut off the content of responses after this fraction
+        self.truncate_ratio = truncate_ratio
+
+        self.lock = threading.Lock()
+        self.requests = []
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def start(self):
+        handler = type("Handler", (MockOpenAIHandler,), {"mock_server": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, payload):
+        """
+        Return the status code, headers and content of the response
+        """
+        with self.lock:
+            self.requests.append(payload)
+            if self.errors < self.error_count:
+                self.errors += 1
+                headers = {"Retry-After": str(self.retry_after)}
+                return self.error_status, headers, None
+
+        content = get_response_content(payload)
+        if self.truncate_ratio is not None:
+            content = content[: int(len(content) * self.truncate_ratio)]
+
+        with self.lock:
+            self.prompt_tokens += estimate_tokens(
+                "".join(message["content"] for message in payload["messages"])
+            )
+            self.completion_tokens += estimate_tokens(content)
+        return 200, {}, content
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock_server = None
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            # the client closed a kept alive connection on exit
+            pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.mock_server.delay:
+            time.sleep(self.mock_server.delay)
+        status, headers, content = self.mock_server.handle(payload)
+
+        if content is None:
+            self.send_json(status, {"error": {"message": "Mock error"}}, headers)
+        elif payload.get("stream"):
+            self.send_stream(payload, content)
+        else:
+            self.send_json(
+                200,
+                {
+                    "choices": [{"message": get_message(payload, content)}],
+                    "usage": get_usage(payload, content),
+                },
+            )
+
+    def send_json(self, status, body, headers=None):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, payload, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for index in range(0, len(content), 16):
+            delta = content[index : index + 16]
+            if payload.get("tools"):
+                delta = {"tool_calls": [{"index": 0, "function": {"arguments": delta}}]}
+            else:
+                delta = {"content": delta}
+            self.write_chunk(f"data: {json.dumps({'choices': [{'delta': delta}]})}\n\n")
+            if self.mock_server.stream_chunk_delay:
+                time.sleep(self.mock_server.stream_chunk_delay)
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            usage = get_usage(payload, content)
+            self.write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.write_chunk("")
+
+    def write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+def get_message(payload, content):
+    if payload.get("tools"):
+        function = {"name": "submit_review", "arguments": content}
+        return {
+            "content": None,
+            "tool_calls": [{"type": "function", "function": function}],
+        }
+    return {"content": content}
+
+
+def get_response_content(payload):
+    prompt = payload["messages"][-1]["content"]
+    code_block = CODE_BLOCK_PATTERN.search(prompt)
+    if code_block is None:
+        return json.dumps(get_review(prompt))
+    code = code_block.group(1)
+    if "SEARCH" in prompt:
+        # replace the first line with itself
+        first_line = code.splitlines()[0] if code else ""
+        return f"<<<<<<< SEARCH\n{first_line}\n=======\n{first_line}\n>>>>>>> REPLACE\n"
+    return f"```\n{code}```"
+
+
+# Review with a finding for the first changed line of every file,
+# the formatted diff starts with the file name followed by its hunks
+def get_review(diff):
+    review = {}
+    for file_diff in re.split(r"\n(?=[^\n@\d][^\n]*\n@@ )", "\n" + diff):
+        file_name = file_diff.strip().split("\n", 1)[0]
+        if not file_name:
+            continue
+        line = DIFF_LINE_PATTERN.search(file_diff)
+        review[file_name] = {}
+        if line:
+            review[file_name][line.group(1)] = {
+                "feedback": f"Check the change in line {line.group(1)}.",
+                "suggestion": "Handle the error case.",
+            }
+    return review
+
+
+def get_usage(payload, content):
+    return {
+        "prompt_tokens": estimate_tokens(str(payload["messages"])),
+        "completion_tokens": estimate_tokens(content),
+    }
+
+
+# About four characters per token
+def estimate_tokens(text):
+    return len(text) // 4
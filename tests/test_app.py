@@ -0,0 +1,49 @@
+import threading
+import time
+import unittest
+from unittest import mock
+import gitreview_gpt.app as app
+
+
+class TestApplyPipeline(unittest.TestCase):
+    def test_applies_reviews_of_same_file_one_after_another(self):
+        running = set()
+        overlapping = []
+        applied = []
+        lock = threading.Lock()
+
+        def apply(file_path, index):
+            with lock:
+                if file_path in running:
+                    overlapping.append(file_path)
+                running.add(file_path)
+            time.sleep(0.01)
+            with lock:
+                running.discard(file_path)
+                applied.append((file_path, index))
+
+        apply_pipeline = app.ApplyPipeline(max_workers=4)
+        for index in range(3):
+            for file_path in ("app.py", "src/utils.py"):
+                apply_pipeline.submit(file_path, apply, file_path, index)
+        apply_pipeline.close()
+
+        self.assertEqual(overlapping, [])
+        self.assertEqual(len(applied), 6)
+        self.assertEqual(
+            [index for file_path, index in applied if file_path == "app.py"],
+            [0, 1, 2],
+        )
+
+
+class TestReviewStreamPrinter(unittest.TestCase):
+    def test_finish_matches_files_keyed_by_path(self):
+        printer = app.ReviewStreamPrinter()
+        with mock.patch("builtins.print"):
+            printer.print_event(("file", "src/a.py"))
+            printer.print_event(
+                ("finding", "src/a.py", "1", {"feedback": "Handle errors."})
+            )
+            printer.print_event(("file_end", "src/a.py"))
+
+        self.assertTrue(printer.finish("a.py"))
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+import unittest
+import gitreview_gpt.batch as batch
+from tests.mock_openai import MockOpenAIServer
+from tests.test_e2e import create_repo, run_rgpt
+
+
+class TestParseTargets(unittest.TestCase):
+    def test_parse_targets(self):
+        targets = batch.parse_targets(
+            [
+                "# nightly review\n",
+                "../service main\n",
+                "\n",
+                "'../mono repo' main -- packages/api packages/web\n",
+                "../scratch\n",
+            ]
+        )
+
+        self.assertEqual(
+            [(target.path, target.branch, target.pathspecs) for target in targets],
+            [
+                ("../service", "main", []),
+                ("../mono repo", "main", ["packages/api", "packages/web"]),
+                ("../scratch", None, []),
+            ],
+        )
+
+    def test_invalid_target(self):
+        with self.assertRaises(ValueError):
+            batch.parse_targets(["../service main extra\n"])
+
+
+class TestBatchEndToEnd(unittest.TestCase):
+    def test_batch_report(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, file_count in (("service", 2), ("mono", 3)):
+                os.makedirs(os.path.join(tmp_dir, name))
+                create_repo(os.path.join(tmp_dir, name), file_count)
+            targets_path = os.path.join(tmp_dir, "targets.txt")
+            with open(targets_path, "w") as file:
+                file.write("service\nmono -- src/module_1.py\nmissing\n")
+            report_path = os.path.join(tmp_dir, "report.json")
+
+            with MockOpenAIServer() as server:
+                result = run_rgpt(
+                    tmp_dir,
+                    server.base_url,
+                    "--targets",
+                    targets_path,
+                    "--report",
+                    report_path,
+                    action="batch",
+                )
+            with open(report_path) as file:
+                report = json.load(file)
+
+        # the missing repository fails the run
+        self.assertEqual(result.returncode, 1, result.stderr)
+        self.assertIn("1 of 3 targets failed", result.stderr)
+        self.assertEqual(report["model"], "gpt-3.5-turbo")
+        # small files of all repositories are packed into shared requests,
+        # files with the same name are reviewed in separate requests
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(
+            report["summary"],
+            {
+                "targets": 3,
+                "failed_targets": 1,
+                "files": 3,
+                "failed_files": 0,
+                "findings": 3,
+            },
+        )
+        service, mono, missing = report["targets"]
+        self.assertEqual(
+            [file["file_path"] for file in service["files"]],
+            ["src/module_0.py", "src/module_1.py"],
+        )
+        self.assertEqual(
+            [file["file_path"] for file in mono["files"]], ["src/module_1.py"]
+        )
+        self.assertEqual(
+            mono["files"][0]["findings"],
+            [
+                {
+                    "line": 21,
+                    "end_line": 21,
+                    "feedback": "Check the change in line 21.",
+                    "suggestion": "Handle the error case.",
+                }
+            ],
+        )
+        self.assertTrue(mono["files"][0]["reviewed"])
+        self.assertIsNone(service["error"])
+        self.assertIsNotNone(missing["error"])
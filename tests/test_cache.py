@@ -0,0 +1,54 @@
+import os
+import tempfile
+import time
+import unittest
+import gitreview_gpt.cache as cache
+import gitreview_gpt.prompt as prompt
+
+
+class TestReviewCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.review_cache = cache.ReviewCache(cache_dir=self.tmp_dir.name)
+        self.code = "app.py\n@@ -1,1 +1,2 @@\n1 import os\n2 +import sys\n"
+        self.review_json = {"app.py": {"2": {"feedback": "sys is not needed."}}}
+
+    def test_get_returns_stored_review(self):
+        self.assertIsNone(self.review_cache.get(self.code, prompt.GptModel.GPT_35))
+        self.review_cache.put(self.code, prompt.GptModel.GPT_35, self.review_json)
+
+        self.assertEqual(
+            self.review_cache.get(self.code, prompt.GptModel.GPT_35), self.review_json
+        )
+        self.assertIsNone(self.review_cache.get(self.code, prompt.GptModel.GPT_4))
+        self.assertIsNone(
+            self.review_cache.get(self.code + "3 \n", prompt.GptModel.GPT_35)
+        )
+
+    def test_get_ignores_expired_entries(self):
+        self.review_cache.put(self.code, prompt.GptModel.GPT_35, self.review_json)
+        path = self.review_cache.get_path(
+            self.review_cache.get_key(self.code, prompt.GptModel.GPT_35)
+        )
+        expired = time.time() - self.review_cache.max_age - 1
+        os.utime(path, (expired, expired))
+
+        self.assertIsNone(self.review_cache.get(self.code, prompt.GptModel.GPT_35))
+        self.assertFalse(os.path.exists(path))
+
+    def test_evict_removes_least_recently_used_entries(self):
+        codes = [self.code + str(i) for i in range(3)]
+        for i, code in enumerate(codes):
+            self.review_cache.put(code, prompt.GptModel.GPT_35, self.review_json)
+            path = self.review_cache.get_path(
+                self.review_cache.get_key(code, prompt.GptModel.GPT_35)
+            )
+            os.utime(path, (time.time() - 10 + i, time.time() - 10 + i))
+        self.review_cache.max_size = 2 * os.path.getsize(path)
+
+        self.review_cache.evict()
+
+        self.assertIsNone(self.review_cache.get(codes[0], prompt.GptModel.GPT_35))
+        self.assertIsNotNone(self.review_cache.get(codes[1], prompt.GptModel.GPT_35))
+        self.assertIsNotNone(self.review_cache.get(codes[2], prompt.GptModel.GPT_35))
@@ -0,0 +1,282 @@
+import time
+import unittest
+from unittest import mock
+import gitreview_gpt.dispatcher as dispatcher
+import gitreview_gpt.formatter as formatter
+import gitreview_gpt.output as output
+import gitreview_gpt.prompt as prompt
+import gitreview_gpt.review_parser as review_parser
+
+
+def get_file_chunk(file_name, line_count=1):
+    diff = f"{file_name}\n@@ -1,{line_count} +1,{line_count} @@\n" + "".join(
+        f"{line} +line {line}\n" for line in range(1, line_count + 1)
+    )
+    return formatter.FileChunk(file_name, "src/" + file_name, {}, diff)
+
+
+def count_tokens(text):
+    return len(text.split())
+
+
+def count_tokens_batch(texts):
+    return [count_tokens(text) for text in texts]
+
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        for name, side_effect in [
+            ("count_tokens", count_tokens),
+            ("count_tokens_batch", count_tokens_batch),
+        ]:
+            patcher = mock.patch.object(
+                dispatcher.tokens, name, side_effect=side_effect
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_request_reviews_yields_results_in_file_order(self):
+        delays = {"a.py": 0.05, "b.py": 0.0, "c.py": 0.01}
+
+        def request_review(api_key, code, gpt_model, file_name, *args):
+            time.sleep(delays[file_name])
+            return {"src/" + file_name: {"1": {"feedback": file_name}}}
+
+        with mock.patch.object(
+            dispatcher.reviewer, "request_review", side_effect=request_review
+        ):
+            results = list(
+                dispatcher.request_reviews(
+                    "api_key",
+                    [get_file_chunk(file_name) for file_name in delays],
+                    prompt.GptModel.GPT_35,
+                    max_workers=3,
+                    pack_ratio=0,
+                )
+            )
+
+        self.assertEqual(
+            [file_chunk.file_name for file_chunk, _ in results], list(delays)
+        )
+        self.assertEqual(results[1][1], {"b.py": {"1": {"feedback": "b.py"}}})
+
+    def test_request_reviews_packs_small_files(self):
+        file_chunks = [
+            get_file_chunk("a.py", 100),
+            get_file_chunk("b.py", 100),
+            get_file_chunk("c.py", 400),
+            get_file_chunk("d.py", 10),
+            get_file_chunk("e.py", 10),
+        ]
+
+        def request_review(api_key, code, gpt_model, file_name, *args):
+            return {
+                name: {"1": {"feedback": f"Review of {file_name}"}}
+                for name in file_name.split(", ")
+            }
+
+        with mock.patch.object(
+            dispatcher.reviewer, "request_review", side_effect=request_review
+        ) as request_review_mock:
+            results = list(
+                dispatcher.request_reviews(
+                    "api_key",
+                    file_chunks,
+                    prompt.GptModel.GPT_35,
+                    pack_ratio=0.1,
+                )
+            )
+
+        self.assertEqual(
+            [call.args[3] for call in request_review_mock.call_args_list],
+            ["a.py", "b.py", "c.py", "d.py, e.py"],
+        )
+        self.assertEqual(
+            [file_chunk.file_name for file_chunk, _ in results],
+            ["a.py", "b.py", "c.py", "d.py", "e.py"],
+        )
+        self.assertEqual(
+            results[4][1], {"e.py": {"1": {"feedback": "Review of d.py, e.py"}}}
+        )
+
+    def test_request_reviews_submits_pack_before_oversized_file(self):
+        def request_review(api_key, code, gpt_model, file_name, *args):
+            name = file_name.split(" ")[0]
+            return {name: {"1": {"feedback": f"Review of {file_name}"}}}
+
+        with mock.patch.object(
+            dispatcher.reviewer, "request_review", side_effect=request_review
+        ), mock.patch.object(
+            dispatcher, "split_file_chunk", return_value=["b.py\n@@\n1 b\n"]
+        ):
+            results = list(
+                dispatcher.request_reviews(
+                    "api_key",
+                    [
+                        get_file_chunk("a.py", 50),
+                        # exceeds the limit of a file, but not the limit of a pack
+                        get_file_chunk("b.py", 1066),
+                        get_file_chunk("c.py", 5),
+                    ],
+                    prompt.GptModel.GPT_35,
+                    pack_ratio=0.9,
+                )
+            )
+
+        self.assertEqual(
+            [file_chunk.file_name for file_chunk, _ in results],
+            ["a.py", "b.py", "c.py"],
+        )
+
+    def test_split_file_chunk(self):
+        git_diff = (
+            "diff --git a/app.py b/app.py\n"
+            "--- a/app.py\n"
+            "+++ b/app.py\n"
+            "@@ -1,1 +1,2 @@ def run():\n"
+            " a = 1\n"
+            "+b = 2\n"
+            "@@ -10,1 +10,2 @@ def run():\n"
+            " c = 3\n"
+            "+d = 4\n"
+            "@@ -20,2 +20,8 @@ def main():\n"
+            " e = 5\n"
+            "+f = 6\n"
+            "+g = 7\n"
+            "+h = 8\n"
+            "+i = 9\n"
+            "+j = 10\n"
+            "+k = 11\n"
+            " l = 12\n"
+        )
+        file_chunk = next(formatter.parse_git_diff(git_diff.splitlines()))
+
+        windows = dispatcher.split_file_chunk(file_chunk, 30)
+
+        main_hunk_header = "app.py\n@@ -20,2 +20,8 @@ def main():\n"
+        self.assertEqual(
+            windows,
+            [
+                "app.py\n"
+                "@@ -1,1 +1,2 @@ def run():\n1  a = 1\n2 +b = 2\n"
+                "@@ -10,1 +10,2 @@ def run():\n10  c = 3\n11 +d = 4\n",
+                main_hunk_header
+                + "20  e = 5\n21 +f = 6\n22 +g = 7\n23 +h = 8\n24 +i = 9\n",
+                main_hunk_header + "25 +j = 10\n26 +k = 11\n27  l = 12\n",
+            ],
+        )
+
+    def test_request_reviews_merges_reviews_of_windows(self):
+        def request_review(api_key, code, gpt_model, file_name, *args):
+            first_line = code.splitlines()[2].split()[0]
+            return {"big.py": {first_line: {"feedback": f"Review of {file_name}"}}}
+
+        with mock.patch.object(
+            dispatcher.reviewer, "request_review", side_effect=request_review
+        ), mock.patch.object(
+            dispatcher,
+            "split_file_chunk",
+            return_value=["big.py\n@@\n1 a\n", "big.py\n@@\n2 b\n"],
+        ):
+            results = list(
+                dispatcher.request_reviews(
+                    "api_key",
+                    [get_file_chunk("big.py", 2000)],
+                    prompt.GptModel.GPT_35,
+                    max_workers=2,
+                )
+            )
+
+        self.assertEqual(
+            results[0][1],
+            {
+                "big.py": {
+                    "1": {"feedback": "Review of big.py 1/2"},
+                    "2": {"feedback": "Review of big.py 2/2"},
+                }
+            },
+        )
+
+    def test_request_reviews_fails_file_if_a_window_fails(self):
+        def request_review(api_key, code, gpt_model, file_name, *args):
+            if file_name.endswith("1/2"):
+                return None
+            return {"big.py": {"2": {"feedback": f"Review of {file_name}"}}}
+
+        file_chunk = get_file_chunk("big.py", 2000)
+        review_cache = mock.Mock()
+        review_cache.get.return_value = None
+        with mock.patch.object(
+            dispatcher.reviewer, "request_review", side_effect=request_review
+        ), mock.patch.object(
+            dispatcher,
+            "split_file_chunk",
+            return_value=["big.py\n@@\n1 a\n", "big.py\n@@\n2 b\n"],
+        ):
+            results = list(
+                dispatcher.request_reviews(
+                    "api_key",
+                    [file_chunk],
+                    prompt.GptModel.GPT_35,
+                    max_workers=2,
+                    review_cache=review_cache,
+                )
+            )
+
+        self.assertEqual(results, [(file_chunk, None)])
+        review_cache.put.assert_not_called()
+
+    def test_request_reviews_does_not_cache_truncated_reviews(self):
+        file_chunk = get_file_chunk("a.py")
+        review_cache = mock.Mock()
+        review_cache.get.return_value = None
+        with mock.patch.object(
+            dispatcher.reviewer,
+            "request_review",
+            return_value=review_parser.TruncatedReview(
+                {"a.py": {"1": {"feedback": "Handle errors."}}}
+            ),
+        ):
+            results = list(
+                dispatcher.request_reviews(
+                    "api_key",
+                    [file_chunk],
+                    prompt.GptModel.GPT_35,
+                    review_cache=review_cache,
+                )
+            )
+
+        self.assertEqual(
+            results, [(file_chunk, {"a.py": {"1": {"feedback": "Handle errors."}}})]
+        )
+        self.assertTrue(review_parser.is_truncated(results[0][1]))
+        review_cache.put.assert_not_called()
+
+    def test_request_reviews_records_time_of_requests(self):
+        def request_review(api_key, code, gpt_model, file_name, *args):
+            time.sleep(0.05)
+            return {name: {} for name in file_name.split(", ")}
+
+        file_chunks = [get_file_chunk(name) for name in ["a.py", "b.py", "c.py"]]
+        review_cache = mock.Mock()
+        review_cache.get.side_effect = lambda diff, gpt_model: (
+            {"c.py": {}} if diff.startswith("c.py") else None
+        )
+        review_timer = output.ReviewTimer()
+        review_seconds = []
+        with mock.patch.object(
+            dispatcher.reviewer, "request_review", side_effect=request_review
+        ), mock.patch("builtins.print"):
+            for file_chunk, _ in dispatcher.request_reviews(
+                "api_key",
+                file_chunks,
+                prompt.GptModel.GPT_35,
+                review_cache=review_cache,
+                review_timer=review_timer,
+            ):
+                review_seconds.append(review_timer.stop(file_chunk))
+
+        # a.py and b.py are packed into one request and share its time
+        self.assertEqual(review_seconds[0], review_seconds[1])
+        self.assertGreaterEqual(review_seconds[0], 0.05)
+        self.assertIsNone(review_seconds[2])
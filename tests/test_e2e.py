@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from tests.mock_openai import MockOpenAIServer
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Create a git repository with committed files and unstaged changes of them
+def create_repo(repo_root, file_count, line_count=20):
+    def git(*args):
+        subprocess.run(["git", *args], cwd=repo_root, check=True)
+
+    git("init", "-q")
+    file_paths = [f"src/module_{index}.py" for index in range(file_count)]
+    os.makedirs(os.path.join(repo_root, "src"), exist_ok=True)
+    for file_path in file_paths:
+        with open(os.path.join(repo_root, file_path), "w") as file:
+            file.writelines(f"value_{line} = {line}\n" for line in range(line_count))
+    git("add", ".")
+    git(
+        "-c",
+        "user.name=rgpt",
+        "-c",
+        "user.email=rgpt@localhost",
+        "commit",
+        "-qm",
+        "init",
+    )
+    for file_path in file_paths:
+        with open(os.path.join(repo_root, file_path), "a") as file:
+            file.write("result = value_1 / value_0\n")
+    return file_paths
+
+
+# Run rgpt in a repository against the mock server
+def run_rgpt(repo_root, base_url, *args, action="review"):
+    return subprocess.run(
+        [sys.executable, "-m", "gitreview_gpt", action, "--base-url", base_url]
+        + list(args),
+        cwd=repo_root,
+        env={
+            **os.environ,
+            "OPENAI_API_KEY": "test",
+            "PYTHONPATH": PROJECT_ROOT,
+            "XDG_CACHE_HOME": os.path.join(repo_root, ".cache"),
+        },
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+
+class TestEndToEnd(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.repo_root = self.tmp_dir.name
+        self.file_paths = create_repo(self.repo_root, 3)
+
+    def test_review(self):
+        with MockOpenAIServer() as server:
+            result = run_rgpt(self.repo_root, server.base_url, "--readonly")
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        for index in range(3):
+            self.assertIn(f"module_{index}.py", result.stdout)
+        self.assertEqual(result.stdout.count("Check the change in line 21."), 3)
+        # small files are packed into one request
+        self.assertEqual(len(server.requests), 1)
+
+    def test_streamed_review_is_retried_after_rate_limit(self):
+        with MockOpenAIServer(error_status=429, error_count=1) as server:
+            result = run_rgpt(self.repo_root, server.base_url, "--readonly", "--stream")
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.count("Check the change in line 21."), 3)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_truncated_review_is_repaired_locally(self):
+        with MockOpenAIServer(truncate_ratio=0.9) as server:
+            result = run_rgpt(self.repo_root, server.base_url, "--readonly")
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Check the change in line 21.", result.stdout)
+        self.assertNotIn("invalid format", result.stdout)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_review_is_applied(self):
+        subprocess.run(["git", "add", "."], cwd=self.repo_root, check=True)
+        with MockOpenAIServer() as server:
+            result = run_rgpt(self.repo_root, server.base_url)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.count("Successfully applied review changes"), 3)
+        # one review request and one edits request per file
+        self.assertEqual(len(server.requests), 4)
@@ -1,3 +1,4 @@
+import time
 import unittest
 import gitreview_gpt.formatter as formatter
 
@@ -291,3 +292,83 @@ class TestFormatter(unittest.TestCase):
             code_change_chunks["formatter.py"][""][0].code,
             self.code_change_chunks_fixture["formatter.py"][""][0].code,
         )
+
+    def test_parse_git_diff(self):
+        file_chunks = list(
+            formatter.parse_git_diff(self.git_diff.splitlines(keepends=True))
+        )
+
+        self.assertEqual(
+            [file_chunk.file_name for file_chunk in file_chunks],
+            ["app.py", "formatter.py"],
+        )
+        self.assertEqual(file_chunks[0].file_path, "gitreview_gpt/app.py")
+        self.assertEqual(file_chunks[0].diff, self.file_chunks_fixture["app.py"])
+        self.assertEqual(file_chunks[1].diff, self.file_chunks_fixture["formatter.py"])
+        code_chunk = file_chunks[0].code_chunks["run():"][1]
+        self.assertEqual((code_chunk.start_line, code_chunk.end_line), (223, 237))
+        self.assertTrue(code_chunk.diff.startswith("@@ -168,7 +223,15 @@ def run():"))
+
+    def test_parse_git_diff_skips_headers_of_new_and_deleted_files(self):
+        git_diff = (
+            "diff --git a/new.py b/new.py\n"
+            "new file mode 100644\n"
+            "index 0000000..e69de29\n"
+            "--- /dev/null\n"
+            "+++ b/new.py\n"
+            "@@ -0,0 +1 @@\n"
+            "+print('new')\n"
+            "\\ No newline at end of file\n"
+            "diff --git a/old.py b/old.py\n"
+            "deleted file mode 100644\n"
+            "index e69de29..0000000\n"
+            "--- a/old.py\n"
+            "+++ /dev/null\n"
+            "@@ -1 +0,0 @@\n"
+            "-print('old')\n"
+        )
+
+        formatted, file_chunks, _, file_paths = formatter.format_git_diff(git_diff)
+
+        self.assertEqual(formatted, "new.py\n@@ -0,0 +1 @@\n1 +print('new')\n")
+        self.assertEqual(file_paths, {"new.py": "new.py"})
+
+
+class TestGitDiffParserScaling(unittest.TestCase):
+    def get_git_diff(self, file_count):
+        hunk = (
+            "@@ -10,6 +10,7 @@ def run():\n"
+            " import os\n"
+            "-import sys\n"
+            "+import sys as system\n"
+            "+import json\n"
+            " \n"
+            " \n"
+            " def run():\n"
+            "     pass\n"
+        )
+        return "".join(
+            f"diff --git a/src/file{i}.py b/src/file{i}.py\n"
+            "index a18d784..49f9b9e 100644\n"
+            f"--- a/src/file{i}.py\n"
+            f"+++ b/src/file{i}.py\n" + hunk * 20
+            for i in range(file_count)
+        )
+
+    def time_format_git_diff(self, git_diff):
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            formatter.format_git_diff(git_diff)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def test_format_git_diff_scales_linearly(self):
+        small_diff = self.get_git_diff(50)
+        large_diff = self.get_git_diff(800)
+
+        small_time = self.time_format_git_diff(small_diff)
+        large_time = self.time_format_git_diff(large_diff)
+
+        # 16 times the input, quadratic scaling would take 256 times as long
+        self.assertLess(large_time / small_time, 16 * 3)
@@ -0,0 +1,170 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import gitreview_gpt.dispatcher as dispatcher
+import gitreview_gpt.formatter as formatter
+import gitreview_gpt.hunks as hunks
+import gitreview_gpt.prompt as prompt
+import gitreview_gpt.review_parser as review_parser
+from tests.mock_openai import MockOpenAIServer
+from tests.test_e2e import create_repo, run_rgpt
+
+DIFF = """diff --git a/app.py b/app.py
+--- a/app.py
++++ b/app.py
+@@ -1,2 +1,3 @@
+ import os
++import sys
+ import json
+@@ -10,2 +11,3 @@ def main():
+     value = 1
++    print(value)
+     return value
+"""
+
+SHIFTED_DIFF = """diff --git a/app.py b/app.py
+--- a/app.py
++++ b/app.py
+@@ -1,2 +1,3 @@
+ import os
++import re
+ import json
+@@ -20,2 +21,3 @@ def main():
+     value = 1
++    print(value)
+     return value
+"""
+
+
+def parse_file_chunk(diff):
+    return next(formatter.parse_git_diff(diff.splitlines()))
+
+
+class TestHunkIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.hunk_index = hunks.HunkIndex(self.tmp_dir.name)
+        self.gpt_model = prompt.GptModel.GPT_35
+
+    def test_fingerprint_ignores_line_numbers(self):
+        code_chunks = hunks.get_code_chunks(parse_file_chunk(DIFF))
+        shifted_code_chunks = hunks.get_code_chunks(parse_file_chunk(SHIFTED_DIFF))
+
+        self.assertNotEqual(
+            code_chunks[0].fingerprint, shifted_code_chunks[0].fingerprint
+        )
+        self.assertEqual(code_chunks[1].fingerprint, shifted_code_chunks[1].fingerprint)
+
+    def test_findings_are_moved_with_their_hunk(self):
+        file_chunk = parse_file_chunk(DIFF)
+        self.hunk_index.add(
+            "app.py",
+            hunks.get_code_chunks(file_chunk),
+            self.gpt_model,
+            {"2": {"feedback": "Unused import"}, "12-13": {"feedback": "Use logging"}},
+        )
+
+        findings, new_code_chunks = self.hunk_index.lookup(
+            parse_file_chunk(SHIFTED_DIFF), self.gpt_model
+        )
+
+        self.assertEqual(findings, {"22-23": {"feedback": "Use logging"}})
+        self.assertEqual([chunk.start_line for chunk in new_code_chunks], [1])
+
+    def test_findings_are_not_shared_by_files_with_the_same_name(self):
+        with mock.patch.object(
+            dispatcher.reviewer,
+            "request_review",
+            return_value={"utils.py": {"2": {"feedback": "Unused import"}}},
+        ) as request_review:
+            for file_path in ["api/utils.py", "web/utils.py"]:
+                list(
+                    dispatcher.request_reviews(
+                        "api_key",
+                        [parse_file_chunk(DIFF.replace("app.py", file_path))],
+                        self.gpt_model,
+                        hunk_index=self.hunk_index,
+                    )
+                )
+
+        # the identical hunks of the second file are reviewed as well
+        self.assertEqual(request_review.call_count, 2)
+
+    def test_merged_findings_are_sorted_by_line(self):
+        file_chunk = parse_file_chunk(DIFF)
+        self.hunk_index.add(
+            "app.py",
+            hunks.get_code_chunks(file_chunk)[1:],
+            self.gpt_model,
+            {"12": {"feedback": "Use logging"}},
+        )
+
+        with mock.patch.object(
+            dispatcher.reviewer,
+            "request_review",
+            return_value={"app.py": {"2": {"feedback": "Unused import"}}},
+        ):
+            [(_, review_json)] = dispatcher.request_reviews(
+                "api_key", [file_chunk], self.gpt_model, hunk_index=self.hunk_index
+            )
+
+        self.assertEqual(list(review_json["app.py"]), ["2", "12"])
+
+    def test_truncated_reviews_are_not_indexed(self):
+        with mock.patch.object(
+            dispatcher.reviewer,
+            "request_review",
+            return_value=review_parser.TruncatedReview(
+                {"app.py": {"2": {"feedback": "Unused import"}}}
+            ),
+        ) as request_review:
+            for _ in range(2):
+                list(
+                    dispatcher.request_reviews(
+                        "api_key",
+                        [parse_file_chunk(DIFF)],
+                        self.gpt_model,
+                        hunk_index=self.hunk_index,
+                    )
+                )
+
+        self.assertEqual(request_review.call_count, 2)
+
+    def test_partial_file_chunk(self):
+        file_chunk = parse_file_chunk(DIFF)
+        code_chunks = hunks.get_code_chunks(file_chunk)
+
+        partial_file_chunk = hunks.get_partial_file_chunk(file_chunk, code_chunks[1:])
+
+        self.assertEqual(partial_file_chunk.diff, "app.py\n" + code_chunks[1].diff)
+        self.assertEqual(partial_file_chunk.code_chunks, {"main():": [code_chunks[1]]})
+
+
+class TestHunkIndexEndToEnd(unittest.TestCase):
+    def test_only_new_hunks_are_reviewed(self):
+        with tempfile.TemporaryDirectory() as repo_root:
+            create_repo(repo_root, 2)
+            with MockOpenAIServer() as server:
+                result = run_rgpt(repo_root, server.base_url, "--readonly")
+                self.assertEqual(result.returncode, 0, result.stderr)
+
+                # insert a line above the reviewed hunk of one file
+                file_path = os.path.join(repo_root, "src", "module_0.py")
+                with open(file_path) as file:
+                    content = file.read()
+                with open(file_path, "w") as file:
+                    file.write("import math\n" + content)
+
+                result = run_rgpt(repo_root, server.base_url, "--readonly")
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(len(server.requests), 2)
+        prompt_text = server.requests[1]["messages"][-1]["content"]
+        self.assertIn("import math", prompt_text)
+        self.assertNotIn("value_1 / value_0", prompt_text)
+        self.assertIn("Check the change in line 1.", result.stdout)
+        # the finding of the moved hunk is reused at its new line
+        self.assertIn("Line 22", result.stdout)
+        self.assertEqual(result.stdout.count("Check the change in line 21."), 2)
@@ -0,0 +1,191 @@
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+import gitreview_gpt.incremental as incremental
+from tests.mock_openai import MockOpenAIServer
+from tests.test_e2e import create_repo, run_rgpt
+
+CHANGED_LINES_DIFF = """diff --git a/a.py b/a.py
+--- a/a.py
++++ b/a.py
+@@ -2,0 +3,2 @@ def main():
++import os
++import sys
+@@ -10,2 +12 @@ def main():
+-    print(1)
+-    print(2)
++    print(3)
+diff --git a/b.py b/b.py
+deleted file mode 100644
+--- a/b.py
++++ /dev/null
+@@ -1 +0,0 @@
+-value = 1
+"""
+
+
+class TestRemapFindings(unittest.TestCase):
+    def test_parse_changed_lines(self):
+        self.assertEqual(
+            incremental.parse_changed_lines(CHANGED_LINES_DIFF),
+            {
+                "a.py": ("a.py", [(2, 0, 3, 2), (10, 2, 12, 1)]),
+                "b.py": (None, [(1, 1, 0, 0)]),
+            },
+        )
+
+    def test_remap_findings(self):
+        findings = {
+            "a.py": {
+                "2": {"feedback": "Before the inserted lines"},
+                "5-6": {"feedback": "Between the hunks"},
+                "11": {"feedback": "Changed line"},
+                "20": {"feedback": "After the hunks"},
+            },
+            "b.py": {"1": {"feedback": "Deleted file"}},
+            "c.py": {"3": {"feedback": "Unchanged file"}},
+        }
+
+        remapped = incremental.remap_findings(
+            findings, incremental.parse_changed_lines(CHANGED_LINES_DIFF)
+        )
+
+        self.assertEqual(
+            remapped,
+            {
+                "a.py": {
+                    "2": {"feedback": "Before the inserted lines"},
+                    "7-8": {"feedback": "Between the hunks"},
+                    "21": {"feedback": "After the hunks"},
+                },
+                "c.py": {"3": {"feedback": "Unchanged file"}},
+            },
+        )
+
+
+class TestIncrementalReview(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.repo_root = self.tmp_dir.name
+        create_repo(self.repo_root, 2)
+        self.target_branch = subprocess.check_output(
+            ["git", "rev-parse", "--abbrev-ref", "HEAD"], cwd=self.repo_root, text=True
+        ).strip()
+        self.git("checkout", "-qb", "feature")
+        self.commit("feature")
+
+    def git(self, *args):
+        subprocess.run(["git", *args], cwd=self.repo_root, check=True)
+
+    def commit(self, message):
+        self.git("add", "src")
+        self.git(
+            "-c",
+            "user.name=rgpt",
+            "-c",
+            "user.email=rgpt@localhost",
+            "commit",
+            "-qm",
+            message,
+        )
+
+    def test_only_new_commits_are_reviewed(self):
+        with MockOpenAIServer() as server:
+            result = run_rgpt(
+                self.repo_root,
+                server.base_url,
+                "--readonly",
+                "--no-cache",
+                "--branch",
+                self.target_branch,
+                "--incremental",
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(result.stdout.count("Check the change in line 21."), 2)
+
+            # insert a line at the top of one file
+            file_path = os.path.join(self.repo_root, "src", "module_0.py")
+            with open(file_path) as file:
+                content = file.read()
+            with open(file_path, "w") as file:
+                file.write("import math\n" + content)
+            self.commit("insert import")
+
+            result = run_rgpt(
+                self.repo_root,
+                server.base_url,
+                "--readonly",
+                "--no-cache",
+                "--branch",
+                self.target_branch,
+                "--incremental",
+            )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(len(server.requests), 2)
+        prompt = server.requests[1]["messages"][-1]["content"]
+        self.assertIn("module_0.py", prompt)
+        self.assertNotIn("module_1.py", prompt)
+        self.assertIn("Check the change in line 1.", result.stdout)
+        # the previous findings are kept and moved below the inserted line
+        self.assertIn("Line 22", result.stdout)
+        self.assertIn("Findings of previous reviews", result.stdout)
+        self.assertEqual(result.stdout.count("Check the change in line 21."), 2)
+
+    def test_state_is_not_saved_with_staged_changes(self):
+        file_path = os.path.join(self.repo_root, "src", "module_0.py")
+        with open(file_path) as file:
+            content = file.read()
+        with open(file_path, "w") as file:
+            file.write("import math\n" + content)
+        self.git("add", "src")
+
+        with MockOpenAIServer() as server:
+            for _ in range(2):
+                result = run_rgpt(
+                    self.repo_root,
+                    server.base_url,
+                    "--readonly",
+                    "--no-cache",
+                    "--branch",
+                    self.target_branch,
+                    "--incremental",
+                )
+                self.assertEqual(result.returncode, 0, result.stderr)
+
+        self.assertEqual(len(server.requests), 2)
+        # all changes are reviewed again, since the first review wasn't saved
+        prompt = server.requests[1]["messages"][-1]["content"]
+        self.assertIn("module_0.py", prompt)
+        self.assertIn("module_1.py", prompt)
+        self.assertNotIn("Findings of previous reviews", result.stdout)
+
+    def test_machine_readable_output_without_new_changes(self):
+        with MockOpenAIServer() as server:
+            for output_format in ["text", "json"]:
+                result = run_rgpt(
+                    self.repo_root,
+                    server.base_url,
+                    "--readonly",
+                    "--no-cache",
+                    "--branch",
+                    self.target_branch,
+                    "--incremental",
+                    "--format",
+                    output_format,
+                )
+
+        # stdout only has the reviews, messages go to stderr
+        self.assertEqual(result.returncode, 0, result.stderr)
+        report = json.loads(result.stdout)
+        self.assertEqual(report["model"], "gpt-3.5-turbo")
+        # the findings of the previous review are written as file records
+        self.assertEqual(
+            sorted(file["file_path"] for file in report["files"]),
+            ["src/module_0.py", "src/module_1.py"],
+        )
+        self.assertEqual(report["files"][0]["findings"][0]["line"], 21)
+        self.assertIn("Reviewing changes since", result.stderr)
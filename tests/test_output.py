@@ -0,0 +1,182 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+import gitreview_gpt.output as output
+import gitreview_gpt.prompt as prompt
+from tests.mock_openai import MockOpenAIServer
+from tests.test_e2e import create_repo, run_rgpt
+
+FINDINGS = {
+    "12": {"feedback": "Check for None.", "suggestion": "Return early."},
+    "20-22": {"feedback": "Close the file."},
+}
+
+
+class TestReviewWriter(unittest.TestCase):
+    def write(self, output_format):
+        file = io.StringIO()
+        writer = output.ReviewWriter(file, output_format, prompt.GptModel.GPT_4)
+        writer.write_file("src/app.py", FINDINGS, 1.5)
+        # the first file is written before the output is closed
+        written = file.getvalue()
+        writer.write_file("src/utils.py", {})
+        writer.close()
+        return written, file.getvalue()
+
+    def test_json(self):
+        written, text = self.write(output.FORMAT_JSON)
+
+        self.assertIn("src/app.py", written)
+        report = json.loads(text)
+        self.assertEqual(report["model"], "gpt-4")
+        self.assertEqual(
+            report["files"][0],
+            {
+                "file_path": "src/app.py",
+                "model": "gpt-4",
+                "reviewed": True,
+                "error": None,
+                "findings": [
+                    {
+                        "line": 12,
+                        "end_line": 12,
+                        "feedback": "Check for None.",
+                        "suggestion": "Return early.",
+                    },
+                    {
+                        "line": 20,
+                        "end_line": 22,
+                        "feedback": "Close the file.",
+                        "suggestion": None,
+                    },
+                ],
+                "timings": {"review_seconds": 1.5},
+            },
+        )
+        self.assertEqual(report["files"][1]["findings"], [])
+        self.assertIn("total_seconds", report["timings"])
+
+    def test_jsonl(self):
+        written, text = self.write(output.FORMAT_JSONL)
+
+        self.assertEqual(written.count("\n"), 1)
+        records = [json.loads(line) for line in text.splitlines()]
+        self.assertEqual(
+            [record["file_path"] for record in records],
+            ["src/app.py", "src/utils.py"],
+        )
+
+    def test_sarif(self):
+        _, text = self.write(output.FORMAT_SARIF)
+
+        sarif = json.loads(text)
+        self.assertEqual(sarif["version"], "2.1.0")
+        results = sarif["runs"][0]["results"]
+        self.assertEqual(len(results), 2)
+        self.assertEqual(
+            results[0]["message"]["text"], "Check for None.\nReturn early."
+        )
+        self.assertEqual(
+            results[1]["locations"][0]["physicalLocation"],
+            {
+                "artifactLocation": {"uri": "src/app.py"},
+                "region": {"startLine": 20, "endLine": 22},
+            },
+        )
+
+    def test_failed_files_are_written(self):
+        file = io.StringIO()
+        writer = output.ReviewWriter(file, output.FORMAT_JSONL, prompt.GptModel.GPT_4)
+        writer.write_file("src/app.py", None, 1.5)
+        writer.close()
+
+        record = json.loads(file.getvalue())
+        self.assertFalse(record["reviewed"])
+        self.assertEqual(record["error"], output.REVIEW_FAILED_ERROR)
+        self.assertEqual(record["findings"], [])
+
+        file = io.StringIO()
+        writer = output.ReviewWriter(file, output.FORMAT_SARIF, prompt.GptModel.GPT_4)
+        writer.write_file("src/app.py", FINDINGS, 1.5)
+        writer.write_file("src/utils.py", None, 0.5)
+        writer.close()
+
+        run = json.loads(file.getvalue())["runs"][0]
+        self.assertEqual(len(run["results"]), 2)
+        invocation = run["invocations"][0]
+        self.assertFalse(invocation["executionSuccessful"])
+        self.assertEqual(
+            invocation["toolExecutionNotifications"][0]["locations"][0][
+                "physicalLocation"
+            ],
+            {"artifactLocation": {"uri": "src/utils.py"}},
+        )
+
+
+class TestOutputEndToEnd(unittest.TestCase):
+    def test_jsonl_to_stdout(self):
+        with tempfile.TemporaryDirectory() as repo_root:
+            create_repo(repo_root, 2)
+            with MockOpenAIServer() as server:
+                result = run_rgpt(
+                    repo_root, server.base_url, "--readonly", "--format", "jsonl"
+                )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        # stdout only has the reviews, messages go to stderr
+        records = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual(
+            [record["file_path"] for record in records],
+            ["src/module_0.py", "src/module_1.py"],
+        )
+        self.assertEqual(records[0]["findings"][0]["line"], 21)
+        self.assertEqual(records[0]["model"], "gpt-3.5-turbo")
+        self.assertIsNotNone(records[0]["timings"]["review_seconds"])
+
+    def test_sarif_to_file(self):
+        with tempfile.TemporaryDirectory() as repo_root:
+            create_repo(repo_root, 1)
+            sarif_path = os.path.join(repo_root, "review.sarif")
+            with MockOpenAIServer() as server:
+                result = run_rgpt(
+                    repo_root,
+                    server.base_url,
+                    "--readonly",
+                    "--format",
+                    "sarif",
+                    "--output",
+                    sarif_path,
+                )
+            with open(sarif_path) as file:
+                sarif = json.load(file)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(len(sarif["runs"][0]["results"]), 1)
+
+    def test_failed_review_to_stdout(self):
+        with tempfile.TemporaryDirectory() as repo_root:
+            create_repo(repo_root, 2)
+            with MockOpenAIServer(error_status=500, error_count=1) as server:
+                result = run_rgpt(
+                    repo_root,
+                    server.base_url,
+                    "--readonly",
+                    "--format",
+                    "jsonl",
+                    "--concurrency",
+                    "1",
+                    "--pack-ratio",
+                    "0",
+                    "--max-retries",
+                    "0",
+                )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        records = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual(
+            [(record["file_path"], record["reviewed"]) for record in records],
+            [("src/module_0.py", False), ("src/module_1.py", True)],
+        )
+        self.assertIn("An error occurred while requesting a review", result.stderr)
@@ -0,0 +1,52 @@
+import unittest
+import gitreview_gpt.patch as patch
+
+
+class TestPatch(unittest.TestCase):
+    def setUp(self):
+        self.content = (
+            "def run(args):\n"
+            "    if args:\n"
+            "        print(args)\n"
+            "    return None\n"
+            "\n"
+            "def main():\n"
+            "    run([])"
+        )
+
+    def test_apply_edits(self):
+        review_edits = (
+            "```python\n"
+            "<<<<<<< SEARCH\n"
+            "    if args:\n"
+            "        print(args)\n"
+            "=======\n"
+            "    for arg in args:\n"
+            "        print(arg)\n"
+            ">>>>>>> REPLACE\n"
+            "```\n"
+            "<<<<<<< SEARCH\n"
+            "    run([])  \n"
+            "=======\n"
+            "    run(sys.argv)\n"
+            ">>>>>>> REPLACE\n"
+        )
+
+        self.assertEqual(
+            patch.apply_edits(self.content, patch.parse_edits(review_edits)),
+            "def run(args):\n"
+            "    for arg in args:\n"
+            "        print(arg)\n"
+            "    return None\n"
+            "\n"
+            "def main():\n"
+            "    run(sys.argv)\n",
+        )
+
+    def test_apply_edits_rejects_edits_which_dont_match_once(self):
+        with self.assertRaises(ValueError):
+            patch.parse_edits("The code looks good.")
+        with self.assertRaises(ValueError):
+            patch.apply_edits(self.content, [("    print(arg)\n", "")])
+        with self.assertRaises(ValueError):
+            patch.apply_edits(self.content, [("    ", "  ")])
@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+import unittest
+import gitreview_gpt.profiler as profiler
+import gitreview_gpt.review_parser as review_parser
+from tests.mock_openai import MockOpenAIServer
+from tests.test_e2e import create_repo, run_rgpt
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        profiler.reset()
+        self.addCleanup(profiler.reset)
+
+    def test_nothing_is_recorded_if_disabled(self):
+        with profiler.timer("block"):
+            pass
+        profiler.count("requests")
+
+        report = profiler.get_report()
+        self.assertEqual(report["timers"], {})
+        self.assertEqual(report["counters"], {})
+
+    def test_timers_and_counters(self):
+        profiler.enable()
+
+        @profiler.timed("function")
+        def function(value):
+            return value * 2
+
+        self.assertEqual(function(2), 4)
+        self.assertEqual(function(3), 6)
+        with profiler.timer("block"):
+            pass
+        profiler.count("tokens", 10)
+        profiler.count("tokens", 5)
+
+        report = profiler.get_report()
+        self.assertEqual(report["timers"]["function"]["calls"], 2)
+        self.assertEqual(report["timers"]["block"]["calls"], 1)
+        self.assertEqual(report["counters"], {"tokens": 15})
+
+    def test_timed_iter_is_recorded_once(self):
+        profiler.enable()
+
+        self.assertEqual(list(profiler.timed_iter("items", iter([1, 2, 3]))), [1, 2, 3])
+
+        self.assertEqual(profiler.get_report()["timers"]["items"]["calls"], 1)
+
+    def test_parse_stages_are_counted(self):
+        profiler.enable()
+
+        review_parser.parse_review('{"a.py": {"1": {"feedback": "Fix"}}}')
+        review_parser.parse_review(
+            'Review:\n```json\n{"a.py": {"1": {"feedback": "Fix"}}}\n```\nSee {above}'
+        )
+        review_parser.parse_review('{"a.py": {"1": {"feedback": "Fix"}, "2": {"fe')
+
+        self.assertEqual(
+            profiler.get_report()["counters"],
+            {"parse_json": 1, "parse_code_blocks": 1, "parse_repaired": 1},
+        )
+
+
+class TestProfileEndToEnd(unittest.TestCase):
+    def test_profile_json(self):
+        with tempfile.TemporaryDirectory() as repo_root:
+            create_repo(repo_root, 2)
+            profile_path = os.path.join(repo_root, "profile.json")
+            with MockOpenAIServer(error_status=503, error_count=1) as server:
+                result = run_rgpt(
+                    repo_root,
+                    server.base_url,
+                    "--readonly",
+                    "--stream",
+                    "--max-retries",
+                    "1",
+                    "--profile",
+                    "--profile-json",
+                    profile_path,
+                )
+            with open(profile_path) as file:
+                report = json.load(file)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("⏱️  Profile", result.stdout)
+        for timer in ("get_git_diff", "format_git_diff", "send_request"):
+            self.assertIn(timer, report["timers"])
+        self.assertEqual(report["counters"]["requests"], 2)
+        self.assertEqual(report["counters"]["retries"], 1)
+        self.assertEqual(report["counters"]["cache_misses"], 2)
+        self.assertGreater(report["counters"]["prompt_tokens"], 0)
+        self.assertGreater(report["counters"]["completion_tokens"], 0)
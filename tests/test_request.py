@@ -0,0 +1,174 @@
+import json
+import unittest
+from unittest import mock
+import requests
+import gitreview_gpt.request as request
+
+
+def get_response(status_code, headers=None, content="{}"):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = content.encode()
+    return response
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestSendRequest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        for name in ("monotonic", "sleep"):
+            patcher = mock.patch.object(
+                request.time, name, side_effect=getattr(self.clock, name)
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(request, "rate_limiter", request.RateLimiter())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = mock.Mock()
+        patcher = mock.patch.object(request, "get_session", return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.payload = {"messages": [{"role": "user", "content": "review"}]}
+
+    def test_retries_rate_limited_request_after_retry_after(self):
+        self.session.post.side_effect = [
+            get_response(429, {"Retry-After": "3"}),
+            get_response(503),
+            get_response(
+                200, content='{"choices": [{"message": {"content": "review"}}]}'
+            ),
+        ]
+
+        with mock.patch.object(request.random, "uniform", return_value=1.5):
+            result = request.send_request("key", self.payload)
+
+        self.assertEqual(result, "review")
+        self.assertEqual(self.session.post.call_count, 3)
+        self.assertEqual(self.clock.now, 4.5)
+
+    def test_returns_tool_call_arguments(self):
+        arguments = '{"app.py": {"1": {"feedback": "Use \\u00e9t\u00e9."}}}'
+        self.session.post.return_value = get_response(
+            200,
+            content=json.dumps(
+                {
+                    "choices": [
+                        {
+                            "message": {
+                                "content": None,
+                                "tool_calls": [{"function": {"arguments": arguments}}],
+                            }
+                        }
+                    ]
+                }
+            ),
+        )
+        payload = {**self.payload, "tool_choice": {"type": "function"}}
+
+        self.assertEqual(request.send_request("key", payload), arguments)
+
+    def test_streams_tool_call_arguments(self):
+        response = mock.Mock()
+        response.iter_lines.return_value = iter(
+            [
+                b'data: {"choices": [{"delta": {"role": "assistant"}}]}',
+                b'data: {"choices": [{"delta": {"tool_calls": [{"function":'
+                b' {"name": "submit_review", "arguments": ""}}]}}]}',
+                b'data: {"choices": [{"delta": {"tool_calls": [{"function":'
+                b' {"arguments": "{\\"app.py\\": "}}]}}]}',
+                b'data: {"choices": [{"delta": {"tool_calls": [{"function":'
+                b' {"arguments": "{}}"}}]}}]}',
+                b"data: [DONE]",
+            ]
+        )
+
+        self.assertEqual(
+            list(request.iter_stream_content(response)), ['{"app.py": ', "{}}"]
+        )
+
+    def test_gives_up_after_max_retries(self):
+        self.session.post.return_value = get_response(500)
+
+        with mock.patch.dict(request._client_config, {"max_retries": 2}):
+            with mock.patch("builtins.print"):
+                result = request.send_request("key", self.payload)
+
+        self.assertIsNone(result)
+        self.assertEqual(self.session.post.call_count, 3)
+
+    def test_does_not_retry_client_errors(self):
+        self.session.post.return_value = get_response(401)
+
+        with mock.patch("builtins.print"):
+            result = request.send_request("key", self.payload)
+
+        self.assertIsNone(result)
+        self.assertEqual(self.session.post.call_count, 1)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        for name in ("monotonic", "sleep"):
+            patcher = mock.patch.object(
+                request.time, name, side_effect=getattr(self.clock, name)
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_acquire_waits_for_refilled_buckets(self):
+        rate_limiter = request.RateLimiter(requests_per_minute=2, tokens_per_minute=600)
+
+        rate_limiter.acquire(300)
+        rate_limiter.acquire(100)
+        self.assertEqual(self.clock.now, 0)
+
+        # the requests bucket is empty, one request is refilled in 30 seconds
+        rate_limiter.acquire(100)
+        self.assertEqual(self.clock.now, 30)
+
+        # 300 tokens are left after refilling, 500 tokens are missing
+        rate_limiter.acquire(800)
+        self.assertEqual(self.clock.now, 30 + 30)
+
+    def test_pause_blocks_all_requests(self):
+        rate_limiter = request.RateLimiter()
+        rate_limiter.pause(5)
+        rate_limiter.acquire(100)
+        self.assertEqual(self.clock.now, 5)
+
+
+class TestResetDelay(unittest.TestCase):
+    def test_parse_duration(self):
+        self.assertEqual(request.parse_duration("6m0s"), 360)
+        self.assertEqual(request.parse_duration("1.5s"), 1.5)
+        self.assertEqual(request.parse_duration("20ms"), 0.02)
+        self.assertEqual(request.parse_duration("2"), 2)
+        self.assertIsNone(request.parse_duration(None))
+
+    def test_get_response_reset_delay(self):
+        response = get_response(
+            200,
+            {
+                "x-ratelimit-remaining-requests": "3",
+                "x-ratelimit-reset-requests": "10s",
+                "x-ratelimit-remaining-tokens": "0",
+                "x-ratelimit-reset-tokens": "1m2s",
+            },
+        )
+        self.assertEqual(request.get_response_reset_delay(response), 62)
+
+        response.headers["x-ratelimit-remaining-tokens"] = "100"
+        self.assertIsNone(request.get_response_reset_delay(response))
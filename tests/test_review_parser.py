@@ -1,5 +1,6 @@
 import unittest
 import gitreview_gpt.formatter as formatter
+import gitreview_gpt.review_parser as review_parser
 
 
 class TestReviewParser(unittest.TestCase):
@@ -239,3 +240,120 @@ class TestReviewParser(unittest.TestCase):
                 34: "       # Remove git --diff section",
             },
         )
+
+    def test_review_stream_parser(self):
+        review_result = (
+            "```json\n"
+            '{"app.py": {"12": {"feedback": "Handle the {error} case."},'
+            ' "14-16": {"feedback": "Use a \\"with\\" block.", "suggestion": null}},'
+            ' "formatter.py": {}}\n'
+            "```"
+        )
+        parser = formatter.ReviewStreamParser()
+        events = []
+        for i in range(0, len(review_result), 7):
+            events.extend(parser.feed(review_result[i : i + 7]))
+
+        self.assertEqual(
+            events,
+            [
+                ("file", "app.py"),
+                ("finding", "app.py", "12", {"feedback": "Handle the {error} case."}),
+                (
+                    "finding",
+                    "app.py",
+                    "14-16",
+                    {"feedback": 'Use a "with" block.', "suggestion": None},
+                ),
+                ("file_end", "app.py"),
+                ("file", "formatter.py"),
+                ("file_end", "formatter.py"),
+            ],
+        )
+
+    def test_parse_review_tolerates_loose_json(self):
+        review_result = (
+            "Here's my review:\n"
+            "```json\n"
+            "{'app.py': {'Line 12': {feedback: 'Don\\'t ignore the \"error\".',},\n"
+            "  '14 - 16': {'feedback': 'Use a with block.', 'suggestion': None},},}\n"
+            "```\n"
+            "```json\n"
+            '{"formatter.py": [{"line": 3, "feedback": "Compile the pattern."}]}\n'
+            "```\n"
+            "Let me know if you have questions."
+        )
+
+        self.assertEqual(
+            review_parser.parse_review(review_result),
+            {
+                "app.py": {
+                    "12": {"feedback": 'Don\'t ignore the "error".'},
+                    "14-16": {"feedback": "Use a with block.", "suggestion": None},
+                },
+                "formatter.py": {"3": {"feedback": "Compile the pattern."}},
+            },
+        )
+
+    def test_parse_review_quotes_line_number_keys(self):
+        self.assertEqual(
+            review_parser.parse_review(
+                "{'app.py': {12: {'feedback': 'Handle errors.'}, "
+                + "14 - 16: {'feedback': 'Use a with block.'}}}"
+            ),
+            {
+                "app.py": {
+                    "12": {"feedback": "Handle errors."},
+                    "14-16": {"feedback": "Use a with block."},
+                }
+            },
+        )
+        self.assertEqual(
+            review_parser.parse_review(
+                '{"app.py": {3-5: {feedback: "Compile the pattern."}}}'
+            ),
+            {"app.py": {"3-5": {"feedback": "Compile the pattern."}}},
+        )
+
+    def test_parse_review_repairs_truncated_json(self):
+        review_result = (
+            '```json\n{"app.py": {"12": {"feedback": "Handle errors."},'
+            ' "14": {"feedback": "Trunc'
+        )
+
+        review_json = review_parser.parse_review(review_result)
+        self.assertEqual(
+            review_json, {"app.py": {"12": {"feedback": "Handle errors."}}}
+        )
+        self.assertTrue(review_parser.is_truncated(review_json))
+        self.assertFalse(
+            review_parser.is_truncated(
+                review_parser.parse_review(review_result + '"}}}')
+            )
+        )
+
+    def test_parse_review_rejects_invalid_schema(self):
+        for review_result in [
+            "",
+            "No issues found.",
+            '{"12": {"feedback": "Handle errors."}}',
+            '{"app.py": "Handle errors."}',
+        ]:
+            with self.assertRaises(ValueError):
+                review_parser.parse_review(review_result)
+        self.assertEqual(review_parser.parse_review('{"app.py": {}}'), {"app.py": {}})
+
+    def test_parse_structured_review(self):
+        self.assertEqual(
+            review_parser.parse_structured_review(
+                '{"app.py": {"12": {"feedback": "Handle errors.", "suggestion": 1}}}'
+            ),
+            {"app.py": {"12": {"feedback": "Handle errors."}}},
+        )
+        # truncated arguments are repaired by the tolerant parser
+        self.assertEqual(
+            review_parser.parse_structured_review(
+                '{"app.py": {"12": {"feedback": "Handle errors."}, "14": {"feed'
+            ),
+            {"app.py": {"12": {"feedback": "Handle errors."}}},
+        )
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import gitreview_gpt.prompt as prompt
+import gitreview_gpt.reviewer as reviewer
+
+
+class TestReviewer(unittest.TestCase):
+    def test_request_review_changes_concurrently_keeps_chunk_order(self):
+        code_chunks = [
+            {"code": f"@@ -{i},1 +{i},1 @@\n{i} a = {i}\n", "suggestions": {}}
+            for i in range(1, 6)
+        ]
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def request_review_changes(chunk, *args):
+            with lock:
+                running.append(chunk)
+                max_running.append(len(running))
+            # later chunks finish first
+            time.sleep(0.01 * (6 - len(running)))
+            with lock:
+                running.remove(chunk)
+            return chunk["code"]
+
+        with mock.patch.object(
+            reviewer, "request_review_changes", side_effect=request_review_changes
+        ):
+            results = reviewer.request_review_changes_concurrently(
+                code_chunks,
+                "key",
+                prompt.GptModel.GPT_35,
+                "Python",
+                "app.py",
+                3,
+                show_spinner=False,
+            )
+
+        self.assertEqual(results, [chunk["code"] for chunk in code_chunks])
+        self.assertLessEqual(max(max_running), 3)
+
+    def test_apply_review_falls_back_to_complete_file_for_invalid_edits(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "app.py")
+            with open(file_path, "w") as file:
+                file.write("import os\nprint(1)\n")
+            review_json = {"2": {"feedback": "Print 2."}}
+            responses = [
+                "<<<<<<< SEARCH\nprint(3)\n=======\nprint(2)\n>>>>>>> REPLACE\n",
+                "```python\nimport os\nprint(2)\n```",
+                "<<<<<<< SEARCH\nprint(1)\n=======\nprint(2)\n>>>>>>> REPLACE\n",
+            ]
+
+            with mock.patch.object(
+                reviewer.tokens, "count_prompt_tokens", return_value=100
+            ), mock.patch.object(
+                reviewer.request, "send_request", side_effect=responses
+            ) as send_request, mock.patch(
+                "builtins.print"
+            ):
+                reviewer.apply_review(
+                    "key", file_path, review_json, None, prompt.GptModel.GPT_35
+                )
+                with open(file_path) as file:
+                    self.assertEqual(file.read(), "import os\nprint(2)")
+                self.assertEqual(send_request.call_count, 2)
+
+                with open(file_path, "w") as file:
+                    file.write("import os\nprint(1)\n")
+                reviewer.apply_review(
+                    "key", file_path, review_json, None, prompt.GptModel.GPT_35
+                )
+                with open(file_path) as file:
+                    self.assertEqual(file.read(), "import os\nprint(2)\n")
+                self.assertEqual(send_request.call_count, 3)
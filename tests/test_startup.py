@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import unittest
+
+HEAVY_MODULES = ["requests", "tiktoken", "yaspin", "multiprocessing"]
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Return the cumulative import time in microseconds of a module
+# measured in a fresh interpreter
+def get_import_time(module):
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    # lines have the format "import time: self [us] | cumulative | module"
+    for line in output.splitlines():
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative)
+    raise ValueError(f"No import time of {module}")
+
+
+class TestStartup(unittest.TestCase):
+    def test_app_does_not_import_heavy_modules(self):
+        loaded_modules = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, gitreview_gpt.app; "
+                + f"print(*[m for m in {HEAVY_MODULES} if m in sys.modules])",
+            ],
+            cwd=PROJECT_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        self.assertEqual(loaded_modules, [])
+
+    def test_help_does_not_import_heavy_modules(self):
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, runpy\n"
+                + "sys.argv = ['rgpt', '--help']\n"
+                + "try:\n"
+                + "    runpy.run_module('gitreview_gpt', run_name='__main__')\n"
+                + "except SystemExit:\n"
+                + f"    print(*[m for m in {HEAVY_MODULES} if m in sys.modules])",
+            ],
+            cwd=PROJECT_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        self.assertIn("usage:", output)
+        self.assertEqual(output.splitlines()[-1].split(), [])
+
+    def test_app_imports_faster_than_requests(self):
+        try:
+            requests_import_time = get_import_time("requests")
+        except subprocess.CalledProcessError:
+            self.skipTest("requests is not installed")
+        # best of three, to not fail on a single slow run
+        app_import_time = min(get_import_time("gitreview_gpt.app") for _ in range(3))
+        self.assertLess(app_import_time, requests_import_time)
@@ -0,0 +1,58 @@
+import unittest
+from unittest import mock
+import gitreview_gpt.prompt as prompt
+import gitreview_gpt.tokens as tokens
+
+
+class WhitespaceEncoding:
+    def __init__(self):
+        self.encoded_texts = []
+
+    def encode(self, text, disallowed_special=()):
+        self.encoded_texts.append(text)
+        return text.split()
+
+    def encode_batch(self, texts, disallowed_special=()):
+        return [self.encode(text) for text in texts]
+
+
+class TestTokens(unittest.TestCase):
+    def setUp(self):
+        self.encoding = WhitespaceEncoding()
+        patcher = mock.patch.object(tokens, "get_encoding", return_value=self.encoding)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tokens._count_prompt_scaffold_tokens.cache_clear()
+
+    def test_count_tokens_batch(self):
+        self.assertEqual(tokens.count_tokens_batch(["a b", "", "c d e"]), [2, 0, 3])
+
+    def test_count_prompt_tokens_counts_scaffold_once(self):
+        gpt_model = prompt.GptModel.GPT_35
+        scaffold_tokens = tokens.count_prompt_tokens(
+            prompt.get_review_prompt, ("",), gpt_model.value, gpt_model
+        )
+        self.encoding.encoded_texts.clear()
+
+        prompt_tokens = tokens.count_prompt_tokens(
+            prompt.get_review_prompt, ("1 import json",), gpt_model.value, gpt_model
+        )
+
+        self.assertEqual(prompt_tokens, scaffold_tokens + 3)
+        self.assertEqual(self.encoding.encoded_texts, ["1 import json"])
+
+
+class TestEstimatedEncoding(unittest.TestCase):
+    def test_get_encoding_falls_back_to_estimate(self):
+        tokens.get_encoding.cache_clear()
+        self.addCleanup(tokens.get_encoding.cache_clear)
+        with mock.patch(
+            "tiktoken.encoding_for_model", side_effect=OSError("offline")
+        ), mock.patch("builtins.print"):
+            encoding = tokens.get_encoding()
+
+        self.assertIsInstance(encoding, tokens.EstimatedEncoding)
+        self.assertEqual(
+            encoding.encode("def review(code):"),
+            ["def", "revi", "ew", "(", "code", ")", ":"],
+        )
@@ -1,4 +1,9 @@
+import io
+import os
+import subprocess
+import tempfile
 import unittest
+from unittest import mock
 import gitreview_gpt.utils as utils
 
 
@@ -17,16 +22,166 @@ class TestUtils(unittest.TestCase):
                 "29": {
                     "feedback": "Consider using a more descriptive variable name inst
         """
-        expected_repaired_json = """{
+        expected_repaired_json = {
             "formatter.py": {
                 "23": {
                     "feedback": "Consider adding type hints to the function signature.",
-                    "suggestion": "Add type hints to the `format_git_diff` function."
+                    "suggestion": "Add type hints to the `format_git_diff` function.",
                 },
                 "26": {
                     "feedback": "Consider using a more descriptive variable name instead of `file_chunks`.",
-                    "suggestion": "Rename the `file_chunks` variable to something more descriptive."
-                }\n}\n}"""
+                    "suggestion": "Rename the `file_chunks` variable to something more descriptive.",
+                },
+            }
+        }
 
         repaired_json = utils.repair_truncated_json(json_str)
         self.assertEqual(repaired_json, expected_repaired_json)
+
+    def test_repair_truncated_json_tracks_strings_and_nesting(self):
+        json_str = (
+            "```json\n"
+            '{"a.py": {"1": {"feedback": "Use `{}` and `]`, not \\"[\\"."}},'
+            ' "b.py": {"2": {"feedback": "Fine.", "lines": [3, 4]}, "5": {"feed'
+        )
+
+        self.assertEqual(
+            utils.repair_truncated_json(json_str),
+            {
+                "a.py": {"1": {"feedback": 'Use `{}` and `]`, not "[".'}},
+                "b.py": {"2": {"feedback": "Fine.", "lines": [3, 4]}},
+            },
+        )
+        with self.assertRaises(ValueError):
+            utils.repair_truncated_json('{"a.py": {"1": {"feedback": "Trunc')
+
+    def test_get_unstaged_files(self):
+        with tempfile.TemporaryDirectory() as repo_root:
+
+            def git(*args):
+                subprocess.run(["git", *args], cwd=repo_root, check=True)
+
+            def write(path, content):
+                with open(os.path.join(repo_root, path), "w") as file:
+                    file.write(content)
+
+            git("init", "-q")
+            os.mkdir(os.path.join(repo_root, "src"))
+            for path in ["staged.py", "unstaged.py", "src/both.py", "renamed.py"]:
+                write(path, "a = 1\n")
+            git("add", ".")
+            git("-c", "user.name=a", "-c", "user.email=a@a", "commit", "-qm", "init")
+
+            write("staged.py", "a = 2\n")
+            write("unstaged.py", "a = 2\n")
+            write("src/both.py", "a = 2\n")
+            git("add", "staged.py", "src/both.py")
+            write("src/both.py", "a = 3\n")
+            git("mv", "renamed.py", "moved.py")
+            write("moved.py", "a = 2\n")
+            write("untracked.py", "a = 1\n")
+
+            self.assertEqual(
+                utils.get_unstaged_files(repo_root),
+                {"unstaged.py", "src/both.py", "moved.py"},
+            )
+
+    def test_override_lines_in_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "app.py")
+            with open(file_path, "w") as file:
+                file.write("import os\nimport sys\nprint(1)")
+            os.chmod(file_path, 0o755)
+
+            utils.override_lines_in_file(
+                file_path, {2: "import json\nimport re", 3: "print(2)", 5: "print(3)"}
+            )
+
+            with open(file_path) as file:
+                self.assertEqual(
+                    file.read(), "import os\nimport json\nimport re\nprint(2)"
+                )
+            self.assertEqual(os.stat(file_path).st_mode & 0o777, 0o755)
+            self.assertEqual(os.listdir(tmp_dir), ["app.py"])
+
+    def test_write_file_atomically(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "app.py")
+            with open(file_path, "w") as file:
+                file.write("print(1)\n")
+            os.chmod(file_path, 0o755)
+
+            utils.write_file_atomically(file_path, "print(2)\n")
+            with mock.patch.object(
+                utils.os, "fsync", side_effect=OSError("disk full")
+            ), self.assertRaises(OSError):
+                utils.write_file_atomically(file_path, "print(3)\n")
+
+            with open(file_path) as file:
+                self.assertEqual(file.read(), "print(2)\n")
+            self.assertEqual(os.stat(file_path).st_mode & 0o777, 0o755)
+            self.assertEqual(os.listdir(tmp_dir), ["app.py"])
+
+    def test_edit_lines_in_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            app_path = os.path.join(tmp_dir, "app.py")
+            utils_path = os.path.join(tmp_dir, "utils.py")
+            with open(app_path, "w", newline="") as file:
+                file.write("a = 1\r\nb = 2\r\nc = 3\r\nd = 4\r\n")
+            with open(utils_path, "w") as file:
+                file.write("x = 1\n")
+
+            utils.edit_lines_in_files(
+                {
+                    app_path: [
+                        utils.LineEdit(1, 0, ["# header"]),
+                        utils.LineEdit(2, 3, []),
+                        utils.LineEdit(4, 4, ["d = 5", "e = 6"]),
+                        utils.LineEdit(5, 4, ["f = 7"]),
+                    ],
+                    utils_path: [utils.LineEdit(2, 1, ["y = 2"])],
+                }
+            )
+
+            with open(app_path, newline="") as file:
+                self.assertEqual(
+                    file.read(), "# header\r\na = 1\r\nd = 5\r\ne = 6\r\nf = 7\r\n"
+                )
+            with open(utils_path) as file:
+                self.assertEqual(file.read(), "x = 1\ny = 2\n")
+
+    def test_edit_lines_in_files_keeps_files_on_error(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            app_path = os.path.join(tmp_dir, "app.py")
+            with open(app_path, "w") as file:
+                file.write("a = 1\nb = 2\n")
+
+            with self.assertRaises(ValueError):
+                utils.edit_lines_in_files(
+                    {app_path: [utils.LineEdit(1, 2, []), utils.LineEdit(2, 2, [])]}
+                )
+            with self.assertRaises(FileNotFoundError):
+                utils.edit_lines_in_files(
+                    {
+                        app_path: [utils.LineEdit(1, 1, ["a = 2"])],
+                        os.path.join(tmp_dir, "utils.py"): [],
+                    }
+                )
+
+            with open(app_path) as file:
+                self.assertEqual(file.read(), "a = 1\nb = 2\n")
+            self.assertEqual(os.listdir(tmp_dir), ["app.py"])
+
+    def test_messages_are_routed_to_message_stream(self):
+        stream = io.StringIO()
+        with mock.patch.object(utils, "message_stream", stream), mock.patch(
+            "sys.stdout", io.StringIO()
+        ) as stdout:
+            utils.print_message("Reviewing", "app.py")
+            with utils.get_spinner("🔍 Reviewing utils.py..."):
+                pass
+
+        self.assertEqual(
+            stream.getvalue(), "Reviewing app.py\n🔍 Reviewing utils.py...\n"
+        )
+        self.assertEqual(stdout.getvalue(), "")